@@ -1,100 +1,506 @@
-from threading import Thread, Event
-from multiprocessing import Process, Queue
+from threading import Lock, Timer
+from concurrent.futures import (Future, ProcessPoolExecutor, ThreadPoolExecutor,
+                                FIRST_COMPLETED, TimeoutError as FutureTimeout, wait)
+from concurrent.futures.process import BrokenProcessPool
+from collections import deque
+import atexit
+import os
+import time
 import logging
-from logging.handlers import RotatingFileHandler
+from app_logging import get_logger
 from datetime import datetime
 from pathlib import Path
 import json
+from file_locks import locked
 
-# Shared logger for system-wide errors (configured once)
-shared_logger = None
-
-
-def setup_logging(username):
-    global shared_logger
-    logger = logging.getLogger(__name__)
-    logger.setLevel(logging.DEBUG)
-    user_dir = BASE_DIR / "users" / username
-    user_dir.mkdir(parents=True, exist_ok=True)
-
-    # User-specific log with rotation
-    file_handler = RotatingFileHandler(
-        user_dir / "tracker.log", maxBytes=5*1024*1024, backupCount=3
-    )
-    console_handler = logging.StreamHandler()
-    file_handler.setLevel(logging.INFO)
-    console_handler.setLevel(logging.WARNING)
-    formatter = logging.Formatter(
-        "%(asctime)s -%(name)s - %(levelname)s - %(message)s")
-    file_handler.setFormatter(formatter)
-    console_handler.setFormatter(formatter)
-
-    # Configure shared logger for ERROR and CRITICAL (only once)
-    if shared_logger is None:
-        shared_logger = logging.getLogger('shared')
-        shared_logger.setLevel(logging.ERROR)
-        shared_file_handler = RotatingFileHandler(
-            BASE_DIR / "tracker.log", maxBytes=10*1024*1024, backupCount=5
-        )
-        shared_file_handler.setFormatter(formatter)
-        shared_logger.handlers = [shared_file_handler]
-
-    # Clear existing handlers to avoid duplicates
-    logger.handlers = []
-    logger.addHandler(file_handler)
-    logger.addHandler(console_handler)
-    # Add shared handler for ERROR/CRITICAL
-    logger.addHandler(shared_logger.handlers[0])
-    return logger
-
-
-BASE_DIR = Path(__file__).resolve().parent
-
-
-def process_report(time_period, category, report_type, result_queue, username):
-    """Standalone function for report processing"""
-    logger = setup_logging(username)
+
+# Ledgers smaller than this on disk (bytes) are reported in-process;
+# larger ones are sent to the shared report worker pool
+REPORT_INPROCESS_BYTES = int(os.getenv(
+    "EXPENSE_REPORT_INPROCESS_BYTES", 4 * 1024 * 1024))
+REPORT_POOL_WORKERS = int(os.getenv(
+    "EXPENSE_REPORT_WORKERS", min(4, os.cpu_count() or 1)))
+# Rows per chunk when one ledger is aggregated across the pool
+REPORT_CHUNK_ROWS = int(os.getenv("EXPENSE_REPORT_CHUNK_ROWS", 100_000))
+# Storage modes in which a worker reads only its own chunk (month partitions,
+# indexed day ranges); a JSON ledger would be parsed whole by every worker
+CHUNKED_MODES = ("partitioned", "sqlite")
+# Seconds to wait for a report from the pool
+REPORT_TIMEOUT = 60
+# Seconds a single user's report may take in a batch run
+BATCH_JOB_TIMEOUT = int(os.getenv("EXPENSE_BATCH_JOB_TIMEOUT", 120))
+
+_report_pool = None
+_report_pool_workers = None
+_report_pool_lock = Lock()
+
+
+def get_report_pool(workers=None):
+    """The report worker pool, created on first use and reused afterwards.
+
+    Asking for a different number of workers replaces the pool."""
+    global _report_pool, _report_pool_workers
+    workers = workers or REPORT_POOL_WORKERS
+    with _report_pool_lock:
+        if _report_pool is not None and _report_pool_workers != workers:
+            _report_pool.shutdown(cancel_futures=True)
+            _report_pool = None
+        if _report_pool is None:
+            _report_pool = ProcessPoolExecutor(max_workers=workers)
+            _report_pool_workers = workers
+        return _report_pool
+
+
+def shutdown_report_pool():
+    global _report_pool, _report_pool_workers
+    with _report_pool_lock:
+        if _report_pool is not None:
+            _report_pool.shutdown(cancel_futures=True)
+            _report_pool = None
+            _report_pool_workers = None
+
+
+atexit.register(shutdown_report_pool)
+
+
+# Threads shared by every BackgroundTasks file operation
+IO_POOL_WORKERS = int(os.getenv("EXPENSE_IO_WORKERS", 4))
+# Seconds background_fileIO() waits for an operation
+IO_TIMEOUT = 5
+
+_io_pool = None
+_io_pool_lock = Lock()
+
+
+def get_io_pool():
+    """The file I/O thread pool, started on first use"""
+    global _io_pool
+    with _io_pool_lock:
+        if _io_pool is None:
+            _io_pool = ThreadPoolExecutor(max_workers=IO_POOL_WORKERS,
+                                          thread_name_prefix="file-io")
+        return _io_pool
+
+
+def shutdown_io_pool():
+    """Finish queued file operations and stop the I/O threads"""
+    global _io_pool
+    with _io_pool_lock:
+        pool, _io_pool = _io_pool, None
+    if pool is not None:
+        pool.shutdown(wait=True)
+
+
+atexit.register(shutdown_io_pool)
+
+
+def _reset_after_fork():
+    # A forked report worker inherits the pool object but none of its threads,
+    # and must not write the parent's pending files a second time
+    global _io_pool, _io_pool_lock, write_behind
+    _io_pool, _io_pool_lock = None, Lock()
+    write_behind = WriteBehind()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+# Opt-in write-behind: rewrites of the same JSON file are held briefly and
+# only the latest version is written
+WRITE_BEHIND = os.getenv("EXPENSE_WRITE_BEHIND", "0") == "1"
+# Seconds a pending write waits before it is flushed
+WRITE_BEHIND_DELAY = float(os.getenv("EXPENSE_WRITE_BEHIND_DELAY", 0.05))
+# Pending writes that force a flush without waiting for the delay
+WRITE_BEHIND_MAX_PENDING = int(os.getenv("EXPENSE_WRITE_BEHIND_MAX_PENDING", 100))
+
+
+def write_text(file_path, text, mode="w"):
+    """Write text and fsync it under the directory's exclusive lock; True
+    once it is on disk. Rewrites go to a temporary file that then replaces
+    file_path, so readers see the old or the new contents, never a mix."""
+    file_path = Path(file_path)
+    file_path.parent.mkdir(parents=True, exist_ok=True)
+    with locked(file_path):
+        if mode != "w":
+            with open(file_path, mode) as file:
+                file.write(text)
+                file.flush()
+                os.fsync(file.fileno())
+            return True
+        temp_path = file_path.with_name(f".{file_path.name}.tmp")
+        try:
+            with open(temp_path, "w") as file:
+                file.write(text)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temp_path, file_path)
+        finally:
+            if temp_path.exists():
+                temp_path.unlink()
+        sync_directory(file_path.parent)
+    return True
+
+
+def sync_directory(directory):
+    """fsync a directory so a rename in it survives a crash (POSIX only)"""
+    if not hasattr(os, "O_DIRECTORY"):
+        return
+    fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
     try:
-        from report import Report
-        report_obj = Report(time_period, category, username)
-        if report_type == "brief":
-            result = report_obj.brief_generate_report()
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class WriteBehind:
+    """Coalesces rewrites of the same file.
+
+    write() keeps only the latest text per path and returns a Future that
+    resolves to True once a version at least that new is on disk (False if
+    the write failed). Pending writes are flushed WRITE_BEHIND_DELAY seconds
+    after the first one, when WRITE_BEHIND_MAX_PENDING are waiting, on
+    flush() and at exit. pending_text() lets readers see them meanwhile."""
+
+    def __init__(self, delay=WRITE_BEHIND_DELAY, max_pending=WRITE_BEHIND_MAX_PENDING):
+        self.delay = delay
+        self.max_pending = max_pending
+        # path -> [text, futures waiting for it, generation]
+        self._pending = {}
+        # Taken off _pending by a flush that hasn't finished writing them
+        self._flushing = {}
+        # path -> number of writes, so each pending version has its own token
+        self._generations = {}
+        # path -> ((mtime_ns, size) the last flush left, token it stands for)
+        self._aliases = {}
+        self._waiting = 0
+        self._timer = None
+        self._lock = Lock()
+        self._flush_lock = Lock()
+        self.writes = 0
+        self.flushed = 0
+
+    def write(self, file_path, text):
+        future = Future()
+        key = os.path.abspath(file_path)
+        flush_now = False
+        with self._lock:
+            generation = self._generations[key] = self._generations.get(key, 0) + 1
+            entry = self._pending.setdefault(key, [text, [], generation])
+            entry[0], entry[2] = text, generation
+            entry[1].append(future)
+            self.writes += 1
+            self._waiting += 1
+            if self._waiting >= self.max_pending:
+                flush_now = True
+            elif self._timer is None:
+                self._timer = Timer(self.delay, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+        if flush_now:
+            get_io_pool().submit(self.flush)
+        return future
+
+    def token(self, file_path, stat_token):
+        """What a file token should report for file_path, given its (mtime_ns, size).
+
+        While a write is pending the file's stat is stale, so the token is
+        made from the write count instead. After the flush that token stays
+        valid for as long as the file keeps the stat the flush left, so caches
+        keyed on it survive the flush but still see changes made elsewhere."""
+        if not self._generations:
+            return stat_token
+        key = os.path.abspath(file_path)
+        with self._lock:
+            entry = self._pending.get(key) or self._flushing.get(key)
+            if entry:
+                return ("write-behind", entry[2])
+            alias = self._aliases.get(key)
+            if alias and alias[0] == stat_token:
+                return alias[1]
+        return stat_token
+
+    def discard(self, file_path):
+        """Drop a pending write of a file that is being deleted; its waiters get False"""
+        with self._lock:
+            entry = self._pending.pop(os.path.abspath(file_path), None)
+            if entry:
+                self._waiting -= len(entry[1])
+        for future in entry[1] if entry else []:
+            future.set_result(False)
+
+    def pending_text(self, file_path):
+        """The newest text written for file_path but not yet on disk, or None"""
+        if not self._pending and not self._flushing:
+            return None
+        key = os.path.abspath(file_path)
+        with self._lock:
+            entry = self._pending.get(key) or self._flushing.get(key)
+            return entry[0] if entry else None
+
+    def flush(self, file_path=None, directory=None):
+        """Write pending files (all, just file_path, or those under directory)
+        now; True if every write succeeded"""
+        if directory is not None and not self._pending and not self._flushing:
+            return True
+        with self._flush_lock:
+            with self._lock:
+                if file_path is None and directory is None:
+                    batch, self._pending = self._pending, {}
+                    if self._timer is not None:
+                        self._timer.cancel()
+                        self._timer = None
+                else:
+                    if file_path is not None:
+                        keys = [os.path.abspath(file_path)]
+                    else:
+                        prefix = os.path.join(os.path.abspath(directory), "")
+                        keys = [key for key in self._pending if key.startswith(prefix)]
+                    batch = {key: self._pending.pop(key) for key in keys if key in self._pending}
+                self._waiting -= sum(len(entry[1]) for entry in batch.values())
+                self._flushing.update(batch)
+            succeeded = True
+            for key, (text, futures, generation) in batch.items():
+                try:
+                    result = write_text(key, text)
+                    stat = os.stat(key)
+                except Exception as e:
+                    logging.getLogger('shared').exception(f"Error saving data to {key}: {e}")
+                    result = False
+                with self._lock:
+                    self._flushing.pop(key, None)
+                    if result:
+                        self._aliases[key] = ((stat.st_mtime_ns, stat.st_size),
+                                              ("write-behind", generation))
+                    self.flushed += 1
+                for future in futures:
+                    future.set_result(result)
+                succeeded = succeeded and result
+            return succeeded
+
+
+write_behind = WriteBehind()
+
+
+def flush_writes(file_path=None):
+    """Write out pending write-behind files now; True if all writes succeeded"""
+    return write_behind.flush(file_path)
+
+
+atexit.register(flush_writes)
+
+
+def process_reports(time_period, category, username, start=None, end=None):
+    """Pool worker: brief and detailed reports from a single ledger scan.
+
+    Workers live across requests, so their ledger cache stays warm."""
+    from report import Report
+    report_obj = Report(time_period, category, username, start, end)
+    return report_obj.generate_reports()
+
+
+def analyze_chunk(file_path, first_day, last_day, category=None, top_n=5, mode=None):
+    """Pool worker (map step): ExpenseStats of the rows dated [first_day, last_day]"""
+    from ledger import open_ledger, day_bounds
+    from analytics import ExpenseStats
+    stats = open_ledger(file_path, mode).analyze(*day_bounds(first_day, last_day), category, top_n)
+    return stats if stats is not None else ExpenseStats(top_n)
+
+
+def parallel_analyze(file_path, start_date, end_date, category=None, top_n=5,
+                     chunk_rows=None, workers=None, mode=None):
+    """ExpenseStats of one ledger, aggregated chunk by chunk across the report pool.
+
+    The window is split into day spans of about chunk_rows rows; each worker
+    returns partial stats (totals, category/day maps, top-N heap, sketch)
+    and they are merged here (reduce step). Snapshot and journal ledgers are
+    analyzed here in one pass: every worker would have to parse the whole
+    expenses.json to get at its span."""
+    from ledger import open_ledger
+    from analytics import ExpenseStats
+    ledger = open_ledger(file_path, mode)
+    if ledger.mode not in CHUNKED_MODES:
+        return ledger.analyze(start_date, end_date, category, top_n)
+    spans = ledger.chunks(start_date, end_date, chunk_rows or REPORT_CHUNK_ROWS)
+    if len(spans) < 2:
+        # A single chunk is cheaper to scan here than to ship to a worker
+        return ledger.analyze(start_date, end_date, category, top_n)
+    # Workers read the files, so pending write-behind data must be on disk
+    flush_writes()
+    pool = get_report_pool(workers)
+    futures = [pool.submit(analyze_chunk, str(file_path), first_day, last_day,
+                           category, top_n, mode)
+               for first_day, last_day in spans]
+    stats = ExpenseStats(top_n)
+    for future in futures:
+        stats.merge(future.result(timeout=REPORT_TIMEOUT))
+    return stats
+
+
+def batch_report_job(username, time_period, category=None):
+    """Pool worker: stream one user's detailed report to disk; returns (status, seconds).
+
+    "skipped" means the user has no expenses data; errors are raised, so the
+    batch records them as failed and a resumed run retries them."""
+    from report import Report
+    started = time.perf_counter()
+    report = Report(time_period, category, username).stream_detailed_report(strict=True)
+    return ("ok" if report else "skipped"), time.perf_counter() - started
+
+
+def read_batch_state(state_path):
+    """{username: record} of the users a batch run already finished"""
+    done = {}
+    if state_path.exists():
+        with open(state_path, "r") as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # A line torn by an interrupted run
+                if record.get("status") in ("ok", "skipped"):
+                    done[record["username"]] = record
+    return done
+
+
+def _kill_pool(pool):
+    """Stop a pool whose workers may be stuck; shutdown() alone would wait for them"""
+    for process in list((pool._processes or {}).values()):
+        process.terminate()
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def run_batch_reports(usernames, time_period, category=None, workers=None,
+                      timeout=BATCH_JOB_TIMEOUT, state_path=None, job=batch_report_job):
+    """Report every user on a bounded process pool.
+
+    At most `workers` reports run at once. One that takes longer than
+    `timeout` seconds is failed and its worker killed; the other running
+    reports are requeued on a fresh pool. Each finished user is appended to
+    state_path, and users already recorded there as done are skipped, so an
+    interrupted run resumes where it stopped."""
+    workers = workers or REPORT_POOL_WORKERS
+    records = read_batch_state(state_path) if state_path else {}
+    resumed = [username for username in usernames if username in records]
+    pending = deque(username for username in usernames if username not in records)
+    results = []
+    state = BackgroundTasks(state_path, "a") if state_path else None
+
+    def record(username, status, seconds, error=None):
+        result = {"username": username, "status": status, "seconds": round(seconds, 4)}
+        if error:
+            result["error"] = error
+        results.append(result)
+        if state:
+            state.background_fileIO([result])
+
+    flush_writes()
+    started = time.perf_counter()
+    pool = ProcessPoolExecutor(max_workers=workers)
+    running = {}  # future -> (username, submitted, deadline)
+    try:
+        while pending or running:
+            while pending and len(running) < workers:
+                username = pending.popleft()
+                submitted = time.monotonic()
+                running[pool.submit(job, username, time_period, category)] = (
+                    username, submitted, submitted + timeout)
+
+            next_deadline = min(deadline for _, _, deadline in running.values())
+            done, _ = wait(running, timeout=max(0, next_deadline - time.monotonic()),
+                           return_when=FIRST_COMPLETED)
+            broken = False
+            for future in done:
+                username, submitted, _ = running.pop(future)
+                try:
+                    status, seconds = future.result()
+                    record(username, status, seconds)
+                except BrokenProcessPool as e:
+                    broken = True
+                    record(username, "failed", time.monotonic() - submitted,
+                           f"worker died: {e}")
+                except Exception as e:
+                    record(username, "failed", time.monotonic() - submitted, str(e))
+
+            now = time.monotonic()
+            expired = [future for future, (_, _, deadline) in running.items()
+                       if deadline <= now]
+            for future in expired:
+                username, submitted, _ = running.pop(future)
+                record(username, "timeout", now - submitted,
+                       f"no result after {timeout}s")
+            if expired or broken:
+                # The stuck or dead worker can't be reclaimed; requeue the
+                # reports still running on the old pool
+                pending.extendleft(reversed([username for username, _, _ in running.values()]))
+                running = {}
+                _kill_pool(pool)
+                pool = ProcessPoolExecutor(max_workers=workers)
+    finally:
+        # Interrupted with reports in flight: don't wait for them
+        if running:
+            _kill_pool(pool)
         else:
-            result = report_obj.detailed_generate_report(
-                no_save=True)  # Pass no_save=True
-        result_queue.put((report_type, result))
-    except Exception as e:
-        logger.exception(f"Error generating {report_type} report: {e}")
-        result_queue.put((report_type, None))
+            pool.shutdown()
+    elapsed = time.perf_counter() - started
+
+    failures = [result for result in results if result["status"] in ("failed", "timeout")]
+    reported = [result for result in results if result["status"] != "skipped"]
+    return {
+        "users": len(usernames),
+        "ok": sum(1 for result in results if result["status"] == "ok"),
+        "skipped": sum(1 for result in results if result["status"] == "skipped"),
+        "failed": len(failures),
+        "resumed": len(resumed),
+        "seconds": elapsed,
+        "users_per_sec": len(results) / elapsed if elapsed else 0.0,
+        "failures": failures,
+        "slowest": sorted(reported, key=lambda result: result["seconds"], reverse=True)[:5],
+    }
 
 
 class BackgroundTasks:
-    def __init__(self, file_path=None, mode=None):
+    def __init__(self, file_path=None, mode=None, write_behind=None):
         self.file_path = file_path
         self.mode = mode
+        # None follows EXPENSE_WRITE_BEHIND
+        self.write_behind = WRITE_BEHIND if write_behind is None else write_behind
         self.data = None
-        self.event = Event()
-        self.result_queue = Queue()
 
     def save_to_file(self, data):
+        """Returns True once data is written and synced, False if the write failed"""
         try:
-            # Ensure the parent directory exists
-            self.file_path.parent.mkdir(parents=True, exist_ok=True)
-            with open(self.file_path, self.mode) as file:
-                json.dump(data, file, indent=4)
-            # Logger not available here; logging done in calling context
+            return write_text(self.file_path, json.dumps(data, indent=4), self.mode)
         except Exception as e:
             # Use shared logger for errors in this context
             temp_logger = logging.getLogger('shared')
             temp_logger.exception(
                 f"Error saving data to {self.file_path}: {e}")
-        finally:
-            self.event.set()
+            return False
+
+    def append_to_file(self, records):
+        try:
+            # A pending rewrite of the file has to land before the new lines
+            write_behind.flush(self.file_path)
+            # One compact JSON document per line (JSONL)
+            lines = "".join(json.dumps(record) + "\n" for record in records)
+            return write_text(self.file_path, lines, self.mode)
+        except Exception as e:
+            temp_logger = logging.getLogger('shared')
+            temp_logger.exception(
+                f"Error appending data to {self.file_path}: {e}")
+            return False
 
     def read_from_file(self):
         try:
-            with open(self.file_path, self.mode) as file:
-                self.data = json.load(file)
+            # Pending write-behind data is newer than the file
+            text = write_behind.pending_text(self.file_path)
+            if text is not None:
+                self.data = json.loads(text)
+            else:
+                with locked(self.file_path, shared=True), \
+                        open(self.file_path, self.mode) as file:
+                    self.data = json.load(file)
             # Logger not available here; logging done in calling context
         except Exception as e:
             # Use shared logger for errors in this context
@@ -102,70 +508,96 @@ class BackgroundTasks:
             temp_logger.exception(
                 f"Error reading data from {self.file_path}: {e}")
             self.data = None
-        finally:
-            self.event.set()
+        return self.data
+
+    def _defers_write(self):
+        # New files and appends are always written straight away, so other
+        # code can rely on exists() and on the order of appended lines
+        return self.write_behind and self.mode == "w" and Path(self.file_path).exists()
+
+    def submit_write(self, data, defer=None):
+        """Write (mode "w") or append records (mode "a"). The Future resolves
+        to True when the data is on disk and to False if the write failed.
+
+        With write-behind, rewrites of an existing file are queued and
+        coalesced; the Future resolves when a version at least this new is
+        flushed."""
+        if defer is None:
+            defer = self._defers_write()
+        if defer:
+            return write_behind.write(self.file_path, json.dumps(data, indent=4))
+        if self.mode == "w" and write_behind.pending_text(self.file_path) is not None:
+            # Replace the pending version and write it now, so the older one
+            # can't be flushed over this write later
+            future = write_behind.write(self.file_path, json.dumps(data, indent=4))
+            get_io_pool().submit(write_behind.flush, self.file_path)
+            return future
+        target = self.append_to_file if self.mode == "a" else self.save_to_file
+        return get_io_pool().submit(target, data)
+
+    def submit_read(self):
+        """Read the JSON file on the shared I/O pool; the Future resolves to
+        the data or None"""
+        return get_io_pool().submit(self.read_from_file)
+
+    def flush(self):
+        """Flush a pending write-behind write of this file; True once it is on disk"""
+        return write_behind.flush(self.file_path)
+
+    def _wait(self, future, default):
+        try:
+            return future.result(timeout=IO_TIMEOUT)
+        except FutureTimeout:
+            logging.getLogger('shared').error(
+                f"File operation on {self.file_path} did not finish in {IO_TIMEOUT}s")
+            return default
 
     def background_fileIO(self, data=None):
-        self.event.clear()
-        if self.mode == "w":
-            t = Thread(target=self.save_to_file, args=(data,))
-            t.daemon = True
-            t.start()
-            self.event.wait(timeout=5)
-            return True
+        """Writes return True once the data is on disk and False if the write
+        failed or timed out; with write-behind they return the (truthy)
+        Future of submit_write() for callers that need to await it. Reads
+        return the data or None."""
+        if self.mode in ("w", "a"):
+            defer = self._defers_write()
+            future = self.submit_write(data, defer)
+            return future if defer else self._wait(future, False)
         elif self.mode == "r":
-            t = Thread(target=self.read_from_file)
-            t.daemon = True
-            t.start()
-            self.event.wait(timeout=5)
-            return self.data
+            return self._wait(self.submit_read(), None)
         else:
             # Use shared logger for errors in this context
             temp_logger = logging.getLogger('shared')
             temp_logger.error(
-                "Invalid mode. Use 'r' for read or 'w' for write.")
+                "Invalid mode. Use 'r' for read, 'w' for write or 'a' for append.")
             return None
 
     def generate_reports(self, report_obj):
-        logger = setup_logging(report_obj.username)
+        logger = get_logger(__name__, report_obj.username)
         try:
-            # Create processes for both report types
-            brief_process = Process(
-                target=process_report,
-                args=(report_obj.time_period, report_obj.category,
-                      "brief", self.result_queue, report_obj.username)
-            )
-            detailed_process = Process(
-                target=process_report,
-                args=(report_obj.time_period, report_obj.category,
-                      "detailed", self.result_queue, report_obj.username)
-            )
-
-            # Start processes
-            brief_process.start()
-            detailed_process.start()
-
-            # Wait for processes to complete (with timeout)
-            brief_process.join(timeout=10)
-            detailed_process.join(timeout=10)
-
-            # Collect results
-            results = {}
-            while not self.result_queue.empty():
-                report_type, report_data = self.result_queue.get()
-                results[report_type] = report_data
+            from ledger import open_ledger
+            ledger_size = open_ledger(report_obj.expenses_file_path).disk_size()
+            if ledger_size < REPORT_INPROCESS_BYTES:
+                # A small scan is cheaper than handing the work to a worker
+                results = report_obj.generate_reports()
+            else:
+                # A cached result needs no worker
+                results = report_obj.generate_reports(cached_only=True)
+                if results is None:
+                    flush_writes()
+                    future = get_report_pool().submit(
+                        process_reports, report_obj.time_period, report_obj.category,
+                        report_obj.username, report_obj.start, report_obj.end)
+                    results = future.result(timeout=REPORT_TIMEOUT)
 
             # Save detailed report in the main process
             if results.get("detailed"):
-                user_dir = BASE_DIR / "users" / report_obj.username
-                user_dir.mkdir(parents=True, exist_ok=True)
-                report_handler = BackgroundTasks(
-                    user_dir /
-                    f"detailed_report_{report_obj.time_period}.json", "w"
-                )
-                report_handler.background_fileIO(results["detailed"])
+                report_obj.save_detailed_report(results["detailed"])
 
             return results
+        except BrokenProcessPool as e:
+            # A worker died; start a fresh pool on the next request
+            shutdown_report_pool()
+            logger.exception(f"Error in report generation: {e}")
+            return None
         except Exception as e:
             logger.exception(f"Error in report generation: {e}")
             return None
@@ -0,0 +1,199 @@
+import argparse
+import csv
+import json
+from datetime import date
+from pathlib import Path
+from ledger import migrate_to_partitions, migrate_to_sqlite, open_ledger, verify_rollups
+from transaction import Expense
+from Multithreading_Multiprocessing import BATCH_JOB_TIMEOUT, run_batch_reports
+
+BASE_DIR = Path(__file__).resolve().parent
+
+
+def user_dirs(usernames=None):
+    users_dir = BASE_DIR / "users"
+    if usernames:
+        return [users_dir / username for username in usernames]
+    if not users_dir.exists():
+        return []
+    return sorted(path for path in users_dir.iterdir() if path.is_dir())
+
+
+def migrate_sqlite(args):
+    for user_dir in user_dirs(args.users):
+        expenses_file_path = user_dir / "expenses.json"
+        if not expenses_file_path.exists():
+            print(f"{user_dir.name}: no expenses.json, skipped")
+            continue
+        try:
+            count = migrate_to_sqlite(expenses_file_path)
+            print(f"{user_dir.name}: imported {count} expenses into expenses.db")
+        except Exception as e:
+            print(f"{user_dir.name}: migration failed: {e}")
+
+
+def migrate_partitions(args):
+    for user_dir in user_dirs(args.users):
+        expenses_file_path = user_dir / "expenses.json"
+        if not expenses_file_path.exists():
+            print(f"{user_dir.name}: no expenses.json, skipped")
+            continue
+        try:
+            count = migrate_to_partitions(expenses_file_path)
+            print(f"{user_dir.name}: split {count} expenses into ledger/ month partitions")
+        except Exception as e:
+            print(f"{user_dir.name}: migration failed: {e}")
+
+
+def rebuild_aggregates(args):
+    for user_dir in user_dirs(args.users):
+        result = Expense.rebuild_aggregates(user_dir.name)
+        if result["budget_info"] is None:
+            print(f"{user_dir.name}: no budget info, skipped")
+        elif result["matches"]:
+            print(f"{user_dir.name}: running totals OK ({result['rebuilt']['count']} expenses)")
+        else:
+            print(f"{user_dir.name}: running totals rebuilt")
+            print(f"  stored:  {result['stored']}")
+            print(f"  rebuilt: {result['rebuilt']}")
+
+
+def verify(args):
+    for user_dir in user_dirs(args.users):
+        expenses_file_path = user_dir / "expenses.json"
+        if not open_ledger(expenses_file_path).exists():
+            print(f"{user_dir.name}: no expenses, skipped")
+            continue
+        try:
+            differences = verify_rollups(
+                expenses_file_path, fix=not args.no_fix)
+        except Exception as e:
+            print(f"{user_dir.name}: verification failed: {e}")
+            continue
+        if differences is None:
+            print(f"{user_dir.name}: no saved rollups"
+                  + ("" if args.no_fix else ", built them"))
+        elif not differences:
+            print(f"{user_dir.name}: rollups OK")
+        else:
+            print(f"{user_dir.name}: {len(differences)} rollup cells differ"
+                  + ("" if args.no_fix else " (rebuilt)"))
+            for day, category, saved, rebuilt in differences[:20]:
+                print(f"  {day} {category}: saved {saved}, rebuilt {rebuilt}")
+
+
+def batch_state_path(time_period, category):
+    """Progress file of today's batch run, so a rerun the same day resumes it"""
+    return BASE_DIR / "batch_reports" / \
+        f"{time_period}-{category or 'all'}-{date.today().isoformat()}.jsonl"
+
+
+def batch_reports(args):
+    usernames = [user_dir.name for user_dir in user_dirs(args.users)
+                 if (user_dir / "setup.json").exists()]
+    state_path = Path(args.state) if args.state else batch_state_path(
+        args.period, args.category)
+    if args.restart and state_path.exists():
+        state_path.unlink()
+    summary = run_batch_reports(usernames, args.period, args.category, workers=args.workers,
+                                timeout=args.timeout, state_path=state_path)
+    if summary["resumed"]:
+        print(f"Resumed: {summary['resumed']} users already done in {state_path}")
+    print(f"{summary['ok']} reports written, {summary['skipped']} users without data, "
+          f"{summary['failed']} failed in {summary['seconds']:.2f}s "
+          f"({summary['users_per_sec']:.1f} users/sec)")
+    for result in summary["failures"]:
+        print(f"  FAILED {result['username']} ({result['status']}): {result['error']}")
+    if summary["slowest"]:
+        print("Slowest users:")
+        for result in summary["slowest"]:
+            print(f"  {result['username']}: {result['seconds']:.2f}s")
+
+
+def read_rows(file_path, file_format=None):
+    """Stream rows from a CSV (with a header) or JSONL file"""
+    file_format = file_format or (
+        "jsonl" if Path(file_path).suffix.lower() in (".jsonl", ".json") else "csv")
+    with open(file_path, "r", newline="", encoding="utf-8") as file:
+        if file_format == "csv":
+            yield from csv.DictReader(file)
+        else:
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def import_expenses(args):
+    summary = Expense.add_expenses_bulk(
+        args.user, read_rows(args.file, args.format), chunk_size=args.chunk_size)
+    print(f"Imported {summary['added']} expenses, skipped {summary['skipped']} "
+          f"({summary['duplicates']} duplicate names) in {summary['seconds']:.2f}s ({summary['rows_per_sec']:.0f} rows/sec)")
+    if "error" in summary:
+        print(f"Import stopped early: {summary['error']}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Maintenance commands for the expense tracker")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    migrate = commands.add_parser(
+        "migrate-sqlite", help="Import users' expenses.json into expenses.db")
+    migrate.add_argument("users", nargs="*",
+                         help="Usernames to migrate (default: all)")
+    migrate.set_defaults(func=migrate_sqlite)
+
+    partitions = commands.add_parser(
+        "migrate-partitions", help="Split users' expenses.json into monthly ledger/ partitions")
+    partitions.add_argument("users", nargs="*",
+                            help="Usernames to migrate (default: all)")
+    partitions.set_defaults(func=migrate_partitions)
+
+    import_cmd = commands.add_parser(
+        "import-expenses", help="Bulk import expenses from a CSV or JSONL file")
+    import_cmd.add_argument("user", help="Username to import into")
+    import_cmd.add_argument(
+        "file", help="CSV with name,amount,category,date,description columns or JSONL")
+    import_cmd.add_argument("--format", choices=["csv", "jsonl"],
+                            help="File format (default: from the extension)")
+    import_cmd.add_argument("--chunk-size", type=int, default=5000,
+                            help="Rows applied per ledger write")
+    import_cmd.set_defaults(func=import_expenses)
+
+    rebuild = commands.add_parser(
+        "rebuild-aggregates", help="Recompute and verify budget_info running totals")
+    rebuild.add_argument("users", nargs="*",
+                         help="Usernames to check (default: all)")
+    rebuild.set_defaults(func=rebuild_aggregates)
+
+    verify_cmd = commands.add_parser(
+        "verify-rollups", help="Rebuild daily/monthly rollups from the expenses and diff them")
+    verify_cmd.add_argument("users", nargs="*",
+                            help="Usernames to check (default: all)")
+    verify_cmd.add_argument("--no-fix", action="store_true",
+                            help="Only report differences, keep the saved rollups")
+    verify_cmd.set_defaults(func=verify)
+
+    batch = commands.add_parser(
+        "batch-reports", help="Write every user's detailed report on a process pool")
+    batch.add_argument("users", nargs="*",
+                       help="Usernames to report (default: all)")
+    batch.add_argument("--period", default="cm",
+                       help="Report period, as in the app (default: cm, the current month)")
+    batch.add_argument("--category", help="Only report this category")
+    batch.add_argument("--workers", type=int,
+                       help="Worker processes (default: EXPENSE_REPORT_WORKERS)")
+    batch.add_argument("--timeout", type=float, default=BATCH_JOB_TIMEOUT,
+                       help="Seconds before a user's report is failed")
+    batch.add_argument("--state", help="Progress file (default: batch_reports/<period>-"
+                                       "<category>-<date>.jsonl)")
+    batch.add_argument("--restart", action="store_true",
+                       help="Ignore progress from an earlier run")
+    batch.set_defaults(func=batch_reports)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,224 @@
+import heapq
+import math
+import random
+from bisect import bisect_left, bisect_right
+from datetime import date
+from expense_table import from_day
+
+PERCENTILES = (0.5, 0.9, 0.99)
+
+
+class KLLSketch:
+    """Mergeable quantile sketch (Karnin, Lang & Liberty).
+
+    Values are kept in levels of compactors; a full level is sorted and
+    every other value moves up a level with twice the weight, so memory
+    stays around 3k values for any number of updates and ranks are off by
+    roughly 1.7/k. Sketches built on different partitions or processes
+    merge into one over the union of their values."""
+
+    def __init__(self, k=200, seed=0):
+        self.k = k
+        self.compactors = [[]]
+        self.count = 0
+        self.min = None
+        self.max = None
+        self._random = random.Random(seed)
+        self._size = 0
+        self._max_size = self._capacity(0)
+
+    def _capacity(self, level):
+        depth = len(self.compactors) - level - 1
+        return max(2, int(math.ceil(self.k * (2 / 3) ** depth)))
+
+    def update(self, value):
+        self.compactors[0].append(value)
+        self.count += 1
+        self._size += 1
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        if self._size >= self._max_size:
+            self._compress()
+
+    def _compress(self):
+        for level in range(len(self.compactors)):
+            items = self.compactors[level]
+            if len(items) < self._capacity(level):
+                continue
+            if level + 1 == len(self.compactors):
+                self.compactors.append([])
+            items.sort()
+            # An odd value out stays behind so the total weight is unchanged
+            leftover = [items.pop()] if len(items) % 2 else []
+            promoted = items[self._random.random() < 0.5::2]
+            self.compactors[level + 1].extend(promoted)
+            self.compactors[level] = leftover
+            self._size -= len(items) - len(promoted)
+            self._max_size = sum(self._capacity(level)
+                                 for level in range(len(self.compactors)))
+            if self._size < self._max_size:
+                break
+
+    def merge(self, other):
+        while len(self.compactors) < len(other.compactors):
+            self.compactors.append([])
+        for level, items in enumerate(other.compactors):
+            self.compactors[level].extend(items)
+        self.count += other.count
+        for value in (other.min, other.max):
+            if value is not None:
+                self.min = value if self.min is None else min(self.min, value)
+                self.max = value if self.max is None else max(self.max, value)
+        self._size = sum(len(items) for items in self.compactors)
+        self._max_size = sum(self._capacity(level)
+                             for level in range(len(self.compactors)))
+        while self._size >= self._max_size:
+            self._compress()
+        return self
+
+    def quantiles(self, fractions):
+        """Approximate values at each fraction (0..1) of the sorted input"""
+        if not self.count:
+            return [None for _ in fractions]
+        weighted = sorted((value, 1 << level)
+                          for level, items in enumerate(self.compactors) for value in items)
+        total = sum(weight for _, weight in weighted)
+        results = []
+        for fraction in fractions:
+            if fraction <= 0:
+                results.append(self.min)
+                continue
+            if fraction >= 1:
+                results.append(self.max)
+                continue
+            target = fraction * total
+            cumulative = 0
+            for value, weight in weighted:
+                cumulative += weight
+                if cumulative >= target:
+                    results.append(value)
+                    break
+        return results
+
+    def quantile(self, fraction):
+        return self.quantiles([fraction])[0]
+
+    def to_dict(self):
+        return {"k": self.k, "count": self.count, "min": self.min, "max": self.max,
+                "compactors": self.compactors}
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls(data["k"])
+        sketch.compactors = [list(items) for items in data["compactors"]] or [[]]
+        sketch.count, sketch.min, sketch.max = data["count"], data["min"], data["max"]
+        sketch._size = sum(len(items) for items in sketch.compactors)
+        sketch._max_size = sum(sketch._capacity(level)
+                               for level in range(len(sketch.compactors)))
+        return sketch
+
+
+class ExpenseStats:
+    """Totals, per-category/day/week breakdowns, the top-N expenses and
+    amount percentiles, accumulated in one pass over the expenses.
+
+    Memory depends on the number of categories and days with expenses, top_n
+    and the sketch size, not on the number of expenses. Stats built for
+    different partitions, chunks or worker processes merge."""
+
+    def __init__(self, top_n=5, sketch_k=200):
+        self.top_n = top_n
+        self.count = 0
+        self.total = 0
+        self.by_category = {}
+        # day ordinal -> total; weeks are derived from it
+        self.by_day = {}
+        # min-heap of (amount, name) holding the top_n largest expenses
+        self.top = []
+        self.sketch = KLLSketch(sketch_k)
+
+    def add(self, name, amount, category, day):
+        self.count += 1
+        self.total += amount
+        self.by_category[category] = self.by_category.get(category, 0) + amount
+        self.by_day[day] = self.by_day.get(day, 0) + amount
+        self.sketch.update(amount)
+        if len(self.top) < self.top_n:
+            heapq.heappush(self.top, (amount, name))
+        elif self.top_n and amount > self.top[0][0]:
+            heapq.heapreplace(self.top, (amount, name))
+
+    def add_table(self, table, first_day, last_day, category=None):
+        """Stream the ExpenseTable rows dated within [first_day, last_day]"""
+        code = None
+        if category is not None:
+            code = table.category_code(category)
+            if code is None:
+                return self
+        codes, amounts, days = table.category_codes, table.amounts, table.days
+        categories, top = table.categories, self.top
+        for index in range(bisect_left(days, first_day), bisect_right(days, last_day)):
+            row_code = codes[index]
+            if code is not None and row_code != code:
+                continue
+            amount, day = amounts[index], days[index]
+            self.count += 1
+            self.total += amount
+            row_category = categories[row_code]
+            self.by_category[row_category] = self.by_category.get(
+                row_category, 0) + amount
+            self.by_day[day] = self.by_day.get(day, 0) + amount
+            self.sketch.update(amount)
+            # Names are only decoded for rows that make the top-N
+            if len(top) < self.top_n:
+                heapq.heappush(top, (amount, table.names[index]))
+            elif self.top_n and amount > top[0][0]:
+                heapq.heapreplace(top, (amount, table.names[index]))
+        return self
+
+    def add_indices(self, table, indices):
+        """Add ExpenseTable rows already selected (e.g. by select())"""
+        codes, amounts, days = table.category_codes, table.amounts, table.days
+        categories, names = table.categories, table.names
+        for index in indices:
+            self.add(names[index], amounts[index], categories[codes[index]], days[index])
+        return self
+
+    def merge(self, other):
+        self.count += other.count
+        self.total += other.total
+        for category, amount in other.by_category.items():
+            self.by_category[category] = self.by_category.get(category, 0) + amount
+        for day, amount in other.by_day.items():
+            self.by_day[day] = self.by_day.get(day, 0) + amount
+        for item in other.top:
+            if len(self.top) < self.top_n:
+                heapq.heappush(self.top, item)
+            elif item > self.top[0]:
+                heapq.heapreplace(self.top, item)
+        self.sketch.merge(other.sketch)
+        return self
+
+    def by_week(self):
+        """{'YYYY-Www': total} by ISO week"""
+        weeks = {}
+        for day, amount in sorted(self.by_day.items()):
+            year, week, _ = date.fromordinal(day).isocalendar()
+            key = f"{year}-W{week:02d}"
+            weeks[key] = weeks.get(key, 0) + amount
+        return weeks
+
+    def to_dict(self, percentiles=PERCENTILES):
+        return {
+            "count": self.count,
+            "total_expense": self.total,
+            "by_category": dict(self.by_category),
+            "by_day": {from_day(day): amount for day, amount in sorted(self.by_day.items())},
+            "by_week": self.by_week(),
+            "top_expenses": [{"name": name, "amount": amount}
+                             for amount, name in sorted(self.top, reverse=True)],
+            "percentiles": {f"p{round(fraction * 100)}": value for fraction, value in
+                            zip(percentiles, self.sketch.quantiles(percentiles))}
+        }
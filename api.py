@@ -1,79 +1,323 @@
 import requests
 import logging
-from logging.handlers import RotatingFileHandler
+import random
+import time
+from concurrent.futures import Future
+from decimal import Decimal, localcontext
+from threading import Lock
+from requests.adapters import HTTPAdapter
+from app_logging import get_logger
+from Multithreading_Multiprocessing import BackgroundTasks
 from dotenv import load_dotenv
 import os
 from pathlib import Path
 
-# Shared logger for system-wide errors (configured once)
-shared_logger = None
-
-
-def setup_logging(username):
-    global shared_logger
-    logger = logging.getLogger(__name__)
-    logger.setLevel(logging.DEBUG)
-    user_dir = BASE_DIR / "users" / username
-    user_dir.mkdir(parents=True, exist_ok=True)
-
-    # User-specific log with rotation
-    file_handler = RotatingFileHandler(
-        user_dir / "tracker.log", maxBytes=5*1024*1024, backupCount=3
-    )
-    console_handler = logging.StreamHandler()
-    # API logs errors to user-specific file
-    file_handler.setLevel(logging.ERROR)
-    console_handler.setLevel(logging.INFO)
-    formatter = logging.Formatter(
-        "%(asctime)s -%(name)s - %(levelname)s - %(message)s")
-    file_handler.setFormatter(formatter)
-    console_handler.setFormatter(formatter)
-
-    # Configure shared logger for ERROR and CRITICAL (only once)
-    if shared_logger is None:
-        shared_logger = logging.getLogger('shared')
-        shared_logger.setLevel(logging.ERROR)
-        shared_file_handler = RotatingFileHandler(
-            BASE_DIR / "tracker.log", maxBytes=10*1024*1024, backupCount=5
-        )
-        shared_file_handler.setFormatter(formatter)
-        shared_logger.handlers = [shared_file_handler]
-
-    # Clear existing handlers to avoid duplicates
-    logger.handlers = []
-    logger.addHandler(file_handler)
-    logger.addHandler(console_handler)
-    # Add shared handler for ERROR/CRITICAL
-    logger.addHandler(shared_logger.handlers[0])
-    return logger
+try:
+    import numpy as np
+except ImportError:
+    # NumPy is optional; without it convert_many multiplies in a loop
+    np = None
 
 
 BASE_DIR = Path(__file__).resolve().parent
+# Provider endpoint; <API_URL>/<API_CODE>/latest/<base> is a base's rate table
+API_URL = os.getenv("EXCHANGE_RATE_API_URL", "https://v6.exchangerate-api.com/v6")
+# Rate tables kept between runs
+RATE_CACHE_PATH = Path(os.getenv("EXPENSE_RATE_CACHE", BASE_DIR / "exchange_rates.json"))
+# Seconds a table stays fresh when the provider doesn't send time_next_update_unix
+RATE_TTL = int(os.getenv("EXPENSE_RATE_TTL", 3600))
+# Currency whose table every other rate is derived from
+PIVOT_CURRENCY = os.getenv("EXPENSE_PIVOT_CURRENCY", "USD")
+# Significant digits of a derived cross rate
+RATE_DIGITS = 12
+# Seconds to wait for the provider to accept a connection and to send data
+HTTP_TIMEOUT = (float(os.getenv("EXPENSE_HTTP_CONNECT_TIMEOUT", 3.05)),
+                float(os.getenv("EXPENSE_HTTP_READ_TIMEOUT", 10)))
+# Extra attempts after a connection error, timeout or 429/5xx response
+HTTP_RETRIES = int(os.getenv("EXPENSE_HTTP_RETRIES", 2))
+# Seconds of backoff before the first retry, doubling per retry up to the cap
+RETRY_BACKOFF = 0.5
+RETRY_BACKOFF_MAX = 4
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# Connections kept open per host
+HTTP_POOL_SIZE = 10
+
+
+class RateCache:
+    """Full rate tables per base currency, in memory and in a small JSON file.
+
+    A table is fresh until the provider's next update (time_next_update_unix,
+    or ttl seconds after it was fetched). Older tables are kept to fall back
+    on when the provider can't be reached."""
+
+    def __init__(self, path=RATE_CACHE_PATH, ttl=RATE_TTL):
+        self.path = Path(path)
+        self.ttl = ttl
+        self._tables = None
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _load(self):
+        # The file is read once, on first use
+        if self._tables is None:
+            data = BackgroundTasks(self.path, "r").background_fileIO() \
+                if self.path.exists() else None
+            self._tables = data if isinstance(data, dict) else {}
+        return self._tables
+
+    def fresh(self, base):
+        """The table of base if it's still current, else None"""
+        with self._lock:
+            table = self._load().get(base)
+            if table is not None and time.time() < table["expires"]:
+                self.hits += 1
+                return table
+            self.misses += 1
+            return None
+
+    def stale(self, base):
+        """The last table fetched for base, however old, or None"""
+        with self._lock:
+            return self._load().get(base)
+
+    def put(self, base, data):
+        """Store a provider response for base; returns the cached table"""
+        now = time.time()
+        table = {
+            "rates": data["conversion_rates"],
+            "time_last_update_utc": data.get("time_last_update_utc", "N/A"),
+            "fetched": now,
+            "expires": data.get("time_next_update_unix") or now + self.ttl
+        }
+        with self._lock:
+            self._load()[base] = table
+            tables = dict(self._tables)
+        BackgroundTasks(self.path, "w").background_fileIO(tables)
+        return table
+
+
+rate_cache = RateCache()
+_session = None
+_session_lock = Lock()
+# base currency -> Future of the fetch in flight for it
+_inflight = {}
+_inflight_lock = Lock()
+
+
+def http_session():
+    """The process's requests.Session, created on first use; its pooled
+    connections are reused by every fetch instead of a new TCP+TLS
+    handshake per call"""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE,
+                                      pool_maxsize=HTTP_POOL_SIZE)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                _session = session
+    return _session
+
+
+def fetch_json(url, retries=None):
+    """GET url on the shared session and return its JSON body.
+
+    Connection errors, timeouts (HTTP_TIMEOUT) and 429/5xx responses are
+    retried up to retries (default HTTP_RETRIES) times, sleeping a random
+    part of an exponential backoff in between so callers that failed
+    together don't retry together. Raises the last error after that."""
+    retries = HTTP_RETRIES if retries is None else retries
+    attempt = 0
+    while True:
+        try:
+            response = http_session().get(url, timeout=HTTP_TIMEOUT)
+            if response.status_code not in RETRY_STATUSES or attempt >= retries:
+                response.raise_for_status()
+                return response.json()
+            response.close()
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt >= retries:
+                raise
+        time.sleep(random.uniform(0, min(RETRY_BACKOFF_MAX, RETRY_BACKOFF * 2 ** attempt)))
+        attempt += 1
+
+
+def cross_rate(rates, from_currency, to_currency):
+    """rate(from -> to) from a pivot table (pivot -> currency) as
+    rates[to] / rates[from], or None if either currency is missing.
+
+    The division is done in decimal on the provider's printed digits and
+    rounded to RATE_DIGITS significant digits, so derived rates don't pick
+    up binary noise; rates involving the pivot come back unchanged."""
+    if from_currency == to_currency:
+        return 1.0
+    from_rate, to_rate = rates.get(from_currency), rates.get(to_currency)
+    if not from_rate or to_rate is None:
+        return None
+    if from_rate == 1:
+        return to_rate
+    with localcontext() as context:
+        context.prec = RATE_DIGITS
+        return float(Decimal(repr(to_rate)) / Decimal(repr(from_rate)))
 
 
 class API:
     def __init__(self, base_currency="USD", username=None):
         self.base_currency = base_currency
-        self.logger = setup_logging(
-            username) if username else logging.getLogger('shared')
+        # API logs errors to the user's file and progress to the console
+        self.logger = get_logger(
+            __name__, username, file_level=logging.ERROR,
+            console_level=logging.INFO) if username else logging.getLogger('shared')
         load_dotenv()
         self.api_code = os.getenv("API_CODE")
-        self.base_url = f"https://v6.exchangerate-api.com/v6/{self.api_code}/latest/{self.base_currency}"
+        self.base_url = f"{API_URL}/{self.api_code}/latest/{self.base_currency}"
 
-    def get_exchange_rate(self, to_currency):
+    def get_rates(self, base=None):
+        """(rates, time last updated, result) of base (default base_currency),
+        from the cache until the provider's next update.
+
+        Concurrent callers missing the same base share one request: the
+        first fetches it and the others wait for its result. When the
+        provider can't be reached the last table fetched is used with a
+        warning and result "stale"; None if there is none."""
+        base = base or self.base_currency
+        table = rate_cache.fresh(base)
+        if table is not None:
+            return table["rates"], table["time_last_update_utc"], "success"
+        with _inflight_lock:
+            future = _inflight.get(base)
+            leader = future is None
+            if leader:
+                future = _inflight[base] = Future()
+        if not leader:
+            return future.result()
+        try:
+            future.set_result(self._fetch_rates(base))
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            with _inflight_lock:
+                del _inflight[base]
+        return future.result()
+
+    def _fetch_rates(self, base):
+        # A fetch that finished just before this one started has filled the cache
+        table = rate_cache.stale(base)
+        if table is not None and time.time() < table["expires"]:
+            return table["rates"], table["time_last_update_utc"], "success"
         try:
-            response = requests.get(self.base_url)
-            response.raise_for_status()
-            data = response.json()
-            rate = data["conversion_rates"].get(to_currency)
-            last_updated = data.get("time_last_update_utc", "N/A")
+            data = fetch_json(f"{API_URL}/{self.api_code}/latest/{base}")
             result = data.get("result", "N/A")
-            if rate is None:
-                self.logger.error(
-                    f"Exchange rate for {to_currency} not found.")
-            self.logger.info(f"Time last updated: {last_updated}")
+            if result != "success" or "conversion_rates" not in data:
+                raise ValueError(f"API result status: {result}")
+            table = rate_cache.put(base, data)
+            self.logger.info(f"Time last updated: {table['time_last_update_utc']}")
             self.logger.info(f"API result status: {result}")
-            return rate, last_updated, result
-        except requests.RequestException as e:
-            self.logger.exception(f"Error fetching exchange rate: {e}")
+            return table["rates"], table["time_last_update_utc"], result
+        except (requests.RequestException, ValueError) as e:
+            table = rate_cache.stale(base)
+            if table is None:
+                self.logger.exception(f"Error fetching exchange rate: {e}")
+                return None
+            self.logger.warning(
+                f"Exchange rates unavailable ({e}); using {base} rates "
+                f"last updated {table['time_last_update_utc']}")
+            return table["rates"], table["time_last_update_utc"], "stale"
+
+    def get_exchange_rate(self, to_currency):
+        """(rate base_currency -> to_currency, time last updated, result),
+        derived from the PIVOT_CURRENCY table so every base shares one fetch"""
+        rates = self.get_rates(PIVOT_CURRENCY)
+        if rates is None:
             return None
+        rates, last_updated, result = rates
+        rate = cross_rate(rates, self.base_currency, to_currency)
+        if rate is None:
+            self.logger.error(
+                f"Exchange rate for {to_currency} not found.")
+        return rate, last_updated, result
+
+
+class RateEngine:
+    """Converts between any currencies with one pivot table.
+
+    The PIVOT_CURRENCY table is fetched (and cached) once; every pair is
+    derived from it, and convert_many() converts whole columns of amounts
+    with one rate lookup per distinct currency."""
+
+    def __init__(self, pivot=PIVOT_CURRENCY, username=None):
+        self.api = API(base_currency=pivot, username=username)
+
+    def table(self):
+        """The pivot table (pivot -> currency), or None if unavailable"""
+        rates = self.api.get_rates()
+        return rates[0] if rates is not None else None
+
+    def rate(self, from_currency, to_currency):
+        table = self.table()
+        return cross_rate(table, from_currency, to_currency) if table is not None else None
+
+    def convert(self, amount, from_currency, to_currency, digits=2):
+        return self.convert_many([amount], from_currency, to_currency, digits)[0]
+
+    def convert_many(self, amounts, from_currencies, to_currency, digits=2):
+        """amounts converted to to_currency and rounded to digits places
+        like builtin round(), with or without NumPy.
+
+        from_currencies is one currency for all the amounts or a sequence
+        with one per amount. Raises ValueError for a currency without a
+        rate (or when no pivot table can be had)."""
+        table = self.table()
+        if table is None:
+            raise ValueError("No exchange rates available")
+        single = isinstance(from_currencies, str)
+        factors = {}
+        for currency in [from_currencies] if single else set(from_currencies):
+            factors[currency] = cross_rate(table, currency, to_currency)
+            if factors[currency] is None:
+                raise ValueError(f"No exchange rate from {currency} to {to_currency}")
+        if single:
+            factor = factors[from_currencies]
+        elif np is not None:
+            factor = np.fromiter((factors[currency] for currency in from_currencies),
+                                 float, len(from_currencies))
+        else:
+            factor = [factors[currency] for currency in from_currencies]
+        if np is not None:
+            return round_array(np.asarray(amounts, dtype=float) * factor, digits)
+        if single:
+            return [round(float(amount) * factor, digits) for amount in amounts]
+        return [round(float(amount) * rate, digits) for amount, rate in zip(amounts, factor)]
+
+
+def round_array(values, digits):
+    """round(value, digits) of every element of a float array, as a list.
+
+    np.round() multiplies by 10**digits before rounding, and that product
+    can land on the other side of a half (2.675 -> 2.68). Only elements
+    that close to a half, or too large for the product to keep its
+    fraction, are passed to round(), which works on the exact value."""
+    scale = 10.0 ** digits
+    scaled = values * scale
+    rounded = np.rint(scaled) / scale
+    fraction = scaled - np.floor(scaled)
+    exact = (np.abs(fraction - 0.5) <= 1e-9 * np.maximum(np.abs(scaled), 1.0)) \
+        | (np.abs(scaled) >= 2.0 ** 52)
+    for i in np.flatnonzero(exact):
+        rounded[i] = round(float(values[i]), digits)
+    return rounded.tolist()
+
+
+def _reset_after_fork():
+    # Pooled sockets would be shared with the parent, and a fetch in flight
+    # in a parent thread would never finish here
+    global _session, _session_lock, _inflight, _inflight_lock
+    _session, _session_lock = None, Lock()
+    _inflight, _inflight_lock = {}, Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
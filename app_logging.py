@@ -0,0 +1,370 @@
+import atexit
+import logging
+import multiprocessing.util
+import os
+import queue
+import time
+from collections import OrderedDict
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from pathlib import Path
+from threading import Event, Lock
+
+BASE_DIR = Path(__file__).resolve().parent
+# Most per-user tracker.log files held open at once; the least recently
+# used one is closed when another user logs
+LOG_MAX_OPEN_FILES = int(os.getenv("EXPENSE_LOG_MAX_OPEN_FILES", 32))
+LOG_FORMAT = "%(asctime)s -%(name)s - %(levelname)s - %(message)s"
+# Write log files from a background listener thread ("0" writes them on
+# the calling thread, as each record is logged)
+LOG_QUEUE = os.getenv("EXPENSE_LOG_QUEUE", "1") != "0"
+# Records the listener writes before flushing the log files
+LOG_BATCH_SIZE = 500
+# "category=fraction,..." of the records of a hot-path category to keep,
+# e.g. "expense.add=0.01" keeps one add record in a hundred
+LOG_SAMPLE = os.getenv("EXPENSE_LOG_SAMPLE", "")
+# "category=records per second,..." let through at most
+LOG_RATE_LIMIT = os.getenv("EXPENSE_LOG_RATE_LIMIT", "import.skip=100")
+
+formatter = logging.Formatter(LOG_FORMAT)
+
+
+class BufferedRotatingFileHandler(RotatingFileHandler):
+    """Leaves records in the file's buffer until flush_buffer(), so a batch
+    of records costs a few write() calls rather than one per record"""
+
+    def flush(self):
+        pass
+
+    def flush_buffer(self):
+        super().flush()
+
+
+class UserLogFiles:
+    """LRU pool of the open users/<username>/tracker.log handlers.
+
+    Handlers are opened on a user's first record and closed when evicted,
+    so a process serving many users holds at most max_open log files. With
+    buffered, records reach the files on flush() (or when evicted)."""
+
+    def __init__(self, users_dir=BASE_DIR / "users", max_open=LOG_MAX_OPEN_FILES,
+                 buffered=False):
+        self.users_dir = Path(users_dir)
+        self.max_open = max_open
+        self.buffered = buffered
+        self._handlers = OrderedDict()
+        self._lock = Lock()
+        self.opened = 0
+        self.closed = 0
+
+    def emit(self, username, record):
+        # Held while writing, so eviction never closes a handler mid-record
+        with self._lock:
+            handler = self._handlers.get(username)
+            if handler is None:
+                handler = self._open(username)
+            else:
+                self._handlers.move_to_end(username)
+            handler.handle(record)
+
+    def _open(self, username):
+        while len(self._handlers) >= max(self.max_open, 1):
+            _, evicted = self._handlers.popitem(last=False)
+            evicted.close()
+            self.closed += 1
+        user_dir = self.users_dir / username
+        user_dir.mkdir(parents=True, exist_ok=True)
+        handler_class = BufferedRotatingFileHandler if self.buffered else RotatingFileHandler
+        handler = handler_class(user_dir / "tracker.log", maxBytes=5*1024*1024, backupCount=3)
+        handler.setFormatter(formatter)
+        self._handlers[username] = handler
+        self.opened += 1
+        return handler
+
+    def flush(self):
+        if not self.buffered:
+            return
+        with self._lock:
+            for handler in self._handlers.values():
+                handler.flush_buffer()
+
+    def open_count(self):
+        with self._lock:
+            return len(self._handlers)
+
+    def close_all(self):
+        with self._lock:
+            while self._handlers:
+                self._handlers.popitem()[1].close()
+                self.closed += 1
+
+
+class UserFileHandler(logging.Handler):
+    """Writes a user's records to their tracker.log through a UserLogFiles
+    pool; holds no file itself"""
+
+    def __init__(self, files, username, level=logging.INFO):
+        super().__init__(level)
+        self.files = files
+        self.username = username
+
+    def emit(self, record):
+        try:
+            self.files.emit(self.username, record)
+        except Exception:
+            self.handleError(record)
+
+
+def parse_categories(setting):
+    """'a=0.5,b=10' -> {'a': 0.5, 'b': 10.0}"""
+    categories = {}
+    for item in setting.split(","):
+        if "=" in item:
+            category, value = item.split("=", 1)
+            categories[category.strip()] = float(value)
+    return categories
+
+
+class LogSampler(logging.Filter):
+    """Thins out hot-path records before they are queued or formatted.
+
+    Records opt in with extra={"log_category": name} (see log_category()).
+    sample keeps every round(1 / fraction)-th record of a category and
+    limits lets at most that many records of a category through per
+    second. ERROR and above always pass. Dropped records are counted per
+    category in dropped."""
+
+    def __init__(self, sample=None, limits=None):
+        super().__init__()
+        self.sample = sample or {}
+        self.limits = limits or {}
+        self.dropped = {}
+        self._seen = {}
+        # category -> [second, records let through in it]
+        self._windows = {}
+        self._lock = Lock()
+
+    def filter(self, record):
+        category = getattr(record, "log_category", None)
+        if category is None or record.levelno >= logging.ERROR:
+            return True
+        with self._lock:
+            keep = True
+            fraction = self.sample.get(category)
+            if fraction is not None:
+                seen = self._seen[category] = self._seen.get(category, 0) + 1
+                keep = fraction > 0 and (seen - 1) % max(1, round(1 / fraction)) == 0
+            limit = self.limits.get(category)
+            if keep and limit is not None:
+                second = int(time.monotonic())
+                window = self._windows.get(category)
+                if window is None or window[0] != second:
+                    window = self._windows[category] = [second, 0]
+                keep = window[1] < limit
+                window[1] += keep
+            if not keep:
+                self.dropped[category] = self.dropped.get(category, 0) + 1
+            return keep
+
+
+_categories = {}
+
+
+def log_category(name):
+    """extra= for a record of a sampled/rate-limited hot-path category"""
+    extra = _categories.get(name)
+    if extra is None:
+        extra = _categories[name] = {"log_category": name}
+    return extra
+
+
+class RoutingQueueHandler(QueueHandler):
+    """Queues a logger's records for the log listener along with the
+    handlers that should write them.
+
+    Records are queued unformatted: their messages, arguments and
+    tracebacks are formatted on the listener thread, so callers should
+    log with %-style arguments that aren't changed afterwards."""
+
+    def __init__(self, pipeline, handlers):
+        super().__init__(None)
+        self.pipeline = pipeline
+        self.targets = handlers
+        self.setLevel(min(handler.level for handler in handlers))
+
+    def prepare(self, record):
+        record.log_targets = self.targets
+        return record
+
+    def enqueue(self, record):
+        self.pipeline.put(record)
+
+
+class LogListener(QueueListener):
+    """Writes queued records on one background thread.
+
+    Records are taken off the queue in batches of up to batch_size; each
+    goes to the handlers it was queued with, and the buffered files are
+    flushed once per batch. Rotation happens here too, off the request
+    path."""
+
+    def __init__(self, log_queue, files, batch_size=LOG_BATCH_SIZE):
+        super().__init__(log_queue, respect_handler_level=True)
+        self.files = files
+        self.batch_size = batch_size
+        self.batches = 0
+        self.records = 0
+
+    def handle(self, record):
+        for handler in record.log_targets:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def _monitor(self):
+        stop = False
+        while not stop:
+            batch = [self.dequeue(True)]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.dequeue(False))
+                except queue.Empty:
+                    break
+            flushed = []
+            for record in batch:
+                if record is self._sentinel:
+                    stop = True
+                elif isinstance(record, Event):
+                    flushed.append(record)
+                else:
+                    self.handle(record)
+                    self.records += 1
+            self.files.flush()
+            self.batches += 1
+            for event in flushed:
+                event.set()
+
+
+class LogPipeline:
+    """The queue between loggers and the LogListener, started on first use"""
+
+    def __init__(self, files, batch_size=LOG_BATCH_SIZE):
+        self.files = files
+        self.batch_size = batch_size
+        self.queue = queue.SimpleQueue()
+        self.listener = None
+        self._finalizer = None
+        self._lock = Lock()
+
+    def put(self, record):
+        if self.listener is None:
+            self.start()
+        self.queue.put(record)
+
+    def start(self):
+        with self._lock:
+            if self.listener is None:
+                self.listener = LogListener(self.queue, self.files, self.batch_size)
+                self.listener.start()
+                if self._finalizer is None:
+                    # multiprocessing children (report and batch workers)
+                    # leave through os._exit(), skipping atexit; they run
+                    # multiprocessing's finalizers first
+                    self._finalizer = multiprocessing.util.Finalize(
+                        self, self.stop, exitpriority=10)
+
+    def flush(self, timeout=5):
+        """Wait until every record queued so far is written; True if it was"""
+        if self.listener is None:
+            return True
+        written = Event()
+        self.queue.put(written)
+        return written.wait(timeout)
+
+    def stop(self):
+        with self._lock:
+            if self.listener is not None:
+                self.listener.stop()
+                self.listener = None
+
+    def reset(self):
+        # After fork: the parent's listener thread doesn't exist here
+        self.queue = queue.SimpleQueue()
+        self.listener = None
+        self._finalizer = None
+        self._lock = Lock()
+
+
+log_files = UserLogFiles(buffered=LOG_QUEUE)
+log_pipeline = LogPipeline(log_files)
+log_sampler = LogSampler(parse_categories(LOG_SAMPLE), parse_categories(LOG_RATE_LIMIT))
+_loggers = {}
+_console_handlers = {}
+_registry_lock = Lock()
+
+
+def shared_logger():
+    """The 'shared' logger: ERROR and CRITICAL of every user in tracker.log"""
+    logger = logging.getLogger('shared')
+    if not logger.handlers:
+        with _registry_lock:
+            if not logger.handlers:
+                logger.setLevel(logging.ERROR)
+                handler = RotatingFileHandler(
+                    BASE_DIR / "tracker.log", maxBytes=10*1024*1024, backupCount=5,
+                    delay=True)
+                handler.setFormatter(formatter)
+                logger.handlers = [handler]
+    return logger
+
+
+def _console_handler(level):
+    handler = _console_handlers.get(level)
+    if handler is None:
+        handler = _console_handlers[level] = logging.StreamHandler()
+        handler.setLevel(level)
+        handler.setFormatter(formatter)
+    return handler
+
+
+def get_logger(name, username, file_level=logging.INFO, console_level=logging.WARNING):
+    """Logger for module `name` acting for username, created on first use.
+
+    Records at file_level and up go to the user's tracker.log and errors to
+    the shared log, through log_pipeline unless EXPENSE_LOG_QUEUE=0; those
+    at console_level and up go to the console straight away."""
+    key = (name, username)
+    logger = _loggers.get(key)
+    if logger is not None:
+        return logger
+    shared = shared_logger()
+    with _registry_lock:
+        logger = _loggers.get(key)
+        if logger is None:
+            logger = logging.getLogger(f"{name}.{username}")
+            logger.setLevel(logging.DEBUG)
+            files = [UserFileHandler(log_files, username, file_level), shared.handlers[0]]
+            if LOG_QUEUE:
+                files = [RoutingQueueHandler(log_pipeline, files)]
+            logger.handlers = files + [_console_handler(console_level)]
+            logger.filters = [log_sampler]
+            _loggers[key] = logger
+        return logger
+
+
+def flush_logs(timeout=5):
+    """Wait for queued log records to be written; True once they are"""
+    return log_pipeline.flush(timeout)
+
+
+atexit.register(log_pipeline.stop)
+
+
+def _reset_after_fork():
+    # A lock held by a parent thread at fork time would never be released
+    global _registry_lock
+    _registry_lock = Lock()
+    log_files._lock = Lock()
+    log_pipeline.reset()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
@@ -0,0 +1,72 @@
+import pytest
+import json
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from unittest.mock import patch
+import api
+
+# USD -> currency; other bases are derived from it
+USD_RATES = {"USD": 1, "PKR": 280.0, "EUR": 0.92, "GBP": 0.79, "JPY": 157.3}
+
+
+class RateHandler(BaseHTTPRequestHandler):
+    """GET /<key>/latest/<base>: a rate table shaped like the provider's"""
+    # Keep-alive, so clients can reuse their connections; without Nagle's
+    # algorithm the body isn't held back waiting for the headers' ACK
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append(self.path)
+        server.clients.add(self.client_address)
+        if server.delay:
+            time.sleep(server.delay)
+        base = self.path.rsplit("/", 1)[-1]
+        failing = server.failures > 0
+        server.failures -= failing
+        if server.offline or failing or base not in USD_RATES:
+            self.send_error(503 if server.offline or failing else 404)
+            return
+        body = json.dumps({
+            "result": "success",
+            "base_code": base,
+            "time_last_update_utc": "Tue, 01 Jul 2025 00:00:01 +0000",
+            "time_next_update_unix": time.time() + server.ttl,
+            "conversion_rates": {currency: rate / USD_RATES[base]
+                                 for currency, rate in USD_RATES.items()}
+        }).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def rate_server(tmp_path):
+    """Local stand-in for the exchange rate provider, with api.API pointed at
+    it and an empty rate cache in tmp_path. Set offline, delay, ttl or
+    failures (the number of next requests to answer 503) on it; clients
+    holds the (host, port) of every connection made to it."""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), RateHandler)
+    server.requests = []
+    server.clients = set()
+    server.failures = 0
+    server.offline = False
+    server.delay = 0
+    server.ttl = 3600
+    thread = Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+    cache = api.RateCache(tmp_path / "exchange_rates.json")
+    # Retries back off for milliseconds rather than seconds
+    with patch.object(api, "API_URL", url), patch.object(api, "rate_cache", cache), \
+            patch.object(api, "RETRY_BACKOFF", 0.01):
+        yield server
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,322 @@
+import json
+import os
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import date, datetime
+from Multithreading_Multiprocessing import BackgroundTasks, write_text
+
+try:
+    import numpy as np
+except ImportError:
+    # NumPy is optional; without it reports use ExpenseTable's own loops
+    np = None
+
+# "auto" runs reports on NumPy views of the table when NumPy is installed,
+# "python" always uses the pure-Python loops
+REPORT_BACKEND = os.getenv("EXPENSE_REPORT_BACKEND", "auto")
+# Day ordinal of 1970-01-01, where datetime64 counts from
+EPOCH_DAY = date(1970, 1, 1).toordinal()
+
+
+def to_day(date_string):
+    """'DD-MM-YYYY' -> proleptic Gregorian day ordinal"""
+    return datetime.strptime(date_string, "%d-%m-%Y").toordinal()
+
+
+def from_day(day):
+    return date.fromordinal(day).strftime("%d-%m-%Y")
+
+
+class DateIndex:
+    """Expense names ordered by day ordinal, searched with bisect.
+
+    Saved next to the ledger (expenses.index.json) together with the
+    snapshot's file token, so a fresh process can order the ledger without
+    parsing a single date."""
+
+    def __init__(self, days=None, names=None):
+        self.days = days if days is not None else array("i")
+        self.names = names if names is not None else []
+        self.day_of = dict(zip(self.names, self.days))
+
+    @classmethod
+    def build(cls, expenses_data):
+        pairs = sorted(((to_day(details["date"]), name)
+                        for name, details in expenses_data.items() if name != "budget_info"),
+                       key=lambda pair: pair[0])
+        return cls(array("i", (day for day, _ in pairs)), [name for _, name in pairs])
+
+    def copy(self):
+        return DateIndex(array("i", self.days), list(self.names))
+
+    def __len__(self):
+        return len(self.names)
+
+    def put(self, name, day):
+        if name in self.day_of:
+            self.remove(name)
+        position = bisect_right(self.days, day)
+        self.days.insert(position, day)
+        self.names.insert(position, name)
+        self.day_of[name] = day
+
+    def remove(self, name):
+        day = self.day_of.pop(name, None)
+        if day is None:
+            return
+        position = self.names.index(name, bisect_left(
+            self.days, day), bisect_right(self.days, day))
+        del self.days[position]
+        del self.names[position]
+
+    def apply(self, puts, deletes=()):
+        for key, value in puts.items():
+            if key != "budget_info":
+                self.put(key, to_day(value["date"]))
+        for key in deletes:
+            self.remove(key)
+
+    def span(self, first_day, last_day):
+        """Positions [start, stop) of the names dated within [first_day, last_day]"""
+        return bisect_left(self.days, first_day), bisect_right(self.days, last_day)
+
+    def save(self, file_path, snapshot_token):
+        """Written compactly through write_text(), so a read() in another
+        process never sees half an index"""
+        return write_text(file_path, json.dumps(
+            {"snapshot": snapshot_token, "days": self.days.tolist(), "names": self.names},
+            separators=(",", ":")))
+
+    @classmethod
+    def read(cls, file_path, snapshot_token):
+        """The saved index if it was written for this snapshot, else None"""
+        if not os.path.exists(file_path):
+            return None
+        saved = BackgroundTasks(file_path, "r").background_fileIO()
+        if not isinstance(saved, dict) or saved.get("snapshot") != snapshot_token:
+            return None
+        return cls(array("i", saved["days"]), saved["names"])
+
+
+class ExpenseRecord:
+    """One expense row; __slots__ keeps per-row access cheap"""
+    __slots__ = ("name", "amount", "category", "date", "description")
+
+    def __init__(self, name, amount, category, date, description=""):
+        self.name = name
+        self.amount = amount
+        self.category = category
+        self.date = date
+        self.description = description
+
+    def to_dict(self):
+        return {
+            "amount": self.amount,
+            "category": self.category,
+            "date": self.date,
+            "description": self.description
+        }
+
+    def __repr__(self):
+        return f"ExpenseRecord({self.name!r}, {self.amount!r}, {self.category!r}, {self.date!r})"
+
+
+class StringColumn:
+    """Strings packed into one UTF-8 buffer addressed by offsets"""
+    __slots__ = ("_data", "_offsets")
+
+    def __init__(self):
+        self._data = bytearray()
+        self._offsets = array("Q", [0])
+
+    def append(self, value):
+        self._data += value.encode("utf-8")
+        self._offsets.append(len(self._data))
+
+    def __getitem__(self, index):
+        return self._data[self._offsets[index]:self._offsets[index + 1]].decode("utf-8")
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def nbytes(self):
+        return len(self._data) + self._offsets.itemsize * len(self._offsets)
+
+
+class ExpenseTable:
+    """Column-oriented, read-only copy of a ledger, sorted by date.
+
+    Amounts live in array('d'), dates as int32 day ordinals, categories as
+    small integer codes into a shared list and names/descriptions in
+    StringColumns, so a row costs a few dozen bytes instead of a dict of
+    Python objects."""
+
+    def __init__(self):
+        self.names = StringColumn()
+        self.descriptions = StringColumn()
+        self.amounts = array("d")
+        self.days = array("i")
+        self.category_codes = array("H")
+        self.categories = []
+        self._category_index = {}
+        self.budget_info = {}
+        self._vectorized = None
+
+    @classmethod
+    def from_ledger(cls, expenses_data, index=None):
+        """Rows are laid out in date order, following index when given"""
+        if index is None:
+            index = DateIndex.build(expenses_data)
+        table = cls()
+        table.budget_info = expenses_data.get("budget_info", {})
+        for day, name in zip(index.days, index.names):
+            table.append(name, expenses_data[name], day)
+        return table
+
+    def append(self, name, details, day=None):
+        category = details.get("category")
+        code = self._category_index.get(category)
+        if code is None:
+            code = self._category_index[category] = len(self.categories)
+            self.categories.append(category)
+        self.names.append(name)
+        self.descriptions.append(details.get("description") or "")
+        self.amounts.append(details["amount"])
+        self.days.append(to_day(details["date"]) if day is None else day)
+        self.category_codes.append(code)
+
+    def __len__(self):
+        return len(self.amounts)
+
+    def __getitem__(self, index):
+        return ExpenseRecord(self.names[index], self.amounts[index],
+                             self.categories[self.category_codes[index]],
+                             from_day(self.days[index]), self.descriptions[index])
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def category_code(self, category):
+        return self._category_index.get(category)
+
+    def select(self, first_day, last_day, category=None):
+        """Row indices dated within [first_day, last_day] and their total amount.
+
+        Rows are in date order, so the window is two bisects and a slice."""
+        start = bisect_left(self.days, first_day)
+        stop = bisect_right(self.days, last_day)
+        if category is None:
+            return list(range(start, stop)), sum(self.amounts[start:stop])
+        code = self.category_code(category)
+        if code is None:
+            return [], 0
+        codes = self.category_codes
+        indices = [index for index in range(start, stop) if codes[index] == code]
+        return indices, sum(self.amounts[index] for index in indices)
+
+    def category_totals(self, first_day, last_day):
+        """{category: total} of the rows dated within [first_day, last_day]"""
+        start = bisect_left(self.days, first_day)
+        stop = bisect_right(self.days, last_day)
+        sums = [0] * len(self.categories)
+        counts = [0] * len(self.categories)
+        codes, amounts = self.category_codes, self.amounts
+        for index in range(start, stop):
+            sums[codes[index]] += amounts[index]
+            counts[codes[index]] += 1
+        return {self.categories[code]: sums[code]
+                for code in range(len(sums)) if counts[code]}
+
+    def daily_totals(self, first_day, last_day, category=None):
+        """{'DD-MM-YYYY': total} for each day of the window with expenses"""
+        indices, _ = self.select(first_day, last_day, category)
+        totals = {}
+        for index in indices:
+            day = self.days[index]
+            totals[day] = totals.get(day, 0) + self.amounts[index]
+        return {from_day(day): total for day, total in totals.items()}
+
+    def vectorized(self):
+        """NumPy views of this table when NumPy is available, else the table itself.
+
+        Both answer select(), category_totals() and daily_totals()."""
+        if np is None or REPORT_BACKEND == "python":
+            return self
+        if self._vectorized is None:
+            self._vectorized = NumpyTable(self)
+        return self._vectorized
+
+    def nbytes(self):
+        return (self.names.nbytes() + self.descriptions.nbytes()
+                + self.amounts.itemsize * len(self.amounts)
+                + self.days.itemsize * len(self.days)
+                + self.category_codes.itemsize * len(self.category_codes))
+
+
+class NumpyTable:
+    """An ExpenseTable's columns as NumPy arrays for vectorized reports.
+
+    Amounts are float64 and category codes uint16 views sharing memory with
+    the table (which is read-only once built); dates are datetime64[D].
+    Rows are in date order, so a window is a searchsorted slice; categories
+    are boolean masks over it and group-bys are np.bincount."""
+
+    def __init__(self, table):
+        self.table = table
+        self.amounts = self._view(table.amounts, np.float64)
+        self.codes = self._view(table.category_codes, np.uint16)
+        days = self._view(table.days, np.int32)
+        self.dates = (days.astype(np.int64) - EPOCH_DAY).astype("datetime64[D]")
+
+    @staticmethod
+    def _view(column, dtype):
+        return np.frombuffer(column, dtype=dtype) if len(column) else np.zeros(0, dtype)
+
+    @staticmethod
+    def _date(day):
+        return np.datetime64(day - EPOCH_DAY, "D")
+
+    def _window(self, first_day, last_day, category=None):
+        """(start, amounts, dates, mask) of the rows in the window, masked to the
+        category when one is given; None when the category never occurs"""
+        start = int(np.searchsorted(self.dates, self._date(first_day), "left"))
+        stop = int(np.searchsorted(self.dates, self._date(last_day), "right"))
+        amounts, dates = self.amounts[start:stop], self.dates[start:stop]
+        if category is None:
+            return start, amounts, dates, None
+        code = self.table.category_code(category)
+        if code is None:
+            return None
+        mask = self.codes[start:stop] == code
+        return start, amounts[mask], dates[mask], mask
+
+    def select(self, first_day, last_day, category=None):
+        window = self._window(first_day, last_day, category)
+        if window is None:
+            return [], 0
+        start, amounts, _, mask = window
+        indices = range(start, start + len(amounts)) if mask is None \
+            else (np.flatnonzero(mask) + start).tolist()
+        return list(indices), float(amounts.sum())
+
+    def category_totals(self, first_day, last_day):
+        start, amounts, _, _ = self._window(first_day, last_day)
+        codes = self.codes[start:start + len(amounts)]
+        size = len(self.table.categories)
+        sums = np.bincount(codes, weights=amounts, minlength=size)
+        counts = np.bincount(codes, minlength=size)
+        return {self.table.categories[code]: float(sums[code])
+                for code in np.flatnonzero(counts)}
+
+    def daily_totals(self, first_day, last_day, category=None):
+        window = self._window(first_day, last_day, category)
+        if window is None or not len(window[1]):
+            return {}
+        _, amounts, dates, _ = window
+        offsets = (dates - dates[0]).astype(np.int64)
+        sums = np.bincount(offsets, weights=amounts)
+        counts = np.bincount(offsets)
+        first = int(dates[0].astype(np.int64)) + EPOCH_DAY
+        return {from_day(first + int(offset)): float(sums[offset])
+                for offset in np.flatnonzero(counts)}
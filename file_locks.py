@@ -0,0 +1,164 @@
+import os
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:
+    # No flock() (Windows): locks only coordinate the threads of this process
+    fcntl = None
+
+# Lock file guarding the reads and writes of the files in its directory
+IO_LOCK_NAME = ".io.lock"
+
+
+class FileLock:
+    """Reader/writer lock held across the threads of this process and,
+    through flock() on lock_path, across processes.
+
+    Any number of readers hold it together and a writer holds it alone.
+    The thread holding it exclusively may take it again either way; a
+    reader must not ask for it exclusively. With count_holds the lock file
+    counts the exclusive holds, so a writer can tell whether another
+    process held it since this one last did."""
+
+    def __init__(self, lock_path, count_holds=False):
+        self.lock_path = Path(lock_path)
+        self.count_holds = count_holds
+        self._condition = threading.Condition()
+        self._readers = 0
+        self._owner = None
+        self._depth = 0
+        self._fd = None
+        self._generation = 0
+        # Generation this process left behind; None before its first hold
+        self._seen = None
+
+    def acquire(self, shared=False):
+        """Block until held. With count_holds, a first exclusive hold returns
+        True when another process may have held it since this one did"""
+        me = threading.get_ident()
+        with self._condition:
+            if self._owner == me:
+                self._depth += 1
+                return False
+            if shared:
+                self._condition.wait_for(lambda: self._owner is None)
+                if not self._readers:
+                    self._lock_file(shared=True)
+                self._readers += 1
+                return False
+            self._condition.wait_for(lambda: self._owner is None and not self._readers)
+            self._lock_file(shared=False)
+            self._owner, self._depth = me, 1
+            if not self.count_holds:
+                return False
+            self._generation = self._read_generation()
+            return self._generation != self._seen
+
+    def release(self):
+        with self._condition:
+            if self._owner == threading.get_ident():
+                self._depth -= 1
+                if self._depth:
+                    return
+                if self.count_holds:
+                    self._generation += 1
+                    self._write_generation(self._generation)
+                    self._seen = self._generation
+                self._owner = None
+            else:
+                self._readers -= 1
+                if self._readers:
+                    return
+            self._unlock_file()
+            self._condition.notify_all()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    def _lock_file(self, shared):
+        if fcntl is None:
+            return
+        if not shared:
+            self.lock_path.parent.mkdir(parents=True, exist_ok=True)
+        while True:
+            try:
+                fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+            except FileNotFoundError:
+                # No directory, so nothing to read yet
+                return
+            try:
+                fcntl.flock(fd, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+                # A lock file deleted while we waited (with its directory)
+                # no longer excludes anyone; lock the current one instead
+                if os.path.samestat(os.fstat(fd), os.stat(self.lock_path)):
+                    self._fd = fd
+                    return
+            except FileNotFoundError:
+                pass
+            except BaseException:
+                os.close(fd)
+                raise
+            os.close(fd)
+
+    def _unlock_file(self):
+        if self._fd is not None:
+            # Unlock explicitly: a forked child may still share the descriptor
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+
+    def _read_generation(self):
+        if self._fd is None:
+            return self._generation
+        try:
+            return int(os.pread(self._fd, 32, 0) or 0)
+        except ValueError:
+            return 0
+
+    def _write_generation(self, generation):
+        if self._fd is not None:
+            # Counts only grow, so the new one always covers the old one
+            os.pwrite(self._fd, b"%d\n" % generation, 0)
+
+
+_locks = {}
+_locks_lock = threading.Lock()
+
+
+def lock_for(lock_path, count_holds=False):
+    """The process-wide FileLock of lock_path"""
+    key = os.path.abspath(lock_path)
+    with _locks_lock:
+        lock = _locks.get(key)
+        if lock is None:
+            lock = _locks[key] = FileLock(key, count_holds)
+        return lock
+
+
+@contextmanager
+def locked(file_path, shared=False):
+    """Hold the I/O lock of file_path's directory: shared to read, exclusive to write"""
+    lock = lock_for(Path(file_path).parent / IO_LOCK_NAME)
+    lock.acquire(shared)
+    try:
+        yield lock
+    finally:
+        lock.release()
+
+
+def _reset_after_fork():
+    # Threads holding locks in the parent don't exist in the child, and
+    # inherited descriptors share their flock() with the parent
+    global _locks, _locks_lock
+    _locks, _locks_lock = {}, threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
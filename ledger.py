@@ -0,0 +1,1352 @@
+import json
+import logging
+import os
+import sqlite3
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from contextlib import closing, contextmanager
+from datetime import datetime, timedelta
+from itertools import islice
+from pathlib import Path
+from threading import Lock, Thread
+import Multithreading_Multiprocessing as background
+from Multithreading_Multiprocessing import BackgroundTasks
+from expense_table import DateIndex, ExpenseTable, from_day, to_day
+from rollups import Rollups
+from analytics import ExpenseStats
+from file_locks import lock_for, locked
+
+# "snapshot" rewrites expenses.json on every change, "journal" appends
+# one record per change to expenses.journal.jsonl, "sqlite" keeps the
+# ledger in an indexed expenses.db next to expenses.json and "partitioned"
+# keeps one JSON file per month under ledger/
+STORAGE_MODE = os.getenv("EXPENSE_STORAGE_MODE", "snapshot")
+# Journal size (bytes) after which a background compaction is started
+COMPACT_THRESHOLD = 1024 * 1024
+
+# Upper bound on the estimated memory held by parsed ledgers (bytes)
+LEDGER_CACHE_BYTES = int(os.getenv(
+    "EXPENSE_LEDGER_CACHE_BYTES", 256 * 1024 * 1024))
+# Rough in-memory size of a parsed ledger per byte of JSON on disk
+PARSED_SIZE_FACTOR = 4
+
+# Lock file serializing the read-modify-writes of the ledger in its directory
+LEDGER_LOCK_NAME = ".ledger.lock"
+
+
+def file_token(*paths):
+    """Cheap change detector: (mtime_ns, size) of each path, None if missing"""
+    token = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            # Files with a write-behind write pending report its token instead
+            token.append(background.write_behind.token(
+                path, (stat.st_mtime_ns, stat.st_size)))
+        except FileNotFoundError:
+            token.append(None)
+    return tuple(token)
+
+
+SORT_FIELDS = ("name", "date", "amount", "category")
+
+
+def parse_sort(sort):
+    """'amount' -> ('amount', False), '-date' -> ('date', True)"""
+    if not sort:
+        return None, False
+    descending = sort.startswith("-")
+    field = sort.lstrip("-")
+    if field not in SORT_FIELDS:
+        raise ValueError(
+            f"Invalid sort field {field!r}; use one of {', '.join(SORT_FIELDS)}")
+    return field, descending
+
+
+class LedgerCache:
+    """Parsed ledgers shared by every Expense and Report call in this process.
+
+    Entries are revalidated against file_token() instead of being reparsed
+    and are evicted least-recently-used once the estimated size of all
+    entries exceeds max_bytes. Cached dicts are shared: treat them as
+    read-only and go through Ledger.commit to change them."""
+
+    def __init__(self, max_bytes=LEDGER_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, token):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != token:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def peek(self, key, token):
+        """get() without touching the LRU order or the hit/miss counters"""
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry[1] if entry is not None and entry[0] == token else None
+
+    def put(self, key, token, data, size=None):
+        if size is None:
+            size = sum(part[1] for part in token if part) * PARSED_SIZE_FACTOR
+        with self._lock:
+            self._discard(key)
+            if size > self.max_bytes:
+                return
+            self._entries[key] = (token, data, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                self._discard(next(iter(self._entries)))
+
+    def invalidate(self, key):
+        with self._lock:
+            self._discard(key)
+
+    def invalidate_dir(self, directory):
+        """Drop the entries of every file under directory"""
+        prefix = os.path.join(os.path.abspath(directory), "")
+        with self._lock:
+            for key in list(self._entries):
+                path = key[0] if isinstance(key, tuple) else key
+                if os.path.abspath(path).startswith(prefix):
+                    self._discard(key)
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[2]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def load_json(self, file_path):
+        """json.load with caching, for small files such as setup.json"""
+        # A pending write-behind version is newer than the file and its token
+        text = background.write_behind.pending_text(file_path)
+        if text is not None:
+            return json.loads(text)
+        key = Path(file_path)
+        token = file_token(key)
+        data = self.get(key, token)
+        if data is None:
+            with locked(key, shared=True), open(key, "r") as file:
+                data = json.load(file)
+            self.put(key, token, data)
+        return data
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses,
+                    "entries": len(self._entries), "bytes": self._bytes,
+                    "max_bytes": self.max_bytes}
+
+
+ledger_cache = LedgerCache()
+
+
+@contextmanager
+def ledger_lock(file_path):
+    """Hold the ledger at file_path for a read-modify-write, against other
+    threads and other processes (CLI instances, report workers, batch jobs).
+
+    Cached files of the ledger are dropped when another process may have
+    changed them since this one last held the lock; their file tokens alone
+    can miss a rewrite that keeps the size within one mtime tick. Pending
+    write-behind writes of the ledger's files are flushed before the lock is
+    released, so the next holder reads them from disk."""
+    lock = lock_for(Path(file_path).parent / LEDGER_LOCK_NAME, count_holds=True)
+    if lock.acquire():
+        ledger_cache.invalidate_dir(Path(file_path).parent)
+    try:
+        yield
+    finally:
+        try:
+            background.write_behind.flush(directory=Path(file_path).parent)
+        finally:
+            lock.release()
+
+
+def journal_path_for(file_path):
+    file_path = Path(file_path)
+    return file_path.with_name(f"{file_path.stem}.journal.jsonl")
+
+
+def index_path_for(file_path):
+    file_path = Path(file_path)
+    return file_path.with_name(f"{file_path.stem}.index.json")
+
+
+def version_path_for(file_path):
+    file_path = Path(file_path)
+    return file_path.with_name(f"{file_path.stem}.version.json")
+
+
+def read_version(file_path):
+    """The ledger's version counter; 0 before its first commit"""
+    path = version_path_for(file_path)
+    if not path.exists():
+        return 0
+    try:
+        return ledger_cache.load_json(path)["version"]
+    except (ValueError, KeyError):
+        return 0
+
+
+def bump_version(file_path):
+    """Advance the version counter; every commit calls this, so report
+    caches keyed on the version never serve results from before a change"""
+    path = version_path_for(file_path)
+    version = read_version(file_path) + 1
+    BackgroundTasks(path, "w").background_fileIO({"version": version})
+    return version
+
+
+def rollup_path_for(file_path):
+    file_path = Path(file_path)
+    return file_path.with_name(f"{file_path.stem}.rollup.json")
+
+
+def _stamp(ledger):
+    # The ledger's file token as it round-trips through JSON
+    return json.loads(json.dumps(ledger.token()))
+
+
+def read_rollups(file_path):
+    """(saved rollups, the ledger token they were saved for) or (None, None)"""
+    path = rollup_path_for(file_path)
+    if not path.exists():
+        return None, None
+    saved = BackgroundTasks(path, "r").background_fileIO()
+    if not isinstance(saved, dict):
+        return None, None
+    return Rollups.from_dict(saved), saved.get("token")
+
+
+def load_rollups(ledger, rebuild=True):
+    """Rollups matching the ledger's current contents.
+
+    Rollups saved for another version of the ledger files (written outside
+    the app, or before rollups existed) are rebuilt from the rows and saved,
+    or None is returned when rebuild is False."""
+    key = (rollup_path_for(ledger.file_path), "rollups")
+    token = ledger.token()
+    rollups = ledger_cache.get(key, token)
+    if rollups is not None:
+        return rollups
+    rollups, stamp = read_rollups(ledger.file_path)
+    if rollups is None or stamp != _stamp(ledger):
+        if not rebuild:
+            return None
+        rollups = Rollups.build(ledger.items())
+        save_rollups(ledger, rollups)
+        return rollups
+    ledger_cache.put(key, token, rollups, size=len(rollups.days) * 200)
+    return rollups
+
+
+def save_rollups(ledger, rollups):
+    path = rollup_path_for(ledger.file_path)
+    BackgroundTasks(path, "w").background_fileIO(
+        {"token": _stamp(ledger), **rollups.to_dict()})
+    ledger_cache.put((path, "rollups"), ledger.token(), rollups,
+                     size=len(rollups.days) * 200)
+
+
+def rollup_changes(ledger, puts, deletes):
+    """Before a commit: the current rollups and the rows the commit replaces.
+
+    None when the ledger has no up-to-date rollups; they are then rebuilt
+    the next time an aggregate is asked for."""
+    rollups = load_rollups(ledger, rebuild=False)
+    if rollups is None:
+        return None
+    replaced = ledger.get_many([*puts, *deletes])
+    return rollups, replaced, puts
+
+
+def apply_rollup_changes(ledger, changes):
+    """After a commit: move the rollups from the replaced rows to the new ones"""
+    if changes is None:
+        return
+    rollups, replaced, puts = changes
+    rollups = rollups.copy()
+    for expense in replaced.values():
+        rollups.add(expense, -1)
+    for key, expense in puts.items():
+        if key != "budget_info":
+            rollups.add(expense)
+    save_rollups(ledger, rollups)
+
+
+def verify_rollups(file_path, fix=True):
+    """Rebuild a ledger's rollups from its rows and diff the saved ones against them.
+
+    Returns the differing (date, category, saved, rebuilt) cells, or None
+    when nothing was saved yet; with fix the rebuilt rollups replace the
+    saved ones."""
+    ledger = open_ledger(file_path)
+    saved, _ = read_rollups(file_path)
+    rebuilt = Rollups.build(ledger.items())
+    if fix:
+        save_rollups(ledger, rebuilt)
+    return None if saved is None else saved.diff(rebuilt)
+
+
+def table_breakdown(tables, first_day, last_day, category=None):
+    """Per-category and per-day totals over ExpenseTables (one per partition)"""
+    by_category, by_day = {}, {}
+    for table in tables:
+        view = table.vectorized()
+        for name, total in view.category_totals(first_day, last_day).items():
+            if category is None or name == category:
+                by_category[name] = by_category.get(name, 0) + total
+        for day, total in view.daily_totals(first_day, last_day, category).items():
+            by_day[day] = by_day.get(day, 0) + total
+    return {"by_category": by_category, "by_day": by_day}
+
+
+def table_rows(table, first_day, last_day, category=None, stats=None):
+    """Yield (name, expense) for the table rows dated within [first_day, last_day],
+    adding each to stats (an ExpenseStats) as it goes when given"""
+    code = None
+    if category is not None:
+        code = table.category_code(category)
+        if code is None:
+            return
+    names, amounts, days = table.names, table.amounts, table.days
+    codes, categories, descriptions = table.category_codes, table.categories, table.descriptions
+    row_day = date = None
+    for index in range(bisect_left(days, first_day), bisect_right(days, last_day)):
+        if code is not None and codes[index] != code:
+            continue
+        # Rows are in date order; format each day once
+        if days[index] != row_day:
+            row_day = days[index]
+            date = from_day(row_day)
+        row_category = categories[codes[index]]
+        if stats is not None:
+            stats.add(names[index], amounts[index], row_category, row_day)
+        yield names[index], {"amount": amounts[index], "category": row_category,
+                             "date": date, "description": descriptions[index]}
+
+
+def open_ledger(file_path, mode=None):
+    mode = mode or STORAGE_MODE
+    if mode == "sqlite":
+        return SQLiteLedger(file_path)
+    if mode == "partitioned":
+        return PartitionedLedger(file_path)
+    return Ledger(file_path, mode)
+
+
+def day_range(start_date, end_date):
+    """Inclusive day ordinals of the dates whose midnight lies in [start_date, end_date]"""
+    first_day = start_date.toordinal()
+    if start_date.time() != datetime.min.time():
+        first_day += 1
+    return first_day, end_date.toordinal()
+
+
+def day_bounds(first_day, last_day):
+    """(start_date, end_date) for which day_range() gives back the two ordinals"""
+    return (datetime.fromordinal(first_day),
+            datetime.combine(datetime.fromordinal(last_day), datetime.max.time()))
+
+
+def split_days(days, start, stop, chunk_rows):
+    """(first day, last day) spans covering rows [start, stop) of a sorted day
+    column, about chunk_rows rows each; a day's rows never span two chunks"""
+    spans = []
+    while start < stop:
+        end = bisect_right(days, days[min(start + chunk_rows, stop) - 1], start, stop)
+        spans.append((days[start], days[end - 1]))
+        start = end
+    return spans
+
+
+class Ledger:
+    """Snapshot (expenses.json) plus an optional append-only journal"""
+
+    def __init__(self, file_path, mode=None):
+        self.file_path = Path(file_path)
+        self.journal_path = journal_path_for(self.file_path)
+        self.index_path = index_path_for(self.file_path)
+        self.mode = mode or STORAGE_MODE
+        self._data = None
+
+    def exists(self):
+        return self.file_path.exists() or self.journal_path.exists()
+
+    def token(self):
+        return file_token(self.file_path, self.journal_path)
+
+    def version(self):
+        return read_version(self.file_path)
+
+    def disk_size(self):
+        return sum(part[1] for part in self.token() if part)
+
+    def load(self):
+        token = self.token()
+        data = ledger_cache.get(self.file_path, token)
+        if data is not None:
+            self._data = data
+            return data
+        data = self._read()
+        if data is None:
+            return None
+        self._data = data
+        ledger_cache.put(self.file_path, token, data)
+        return data
+
+    def _snapshot_token(self):
+        token = file_token(self.file_path)[0]
+        return list(token) if token else None
+
+    def date_index(self, data=None):
+        """DateIndex of the ledger: cached, else the saved one plus the journal, else rebuilt"""
+        token = self.token()
+        key = (self.file_path, "index")
+        index = ledger_cache.get(key, token)
+        if index is not None:
+            return index
+        index = DateIndex.read(self.index_path, self._snapshot_token())
+        if index is not None:
+            # Journal records are puts/deletes by name, so replaying ones the
+            # saved index already includes is harmless
+            for record in self._journal_records():
+                if record["op"] == "put":
+                    index.apply({record["key"]: record["value"]})
+                elif record["op"] == "delete":
+                    index.remove(record["key"])
+        if data is None:
+            data = ledger_cache.peek(self.file_path, token) or self._read()
+            if data is None:
+                return None
+        if index is None or len(index) != len(data) - ("budget_info" in data):
+            index = DateIndex.build(data)
+            self._save_index(index)
+        ledger_cache.put(key, token, index, size=len(index) * 16)
+        return index
+
+    def _save_index(self, index):
+        try:
+            index.save(self.index_path, self._snapshot_token())
+        except Exception as e:
+            logging.getLogger('shared').exception(
+                f"Error saving date index {self.index_path}: {e}")
+
+    def _read(self):
+        if self.file_path.exists():
+            data = BackgroundTasks(self.file_path, "r").background_fileIO()
+            if data is None:
+                return None
+        else:
+            data = {}
+        return self._replay(data)
+
+    def table(self):
+        """The ledger as an ExpenseTable, cached separately from the parsed dict.
+
+        Only the compact table is kept, so a process that just runs reports
+        never holds the dict form of a large ledger."""
+        token = self.token()
+        key = (self.file_path, "table")
+        table = ledger_cache.get(key, token)
+        if table is None:
+            data = ledger_cache.peek(self.file_path, token)
+            if data is None:
+                data = self._read()
+                if data is None:
+                    return None
+            table = ExpenseTable.from_ledger(data, self.date_index(data))
+            ledger_cache.put(key, token, table, size=table.nbytes())
+        return table
+
+    def get(self, key):
+        data = self._data if self._data is not None else self.load()
+        value = data.get(key) if data else None
+        # Copy so callers can edit the record without touching the cache
+        return dict(value) if isinstance(value, dict) else value
+
+    def get_many(self, names):
+        """{name: expense} of the names that are in the ledger"""
+        data = self._data if self._data is not None else self.load()
+        return {name: dict(data[name]) for name in names
+                if data and name != "budget_info" and name in data}
+
+    def _journal_records(self):
+        if not self.journal_path.exists():
+            return
+        with locked(self.journal_path, shared=True), open(self.journal_path, "r") as file:
+            lines = file.readlines()
+        for line_number, line in enumerate(lines, 1):
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                # A torn last line means the writer crashed mid-append
+                if line_number == len(lines):
+                    logging.getLogger('shared').warning(
+                        f"Ignoring incomplete journal record in {self.journal_path}")
+                    return
+                raise
+
+    def _replay(self, data):
+        for record in self._journal_records():
+            if record["op"] == "put":
+                data[record["key"]] = record["value"]
+            elif record["op"] == "delete":
+                data.pop(record["key"], None)
+        return data
+
+    def commit(self, puts=None, deletes=()):
+        """Persist puts (key -> new value) and deletes (removed keys)"""
+        puts = puts or {}
+        pending_rollups = rollup_changes(self, puts, deletes)
+        token = self.token()
+        cached = ledger_cache.get(self.file_path, token)
+        index = ledger_cache.peek((self.file_path, "index"), token)
+        if self.mode == "journal":
+            records = [{"op": "put", "key": key, "value": value}
+                       for key, value in puts.items()]
+            records += [{"op": "delete", "key": key} for key in deletes]
+            if not records:
+                return True
+            appended = BackgroundTasks(
+                self.journal_path, "a").background_fileIO(records)
+            # Keep the cache in step with the journal instead of replaying it
+            if cached is not None:
+                ledger_cache.put(self.file_path, self.token(),
+                                 self._apply(cached, puts, deletes))
+            else:
+                ledger_cache.invalidate(self.file_path)
+            self._update_index(index, puts, deletes)
+            apply_rollup_changes(self, pending_rollups)
+            bump_version(self.file_path)
+            if appended and self.journal_path.stat().st_size >= COMPACT_THRESHOLD:
+                self.compact_in_background()
+            return appended
+
+        data = cached if cached is not None else self.load()
+        if data is None:
+            return False
+        data = self._apply(data, puts, deletes)
+        journal_exists = self.journal_path.exists()
+        # The journal may only go once the snapshot is really on disk
+        saved = BackgroundTasks(self.file_path, "w", write_behind=False if journal_exists
+                                else None).background_fileIO(data)
+        # The snapshot now holds everything the journal had
+        if saved and journal_exists:
+            with locked(self.journal_path):
+                self.journal_path.unlink()
+        ledger_cache.put(self.file_path, self.token(), data)
+        self._update_index(index, puts, deletes, save=True)
+        apply_rollup_changes(self, pending_rollups)
+        bump_version(self.file_path)
+        return saved
+
+    def _update_index(self, index, puts, deletes, save=False):
+        """Carry a cached DateIndex over to the new ledger version"""
+        key = (self.file_path, "index")
+        if index is None:
+            ledger_cache.invalidate(key)
+            return
+        try:
+            index = index.copy()
+            index.apply(puts, deletes)
+        except Exception:
+            ledger_cache.invalidate(key)
+            raise
+        ledger_cache.put(key, self.token(), index, size=len(index) * 16)
+        if save:
+            self._save_index(index)
+
+    def _apply(self, data, puts, deletes):
+        # Copy-on-write so readers holding the cached dict never see it change
+        data = dict(data)
+        data.update(puts)
+        for key in deletes:
+            data.pop(key, None)
+        self._data = data
+        return data
+
+    def count(self):
+        data = self.load() or {}
+        return len(data) - ("budget_info" in data)
+
+    def items(self, offset=0, limit=None, sort=None):
+        """(name, expense) pairs without budget_info, sorted and paged"""
+        field, descending = parse_sort(sort)
+        data = self.load() or {}
+        pairs = ((name, details)
+                 for name, details in data.items() if name != "budget_info")
+        if field == "name":
+            pairs = sorted(pairs, key=lambda pair: pair[0], reverse=descending)
+        elif field == "date":
+            names = self.date_index(data).names
+            pairs = ((name, data[name])
+                     for name in (reversed(names) if descending else names))
+        elif field is not None:
+            pairs = sorted(pairs, key=lambda pair: pair[1][field],
+                           reverse=descending)
+        stop = None if limit is None else offset + limit
+        return islice(pairs, offset, stop)
+
+    def query(self, start_date, end_date, category=None, stats=None):
+        """Expenses dated within [start_date, end_date], optionally of one category.
+
+        Returns (expenses, total_expense, budget_info), or None when the
+        ledger holds no data. The selected rows are also added to stats
+        (an ExpenseStats) when given, so analytics need no second pass."""
+        table = self.table()
+        if table is None or (not len(table) and not table.budget_info):
+            return None
+        indices, total_expense = table.vectorized().select(
+            *day_range(start_date, end_date), category)
+        if stats is not None:
+            stats.add_indices(table, indices)
+        filtered_expenses = {table.names[index]: table[index].to_dict()
+                             for index in indices}
+        return filtered_expenses, total_expense, table.budget_info
+
+    def stream(self, start_date, end_date, category=None, stats=None):
+        """Like query() but the expenses are yielded one at a time in date order,
+        each added to stats as it is yielded.
+
+        Returns (rows, budget_info), or None when the ledger holds no data."""
+        table = self.table()
+        if table is None or (not len(table) and not table.budget_info):
+            return None
+        return (table_rows(table, *day_range(start_date, end_date), category, stats),
+                table.budget_info)
+
+    def breakdown(self, start_date, end_date, category=None):
+        """{"by_category": {category: total}, "by_day": {date: total}} for the window"""
+        table = self.table()
+        if table is None or (not len(table) and not table.budget_info):
+            return None
+        return table_breakdown([table], *day_range(start_date, end_date), category)
+
+    def analyze(self, start_date, end_date, category=None, top_n=5):
+        """ExpenseStats of the window from one streaming pass, or None when
+        the ledger holds no data"""
+        table = self.table()
+        if table is None or (not len(table) and not table.budget_info):
+            return None
+        return ExpenseStats(top_n).add_table(
+            table, *day_range(start_date, end_date), category)
+
+    def chunks(self, start_date, end_date, chunk_rows):
+        """Day spans splitting the window into chunks of about chunk_rows rows"""
+        table = self.table()
+        if table is None:
+            return []
+        first_day, last_day = day_range(start_date, end_date)
+        return split_days(table.days, bisect_left(table.days, first_day),
+                          bisect_right(table.days, last_day), chunk_rows)
+
+    def compact(self):
+        """Fold the journal into the snapshot and remove it"""
+        with ledger_lock(self.file_path):
+            if not self.journal_path.exists():
+                return True
+            data = self.load()
+            if data is None:
+                return False
+            index = self.date_index(data)
+            rollups = load_rollups(self, rebuild=False)
+            if not BackgroundTasks(self.file_path, "w",
+                                   write_behind=False).background_fileIO(data):
+                return False
+            # The journal is the only other copy: drop it only once the
+            # snapshot reads back whole
+            if BackgroundTasks(self.file_path, "r").background_fileIO() != data:
+                logging.getLogger('shared').error(
+                    f"Snapshot {self.file_path} doesn't match the ledger; keeping the journal")
+                return False
+            with locked(self.journal_path):
+                self.journal_path.unlink()
+            ledger_cache.put(self.file_path, self.token(), data)
+            self._update_index(index, {}, (), save=True)
+            # Same contents under new file tokens
+            if rollups is not None:
+                save_rollups(self, rollups)
+            return True
+
+    def compact_in_background(self):
+        t = Thread(target=self.compact)
+        t.daemon = True
+        t.start()
+        return t
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS expenses (
+    name TEXT PRIMARY KEY,
+    amount REAL NOT NULL,
+    category TEXT,
+    date TEXT,
+    day INTEGER NOT NULL,
+    description TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_expenses_day ON expenses (day);
+CREATE INDEX IF NOT EXISTS idx_expenses_category_day ON expenses (category, day);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+# expenses.db path -> (st_dev, st_ino) of the database this process has
+# created the schema in
+_sqlite_schemas = {}
+# Names per "WHERE name IN (...)", under SQLite's bound-parameter limit
+SQLITE_BATCH = 900
+
+
+class SQLiteLedger:
+    """Ledger kept in users/<username>/expenses.db, indexed by day and category"""
+
+    def __init__(self, file_path, mode="sqlite"):
+        self.file_path = Path(file_path)
+        self.db_path = self.file_path.with_suffix(".db")
+        self.mode = mode
+        if self.db_path.exists():
+            self._connect().close()
+
+    def _connect(self):
+        # The schema is created once per database file, not on every connection
+        key = str(self.db_path)
+        try:
+            stat = os.stat(self.db_path)
+            identity = (stat.st_dev, stat.st_ino)
+        except FileNotFoundError:
+            identity = None
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        if identity is None or _sqlite_schemas.get(key) != identity:
+            conn.executescript(SQLITE_SCHEMA)
+            stat = os.stat(self.db_path)
+            _sqlite_schemas[key] = (stat.st_dev, stat.st_ino)
+        return conn
+
+    @staticmethod
+    def _row(expense_name, details):
+        day = datetime.strptime(details["date"], "%d-%m-%Y").toordinal()
+        return (expense_name, details["amount"], details.get("category"),
+                details["date"], day, details.get("description", ""))
+
+    @staticmethod
+    def _record(amount, category, date, description):
+        return {"amount": amount, "category": category,
+                "date": date, "description": description}
+
+    def exists(self):
+        return self.db_path.exists()
+
+    def token(self):
+        return file_token(self.db_path)
+
+    def version(self):
+        return read_version(self.file_path)
+
+    def disk_size(self):
+        return self.db_path.stat().st_size if self.db_path.exists() else 0
+
+    def load(self):
+        with closing(self._connect()) as conn:
+            data = {}
+            row = conn.execute(
+                "SELECT value FROM meta WHERE key = 'budget_info'").fetchone()
+            if row:
+                data["budget_info"] = json.loads(row[0])
+            for name, amount, category, date, description in conn.execute(
+                    "SELECT name, amount, category, date, description FROM expenses ORDER BY rowid"):
+                data[name] = self._record(amount, category, date, description)
+            return data
+
+    def get(self, key):
+        with closing(self._connect()) as conn:
+            if key == "budget_info":
+                row = conn.execute(
+                    "SELECT value FROM meta WHERE key = 'budget_info'").fetchone()
+                return json.loads(row[0]) if row else None
+            row = conn.execute(
+                "SELECT amount, category, date, description FROM expenses WHERE name = ?",
+                (key,)).fetchone()
+            return self._record(*row) if row else None
+
+    def get_many(self, names):
+        """{name: expense} of the names that are in the ledger, on one connection"""
+        names = [name for name in dict.fromkeys(names) if name != "budget_info"]
+        found = {}
+        if not names:
+            return found
+        with closing(self._connect()) as conn:
+            for start in range(0, len(names), SQLITE_BATCH):
+                batch = names[start:start + SQLITE_BATCH]
+                for name, amount, category, date, description in conn.execute(
+                        "SELECT name, amount, category, date, description FROM expenses "
+                        f"WHERE name IN ({', '.join('?' * len(batch))})", batch):
+                    found[name] = self._record(amount, category, date, description)
+        return found
+
+    def commit(self, puts=None, deletes=()):
+        puts = puts or {}
+        pending_rollups = rollup_changes(self, puts, deletes)
+        with closing(self._connect()) as conn, conn:
+            for key, value in puts.items():
+                if key == "budget_info":
+                    conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                                 (key, json.dumps(value)))
+                else:
+                    conn.execute(
+                        "INSERT OR REPLACE INTO expenses (name, amount, category, date, day, description) "
+                        "VALUES (?, ?, ?, ?, ?, ?)", self._row(key, value))
+            for key in deletes:
+                if key == "budget_info":
+                    conn.execute("DELETE FROM meta WHERE key = ?", (key,))
+                else:
+                    conn.execute(
+                        "DELETE FROM expenses WHERE name = ?", (key,))
+        apply_rollup_changes(self, pending_rollups)
+        bump_version(self.file_path)
+        return True
+
+    def import_data(self, expenses_data):
+        """Replace the database contents with a loaded expenses.json dict"""
+        rows = [self._row(name, details) for name, details in expenses_data.items()
+                if name != "budget_info"]
+        with closing(self._connect()) as conn, conn:
+            conn.execute("DELETE FROM expenses")
+            conn.execute("DELETE FROM meta")
+            conn.executemany(
+                "INSERT OR REPLACE INTO expenses (name, amount, category, date, day, description) "
+                "VALUES (?, ?, ?, ?, ?, ?)", rows)
+            if "budget_info" in expenses_data:
+                conn.execute("INSERT INTO meta (key, value) VALUES (?, ?)",
+                             ("budget_info", json.dumps(expenses_data["budget_info"])))
+        bump_version(self.file_path)
+        return len(rows)
+
+    def count(self):
+        with closing(self._connect()) as conn:
+            return conn.execute("SELECT COUNT(*) FROM expenses").fetchone()[0]
+
+    def items(self, offset=0, limit=None, sort=None):
+        field, descending = parse_sort(sort)
+        column = {"date": "day", None: "rowid"}.get(field, field)
+        order = f"{column} {'DESC' if descending else 'ASC'}"
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                f"SELECT name, amount, category, date, description FROM expenses "
+                f"ORDER BY {order} LIMIT ? OFFSET ?",
+                (-1 if limit is None else limit, offset)).fetchall()
+        return iter([(name, self._record(amount, category, date, description))
+                     for name, amount, category, date, description in rows])
+
+    def query(self, start_date, end_date, category=None, stats=None):
+        first_day, last_day = day_range(start_date, end_date)
+        where = "day BETWEEN ? AND ?"
+        params = [first_day, last_day]
+        if category is not None:
+            where += " AND category = ?"
+            params.append(category)
+        with closing(self._connect()) as conn:
+            has_rows = conn.execute("SELECT 1 FROM expenses LIMIT 1").fetchone()
+            budget_row = conn.execute(
+                "SELECT value FROM meta WHERE key = 'budget_info'").fetchone()
+            if not has_rows and not budget_row:
+                return None
+            # The total and the stats come from the one SELECT of the rows
+            filtered_expenses = {}
+            total_expense = 0
+            for name, amount, row_category, date, day, description in conn.execute(
+                    f"SELECT name, amount, category, date, day, description FROM expenses "
+                    f"WHERE {where} ORDER BY day", params):
+                filtered_expenses[name] = self._record(amount, row_category, date, description)
+                total_expense += amount
+                if stats is not None:
+                    stats.add(name, amount, row_category, day)
+        budget_info = json.loads(budget_row[0]) if budget_row else {}
+        return filtered_expenses, total_expense, budget_info
+
+    def stream(self, start_date, end_date, category=None, stats=None):
+        first_day, last_day = day_range(start_date, end_date)
+        where = "day BETWEEN ? AND ?"
+        params = [first_day, last_day]
+        if category is not None:
+            where += " AND category = ?"
+            params.append(category)
+        with closing(self._connect()) as conn:
+            has_rows = conn.execute("SELECT 1 FROM expenses LIMIT 1").fetchone()
+            budget_row = conn.execute(
+                "SELECT value FROM meta WHERE key = 'budget_info'").fetchone()
+        if not has_rows and not budget_row:
+            return None
+
+        def rows():
+            # The connection stays open while the caller consumes the cursor
+            with closing(self._connect()) as conn:
+                for name, amount, row_category, date, day, description in conn.execute(
+                        f"SELECT name, amount, category, date, day, description FROM expenses "
+                        f"WHERE {where} ORDER BY day", params):
+                    if stats is not None:
+                        stats.add(name, amount, row_category, day)
+                    yield name, self._record(amount, row_category, date, description)
+        return rows(), json.loads(budget_row[0]) if budget_row else {}
+
+    def breakdown(self, start_date, end_date, category=None):
+        first_day, last_day = day_range(start_date, end_date)
+        where = "day BETWEEN ? AND ?"
+        params = [first_day, last_day]
+        if category is not None:
+            where += " AND category = ?"
+            params.append(category)
+        with closing(self._connect()) as conn:
+            if not conn.execute("SELECT 1 FROM expenses LIMIT 1").fetchone() and \
+                    not conn.execute("SELECT 1 FROM meta WHERE key = 'budget_info'").fetchone():
+                return None
+            by_category = dict(conn.execute(
+                f"SELECT category, SUM(amount) FROM expenses WHERE {where} "
+                f"GROUP BY category ORDER BY MIN(rowid)", params))
+            by_day = {date: total for date, total in conn.execute(
+                f"SELECT MIN(date), SUM(amount) FROM expenses WHERE {where} "
+                f"GROUP BY day ORDER BY day", params)}
+        return {"by_category": by_category, "by_day": by_day}
+
+    def analyze(self, start_date, end_date, category=None, top_n=5):
+        first_day, last_day = day_range(start_date, end_date)
+        where = "day BETWEEN ? AND ?"
+        params = [first_day, last_day]
+        if category is not None:
+            where += " AND category = ?"
+            params.append(category)
+        stats = ExpenseStats(top_n)
+        with closing(self._connect()) as conn:
+            if not conn.execute("SELECT 1 FROM expenses LIMIT 1").fetchone() and \
+                    not conn.execute("SELECT 1 FROM meta WHERE key = 'budget_info'").fetchone():
+                return None
+            # The cursor streams rows; nothing but the stats is kept
+            for name, amount, row_category, day in conn.execute(
+                    f"SELECT name, amount, category, day FROM expenses WHERE {where} "
+                    f"ORDER BY day", params):
+                stats.add(name, amount, row_category, day)
+        return stats
+
+    def chunks(self, start_date, end_date, chunk_rows):
+        spans, span_first, span_rows = [], None, 0
+        with closing(self._connect()) as conn:
+            for day, rows in conn.execute(
+                    "SELECT day, COUNT(*) FROM expenses WHERE day BETWEEN ? AND ? "
+                    "GROUP BY day ORDER BY day", day_range(start_date, end_date)):
+                if span_first is None:
+                    span_first = day
+                span_rows += rows
+                if span_rows >= chunk_rows:
+                    spans.append((span_first, day))
+                    span_first, span_rows = None, 0
+        if span_first is not None:
+            spans.append((span_first, day))
+        return spans
+
+
+def migrate_to_sqlite(file_path):
+    """Import expenses.json (and any pending journal) into expenses.db"""
+    expenses_data = Ledger(file_path, mode="snapshot").load()
+    if expenses_data is None:
+        raise ValueError(f"Could not read {file_path}")
+    return SQLiteLedger(file_path).import_data(expenses_data)
+
+
+def partition_key(date_string):
+    """'DD-MM-YYYY' -> 'YYYY-MM', the month partition an expense belongs to"""
+    return datetime.strptime(date_string, "%d-%m-%Y").strftime("%Y-%m")
+
+
+def partition_days(partition):
+    """Inclusive day ordinals covered by a 'YYYY-MM' partition"""
+    first_day = datetime.strptime(partition, "%Y-%m").date()
+    next_month = (first_day + timedelta(days=32)).replace(day=1)
+    return first_day.toordinal(), next_month.toordinal() - 1
+
+
+def summarize_partition(expenses):
+    """Manifest entry for one partition: row count, total and per-category totals"""
+    category_totals = {}
+    for details in expenses.values():
+        category = details.get("category")
+        category_totals[category] = category_totals.get(
+            category, 0) + details["amount"]
+    return {"count": len(expenses), "total": sum(category_totals.values()),
+            "category_totals": category_totals}
+
+
+class PartitionedLedger:
+    """One JSON file per month under users/<username>/ledger/ plus a manifest.
+
+    ledger/manifest.json holds budget_info and the count, total and
+    per-category totals of every partition; ledger/names.jsonl is an
+    append-only log of which partition each expense name lives in. A commit
+    rewrites only the months it touches, and reports open only the months
+    overlapping their window."""
+
+    def __init__(self, file_path, mode="partitioned"):
+        self.file_path = Path(file_path)
+        self.dir = self.file_path.parent / "ledger"
+        self.manifest_path = self.dir / "manifest.json"
+        self.names_path = self.dir / "names.jsonl"
+        self.mode = mode
+
+    def exists(self):
+        return self.manifest_path.exists()
+
+    def token(self):
+        return file_token(self.manifest_path)
+
+    def version(self):
+        return read_version(self.file_path)
+
+    def disk_size(self):
+        if not self.dir.exists():
+            return 0
+        return sum(path.stat().st_size for path in self.dir.glob("*.json"))
+
+    def manifest(self):
+        if not self.manifest_path.exists():
+            return {"partitions": {}}
+        return ledger_cache.load_json(self.manifest_path)
+
+    def partition_path(self, partition):
+        return self.dir / f"{partition}.json"
+
+    def partition(self, partition):
+        """The expenses of one month, cached like a whole ledger"""
+        path = self.partition_path(partition)
+        token = file_token(path)
+        data = ledger_cache.get(path, token)
+        if data is None:
+            if token[0] is None:
+                return {}
+            data = BackgroundTasks(path, "r").background_fileIO()
+            if data is None:
+                raise ValueError(f"Could not read partition {path}")
+            ledger_cache.put(path, token, data)
+        return data
+
+    def names(self):
+        """expense name -> partition, replayed from names.jsonl"""
+        token = file_token(self.names_path)
+        names = ledger_cache.get(self.names_path, token)
+        if names is not None:
+            return names
+        names = {}
+        if token[0] is not None:
+            with locked(self.names_path, shared=True), open(self.names_path, "r") as file:
+                for line in file:
+                    if not line.strip():
+                        continue
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        logging.getLogger('shared').warning(
+                            f"Ignoring incomplete record in {self.names_path}")
+                        continue
+                    if record["partition"] is None:
+                        names.pop(record["key"], None)
+                    else:
+                        names[record["key"]] = record["partition"]
+        ledger_cache.put(self.names_path, token, names)
+        return names
+
+    def load(self):
+        if not self.exists():
+            return None
+        manifest = self.manifest()
+        data = {}
+        if "budget_info" in manifest:
+            data["budget_info"] = manifest["budget_info"]
+        for partition in sorted(manifest["partitions"]):
+            data.update(self.partition(partition))
+        return data
+
+    def get(self, key):
+        if key == "budget_info":
+            value = self.manifest().get("budget_info")
+        else:
+            partition = self.names().get(key)
+            value = self.partition(partition).get(
+                key) if partition else None
+        return dict(value) if isinstance(value, dict) else value
+
+    def get_many(self, names):
+        """{name: expense} of the names that are in the ledger, reading each
+        partition involved once"""
+        index = self.names()
+        by_partition = {}
+        for name in names:
+            partition = index.get(name)
+            if partition and name != "budget_info":
+                by_partition.setdefault(partition, []).append(name)
+        found = {}
+        for partition, partition_names in by_partition.items():
+            data = self.partition(partition)
+            found.update((name, dict(data[name])) for name in partition_names if name in data)
+        return found
+
+    def commit(self, puts=None, deletes=()):
+        """Rewrite the touched partitions, then the names log and the manifest"""
+        puts = puts or {}
+        pending_rollups = rollup_changes(self, puts, deletes)
+        manifest = self.manifest()
+        names = self.names()
+        changes = {}
+        renames = {}
+        for key, value in puts.items():
+            if key == "budget_info":
+                continue
+            partition = partition_key(value["date"])
+            changes.setdefault(partition, ({}, set()))[0][key] = value
+            previous = names.get(key)
+            if previous != partition:
+                renames[key] = partition
+                if previous is not None:
+                    # The expense moved to another month
+                    changes.setdefault(previous, ({}, set()))[1].add(key)
+        for key in deletes:
+            partition = names.get(key)
+            if partition is not None:
+                changes.setdefault(partition, ({}, set()))[1].add(key)
+                renames[key] = None
+
+        saved = True
+        partitions = dict(manifest["partitions"])
+        for partition, (partition_puts, partition_deletes) in changes.items():
+            path = self.partition_path(partition)
+            # Copy-on-write so readers holding the cached dict never see it change
+            data = dict(self.partition(partition))
+            for key in partition_deletes:
+                data.pop(key, None)
+            data.update(partition_puts)
+            if data:
+                saved = BackgroundTasks(
+                    path, "w").background_fileIO(data) and saved
+                ledger_cache.put(path, file_token(path), data)
+                partitions[partition] = summarize_partition(data)
+            else:
+                background.write_behind.discard(path)
+                with locked(path):
+                    path.unlink(missing_ok=True)
+                ledger_cache.invalidate(path)
+                partitions.pop(partition, None)
+
+        if renames:
+            BackgroundTasks(self.names_path, "a").background_fileIO(
+                [{"key": key, "partition": partition} for key, partition in renames.items()])
+            names = dict(names)
+            for key, partition in renames.items():
+                if partition is None:
+                    names.pop(key, None)
+                else:
+                    names[key] = partition
+            ledger_cache.put(self.names_path, file_token(
+                self.names_path), names)
+
+        manifest = dict(manifest, partitions=partitions)
+        if "budget_info" in puts:
+            manifest["budget_info"] = puts["budget_info"]
+        elif "budget_info" in deletes:
+            manifest.pop("budget_info", None)
+        saved = BackgroundTasks(self.manifest_path, "w").background_fileIO(
+            manifest) and saved
+        ledger_cache.put(self.manifest_path, file_token(
+            self.manifest_path), manifest)
+        apply_rollup_changes(self, pending_rollups)
+        bump_version(self.file_path)
+        return saved
+
+    def count(self):
+        return sum(summary["count"] for summary in self.manifest()["partitions"].values())
+
+    def items(self, offset=0, limit=None, sort=None):
+        """(name, expense) pairs without budget_info, sorted and paged"""
+        field, descending = parse_sort(sort)
+        partitions = self.manifest()["partitions"]
+        stop = None if limit is None else offset + limit
+        if field not in (None, "date"):
+            pairs = sorted(((name, details) for partition in sorted(partitions)
+                            for name, details in self.partition(partition).items()),
+                           key=lambda pair: pair[0] if field == "name" else pair[1][field],
+                           reverse=descending)
+            return islice(pairs, offset, stop)
+
+        def pairs(skip):
+            # Partitions are months, so whole ones before the page are skipped
+            # by their manifest counts and only the rest are opened
+            for partition in sorted(partitions, reverse=descending):
+                if skip >= partitions[partition]["count"]:
+                    skip -= partitions[partition]["count"]
+                    continue
+                expenses = self.partition(partition).items()
+                if field == "date":
+                    expenses = sorted(expenses, key=lambda pair: to_day(pair[1]["date"]),
+                                      reverse=descending)
+                yield from islice(expenses, skip, None)
+                skip = 0
+        return islice(pairs(offset), 0, None if limit is None else limit)
+
+    def _overlapping(self, first_day, last_day):
+        """(partition, summary, fully covered) for months overlapping the window"""
+        partitions = self.manifest()["partitions"]
+        for partition in sorted(partitions):
+            month_first, month_last = partition_days(partition)
+            if month_last < first_day or month_first > last_day:
+                continue
+            yield (partition, partitions[partition],
+                   first_day <= month_first and month_last <= last_day)
+
+    def partition_table(self, partition):
+        """One month as an ExpenseTable, cached like Ledger.table()"""
+        path = self.partition_path(partition)
+        key = (path, "table")
+        token = file_token(path)
+        table = ledger_cache.get(key, token)
+        if table is None:
+            table = ExpenseTable.from_ledger(self.partition(partition))
+            ledger_cache.put(key, token, table, size=table.nbytes())
+        return table
+
+    def _has_data(self):
+        if not self.exists():
+            return False
+        manifest = self.manifest()
+        return bool(manifest["partitions"]) or "budget_info" in manifest
+
+    def query(self, start_date, end_date, category=None, stats=None):
+        """Expenses dated within [start_date, end_date], read from overlapping months only"""
+        if not self._has_data():
+            return None
+        first_day, last_day = day_range(start_date, end_date)
+        filtered_expenses = {}
+        total_expense = 0
+        for partition, summary, _ in self._overlapping(first_day, last_day):
+            if category is not None and category not in summary["category_totals"]:
+                continue
+            table = self.partition_table(partition)
+            indices, total = table.vectorized().select(first_day, last_day, category)
+            for index in indices:
+                filtered_expenses[table.names[index]] = table[index].to_dict()
+            total_expense += total
+            if stats is not None:
+                stats.add_indices(table, indices)
+        return filtered_expenses, total_expense, self.manifest().get("budget_info", {})
+
+    def stream(self, start_date, end_date, category=None, stats=None):
+        """Like query(), one month's table at a time"""
+        if not self._has_data():
+            return None
+        first_day, last_day = day_range(start_date, end_date)
+
+        def rows():
+            for partition, summary, _ in self._overlapping(first_day, last_day):
+                if category is None or category in summary["category_totals"]:
+                    yield from table_rows(self.partition_table(partition),
+                                          first_day, last_day, category, stats)
+        return rows(), self.manifest().get("budget_info", {})
+
+    def total(self, start_date, end_date, category=None):
+        """Total spent within [start_date, end_date]; fully covered months come
+        from the manifest and only the partial months at the edges are read"""
+        if not self._has_data():
+            return None
+        first_day, last_day = day_range(start_date, end_date)
+        total_expense = 0
+        for partition, summary, covered in self._overlapping(first_day, last_day):
+            if covered:
+                total_expense += summary["total"] if category is None else \
+                    summary["category_totals"].get(category, 0)
+            elif category is None or category in summary["category_totals"]:
+                total_expense += self.partition_table(partition).vectorized().select(
+                    first_day, last_day, category)[1]
+        return total_expense
+
+    def breakdown(self, start_date, end_date, category=None):
+        if not self._has_data():
+            return None
+        first_day, last_day = day_range(start_date, end_date)
+        return table_breakdown(
+            [self.partition_table(partition)
+             for partition, _, _ in self._overlapping(first_day, last_day)],
+            first_day, last_day, category)
+
+    def analyze(self, start_date, end_date, category=None, top_n=5):
+        """Stats built per overlapping month and merged"""
+        if not self._has_data():
+            return None
+        first_day, last_day = day_range(start_date, end_date)
+        stats = ExpenseStats(top_n)
+        for partition, summary, _ in self._overlapping(first_day, last_day):
+            if category is None or category in summary["category_totals"]:
+                stats.merge(ExpenseStats(top_n).add_table(
+                    self.partition_table(partition), first_day, last_day, category))
+        return stats
+
+    def chunks(self, start_date, end_date, chunk_rows):
+        """Chunks never cross months, so a worker only loads one partition"""
+        if not self.exists():
+            return []
+        first_day, last_day = day_range(start_date, end_date)
+        spans = []
+        for partition, _, _ in self._overlapping(first_day, last_day):
+            days = self.partition_table(partition).days
+            spans.extend(split_days(days, bisect_left(days, first_day),
+                                    bisect_right(days, last_day), chunk_rows))
+        return spans
+
+    def import_data(self, expenses_data):
+        """Replace the partitions with the contents of a loaded expenses.json dict"""
+        partitions = {}
+        for name, details in expenses_data.items():
+            if name != "budget_info":
+                partitions.setdefault(partition_key(details["date"]), {})[
+                    name] = details
+        if self.dir.exists():
+            for path in self.dir.glob("*.json*"):
+                background.write_behind.discard(path)
+                with locked(path):
+                    path.unlink()
+        for partition, expenses in partitions.items():
+            BackgroundTasks(self.partition_path(partition),
+                            "w").background_fileIO(expenses)
+        BackgroundTasks(self.names_path, "a").background_fileIO(
+            [{"key": name, "partition": partition}
+             for partition, expenses in partitions.items() for name in expenses])
+        manifest = {"partitions": {partition: summarize_partition(expenses)
+                                   for partition, expenses in partitions.items()}}
+        if "budget_info" in expenses_data:
+            manifest["budget_info"] = expenses_data["budget_info"]
+        BackgroundTasks(self.manifest_path, "w").background_fileIO(manifest)
+        bump_version(self.file_path)
+        return sum(len(expenses) for expenses in partitions.values())
+
+
+def migrate_to_partitions(file_path):
+    """Split expenses.json (and any pending journal) into month partitions"""
+    expenses_data = Ledger(file_path, mode="snapshot").load()
+    if expenses_data is None:
+        raise ValueError(f"Could not read {file_path}")
+    return PartitionedLedger(file_path).import_data(expenses_data)
@@ -1,65 +1,26 @@
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 import json
 from pathlib import Path
-import logging
-from logging.handlers import RotatingFileHandler
+from app_logging import get_logger
 import time
 from login import login_screen
 from setup import Setup
 from transaction import Expense
-from report import Report
+from ledger import SORT_FIELDS
+from report import Report, to_date
 from Multithreading_Multiprocessing import BackgroundTasks
 from user_profile import user_profile
 
-# Shared logger for system-wide errors (configured once)
-shared_logger = None
-
-
-def setup_logging(username):
-    global shared_logger
-    logger = logging.getLogger(__name__)
-    logger.setLevel(logging.DEBUG)
-    user_dir = BASE_DIR / "users" / username
-    user_dir.mkdir(parents=True, exist_ok=True)
-
-    # User-specific log with rotation
-    file_handler = RotatingFileHandler(
-        user_dir / "tracker.log", maxBytes=5*1024*1024, backupCount=3
-    )
-    console_handler = logging.StreamHandler()
-    file_handler.setLevel(logging.INFO)
-    console_handler.setLevel(logging.WARNING)
-    formatter = logging.Formatter(
-        "%(asctime)s -%(name)s - %(levelname)s - %(message)s")
-    file_handler.setFormatter(formatter)
-    console_handler.setFormatter(formatter)
-
-    # Configure shared logger for ERROR and CRITICAL (only once)
-    if shared_logger is None:
-        shared_logger = logging.getLogger('shared')
-        shared_logger.setLevel(logging.ERROR)
-        shared_file_handler = RotatingFileHandler(
-            BASE_DIR / "tracker.log", maxBytes=10*1024*1024, backupCount=5
-        )
-        shared_file_handler.setFormatter(formatter)
-        shared_logger.handlers = [shared_file_handler]
-
-    # Clear existing handlers to avoid duplicates
-    logger.handlers = []
-    logger.addHandler(file_handler)
-    logger.addHandler(console_handler)
-    # Add shared handler for ERROR/CRITICAL
-    logger.addHandler(shared_logger.handlers[0])
-    return logger
-
 
 BASE_DIR = Path(__file__).resolve().parent
+# Expenses shown per page in "View all expenses"
+PAGE_SIZE = 10
 
 if __name__ == "__main__":
     login_successful, username = login_screen()
 
     if login_successful:
-        logger = setup_logging(username)
+        logger = get_logger(__name__, username)
         # User-specific directory
         user_dir = BASE_DIR / "users" / username
         user_dir.mkdir(parents=True, exist_ok=True)
@@ -177,27 +138,42 @@ if __name__ == "__main__":
                 command = input(
                     "1.View all expenses\n2.Search expense by name\n3.Update expense\n4.Delete expense\n").strip()
                 if command == "1":
-                    expense_gen = Expense.list_expenses(username)
-                    expenses_found = False
-                    try:
-                        while True:
-                            expense_name = next(expense_gen)
-                            if expense_name == "budget_info":
-                                continue
-                            expenses_found = True
-                            expense_data = Expense.load_expense(
-                                expense_name, username)
-                            if expense_data:
-                                print(f"\n{expense_name}: {expense_data}")
-                                user_input = input(
-                                    "\nPress Enter for next expense, 'q' to quit: ").lower()
-                                if user_input == 'q':
-                                    break
-                    except StopIteration:
-                        if expenses_found:
-                            print("\nEnd of expenses.")
+                    total = Expense.count_expenses(username)
+                    if total == 0:
+                        print("No expenses found.")
+                        continue
+                    sort = input(
+                        "Sort by (name, date, amount, category; prefix '-' for descending, blank for entry order): ").strip().lower() or None
+                    if sort and sort.lstrip("-") not in SORT_FIELDS:
+                        print("Invalid sort field.")
+                        continue
+                    pages = (total + PAGE_SIZE - 1) // PAGE_SIZE
+                    page = 0
+                    while True:
+                        print(f"\nPage {page + 1} of {pages}:")
+                        for expense_name, expense_data in Expense.iter_expenses(
+                                username, page * PAGE_SIZE, PAGE_SIZE, sort):
+                            print(f"{expense_name}: {expense_data}")
+                        user_input = input(
+                            "\n[n]ext, [p]revious, [j]ump to page, [q]uit: ").strip().lower()
+                        if user_input == "q":
+                            break
+                        elif user_input in ("n", ""):
+                            if page + 1 < pages:
+                                page += 1
+                            else:
+                                print("\nEnd of expenses.")
+                                break
+                        elif user_input == "p":
+                            page = max(page - 1, 0)
+                        elif user_input == "j":
+                            try:
+                                page = min(
+                                    max(int(input("Page number: ").strip()) - 1, 0), pages - 1)
+                            except ValueError:
+                                print("Invalid page number.")
                         else:
-                            print("No expenses found.")
+                            print("Invalid option.")
                     logger.info("Listed all expenses")
                 elif command == "2":
                     name = input("Enter expense name to search: ").strip().replace(
@@ -247,11 +223,26 @@ if __name__ == "__main__":
                     print("Invalid command.")
             elif choice == "4":
                 time_period = input(
-                    "Enter time period for report ([d]aily, [w]eekly, [m]onthly, [y]early): ").strip().lower()
+                    "Enter time period for report ([d]aily, [w]eekly, [m]onthly, [y]early, "
+                    "calendar [cd]ay/[cw]eek/[cm]onth/[cy]ear, YYYY-MM, YYYY or [c]ustom): ").strip().lower()
+                start = end = None
+                if time_period == "c":
+                    try:
+                        start = input(
+                            "Enter start date (DD-MM-YYYY, blank for no start): ").strip() or None
+                        end = input(
+                            "Enter end date (DD-MM-YYYY, blank for today): ").strip() or None
+                        # Blank dates cover everything up to today
+                        start = to_date(start) or date.min
+                        end = to_date(end) or date.today()
+                    except ValueError:
+                        print("Invalid date. Please use DD-MM-YYYY.")
+                        continue
+                    time_period = "custom"
                 category = input(
                     "Enter category for report (leave blank for all categories): ").strip() or None
 
-                report = Report(time_period, category, username)
+                report = Report(time_period, category, username, start, end)
                 background_task = BackgroundTasks()
                 print("Generating reports in background...")
 
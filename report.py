@@ -1,62 +1,165 @@
-import logging
-from logging.handlers import RotatingFileHandler
+from app_logging import get_logger, log_category
 from pathlib import Path
-from Multithreading_Multiprocessing import BackgroundTasks
-from datetime import datetime, timedelta
-import json
+from Multithreading_Multiprocessing import parallel_analyze, REPORT_INPROCESS_BYTES
+from report_writer import read_report, report_path, write_report
+from ledger import open_ledger, ledger_cache, day_range, load_rollups
+from analytics import ExpenseStats
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
+from lzma import LZMAError
+from threading import Lock
+import os
 import time
 
-# Shared logger for system-wide errors (configured once)
-shared_logger = None
-
-
-def setup_logging(username):
-    global shared_logger
-    logger = logging.getLogger(__name__)
-    logger.setLevel(logging.DEBUG)
-    user_dir = BASE_DIR / "users" / username
-    user_dir.mkdir(parents=True, exist_ok=True)
-
-    # User-specific log with rotation
-    file_handler = RotatingFileHandler(
-        user_dir / "tracker.log", maxBytes=5*1024*1024, backupCount=3
-    )
-    console_handler = logging.StreamHandler()
-    file_handler.setLevel(logging.INFO)
-    console_handler.setLevel(logging.WARNING)
-    formatter = logging.Formatter(
-        "%(asctime)s -%(name)s - %(levelname)s - %(message)s")
-    file_handler.setFormatter(formatter)
-    console_handler.setFormatter(formatter)
-
-    # Configure shared logger for ERROR and CRITICAL (only once)
-    if shared_logger is None:
-        shared_logger = logging.getLogger('shared')
-        shared_logger.setLevel(logging.ERROR)
-        shared_file_handler = RotatingFileHandler(
-            BASE_DIR / "tracker.log", maxBytes=10*1024*1024, backupCount=5
-        )
-        shared_file_handler.setFormatter(formatter)
-        shared_logger.handlers = [shared_file_handler]
-
-    # Clear existing handlers to avoid duplicates
-    logger.handlers = []
-    logger.addHandler(file_handler)
-    logger.addHandler(console_handler)
-    # Add shared handler for ERROR/CRITICAL
-    logger.addHandler(shared_logger.handlers[0])
-    return logger
-
 
 BASE_DIR = Path(__file__).resolve().parent
 
+# Rolling windows ending now
+ROLLING_PERIODS = {"d": timedelta(days=1), "w": timedelta(weeks=1),
+                   "m": timedelta(days=30), "y": timedelta(days=365)}
+
+
+# Most report results kept in memory by report_cache
+REPORT_CACHE_ENTRIES = int(os.getenv("EXPENSE_REPORT_CACHE_ENTRIES", 128))
+# Largest expenses listed in a report's analytics
+REPORT_TOP_N = int(os.getenv("EXPENSE_REPORT_TOP_N", 5))
+
+
+def format_day(day):
+    """Day ordinal -> 'DD-MM-YYYY' (strftime can't pad years before 1000)"""
+    value = date.fromordinal(day)
+    return f"{value.day:02d}-{value.month:02d}-{value.year:04d}"
+
+
+class ReportCache:
+    """Report query results keyed by (username, time period, first day,
+    last day, category, ledger version).
+
+    The version is bumped by every ledger commit, so a changed ledger is a
+    different key. Memory entries are also checked against the ledger's
+    file token to catch files replaced outside the app. On a memory miss the
+    saved detailed report (detailed_report_<period> in the configured
+    EXPENSE_REPORT_FORMAT/COMPRESSION) is used when its ledger_version and
+    window match. max_entries=0 turns both off."""
+
+    def __init__(self, max_entries=REPORT_CACHE_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def get(self, key, token, saved_report_path=None):
+        """(expenses, total_expense, budget_info, analytics) or None"""
+        if not self.max_entries:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == token:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+        result = self._read_saved(key, saved_report_path)
+        with self._lock:
+            if result is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+        self.put(key, token, result)
+        return result
+
+    @staticmethod
+    def _read_saved(key, saved_report_path):
+        if saved_report_path is None or not Path(saved_report_path).exists():
+            return None
+        _, time_period, first_day, last_day, category, version = key
+        try:
+            report = read_report(saved_report_path)
+        except (OSError, EOFError, ValueError, LZMAError):
+            return None
+        if not isinstance(report, dict) or report.get("ledger_version") != version \
+                or report.get("window") != [format_day(first_day), format_day(last_day)] \
+                or report.get("time_period") != time_period or report.get("category") != category \
+                or "analytics" not in report:
+            return None
+        return (report["expenses"], report["total_expense"], report["budget_info"],
+                report["analytics"])
+
+    def put(self, key, token, result):
+        with self._lock:
+            self._entries[key] = (token, result)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {"hits": self.hits, "disk_hits": self.disk_hits, "misses": self.misses,
+                    "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+                    "entries": len(self._entries)}
+
+
+report_cache = ReportCache()
+
+
+def to_date(value):
+    """date from a date/datetime or a 'DD-MM-YYYY' string"""
+    if value is None or isinstance(value, date) and not isinstance(value, datetime):
+        return value
+    if isinstance(value, datetime):
+        return value.date()
+    return datetime.strptime(value, "%d-%m-%Y").date()
+
+
+def calendar_period(period, today=None):
+    """(first day, last day) of a calendar period or None if period isn't one.
+
+    Accepts cd/cw/cm/cy for the current day, week (from Monday), month or
+    year, 'YYYY-MM' for a month and 'YYYY' for a year."""
+    today = today or date.today()
+    if period == "cd":
+        return today, today
+    if period == "cw":
+        monday = today - timedelta(days=today.weekday())
+        return monday, monday + timedelta(days=6)
+    if period == "cm":
+        period = today.strftime("%Y-%m")
+    elif period == "cy":
+        period = today.strftime("%Y")
+    try:
+        if len(period) == 7:
+            first_day = datetime.strptime(period, "%Y-%m").date()
+            next_month = (first_day + timedelta(days=32)).replace(day=1)
+            return first_day, next_month - timedelta(days=1)
+        if len(period) == 4:
+            year = int(period)
+            return date(year, 1, 1), date(year, 12, 31)
+    except ValueError:
+        pass
+    return None
+
 
 class Report:
-    def __init__(self, time_period, category=None, username=None):
+    def __init__(self, time_period, category=None, username=None, start=None, end=None):
+        self.start = to_date(start)
+        self.end = to_date(end)
+        if time_period is None:
+            time_period = "custom"
         self.time_period = time_period
         self.category = category
         self.username = username
-        self.logger = setup_logging(username)
+        # Set by _query for the detailed report
+        self.window = None
+        self.ledger_version = None
+        self.logger = get_logger(__name__, username)
         self._initialize_paths()
 
     def _initialize_paths(self):
@@ -67,56 +170,189 @@ class Report:
         self.detailed_report_path = user_dir / \
             f"detailed_report_{self.time_period}.json"
 
-    def brief_generate_report(self):
-        try:
-            with open(self.expenses_file_path, 'r') as f:
-                expenses_data = json.load(f)
-            with open(self.setup_file_path, 'r') as f:
-                setup_data = json.load(f)
-            if not expenses_data:
-                self.logger.warning("No expenses data found.")
+    def _date_range(self):
+        # Determine the start date based on the time period
+        end_date = datetime.now()
+        period = self.time_period.lower()
+        if self.start or self.end or period == "custom":
+            first_day, last_day = self.start or date.min, self.end or end_date.date()
+        elif period in ROLLING_PERIODS:
+            return end_date - ROLLING_PERIODS[period], end_date
+        else:
+            days = calendar_period(period)
+            if days is None:
+                self.logger.error("Invalid time period specified.")
                 return None
+            first_day, last_day = days
+        return (datetime.combine(first_day, datetime.min.time()),
+                datetime.combine(last_day, datetime.max.time()))
 
-            if not setup_data:
-                self.logger.warning("No setup data found.")
+    def _query(self, totals_only=False, cached_only=False):
+        """Returns (setup_data, filtered_expenses, total_expense, budget_info,
+        analytics) or None.
+
+        Results come from report_cache when the ledger version matches. With
+        totals_only the result is (setup_data, total_expense); with
+        cached_only None is returned instead of scanning the ledger."""
+        setup_data = ledger_cache.load_json(self.setup_file_path)
+        if not setup_data:
+            self.logger.warning("No setup data found.")
+            return None
+
+        date_range = self._date_range()
+        if date_range is None:
+            return None
+
+        ledger = open_ledger(self.expenses_file_path)
+        first_day, last_day = day_range(*date_range)
+        version = ledger.version()
+        key = (self.username, self.time_period, first_day,
+               last_day, self.category, version)
+        token = ledger.token()
+        # The saved report is bigger than a totals-only answer; skip it then
+        result = report_cache.get(
+            key, token, None if totals_only else report_path(self.detailed_report_path))
+        if result is None:
+            if cached_only:
                 return None
+            if totals_only:
+                if not ledger.exists():
+                    self.logger.warning("No expenses data found.")
+                    return None
+                if ledger.mode == "partitioned":
+                    # Whole months come from the manifest; only the
+                    # partial months at the window's edges are read
+                    total_expense = ledger.total(*date_range, self.category)
+                else:
+                    # A few hundred rollup cells instead of the raw rows
+                    total_expense = load_rollups(ledger).total(
+                        first_day, last_day, self.category)
+                return setup_data, total_expense
 
-            # Determine the start date based on the time period
-            end_date = datetime.now()
-            if self.time_period.lower() == "d":
-                start_date = end_date - timedelta(days=1)
-            elif self.time_period.lower() == "w":
-                start_date = end_date - timedelta(weeks=1)
-            elif self.time_period.lower() == "m":
-                start_date = end_date - timedelta(days=30)
-            elif self.time_period.lower() == "y":
-                start_date = end_date - timedelta(days=365)
-            else:
-                self.logger.error("Invalid time period specified.")
+            # Filter expenses based on date and category; the analytics are
+            # built from the same selected rows
+            stats = ExpenseStats(REPORT_TOP_N)
+            result = ledger.query(*date_range, self.category, stats=stats)
+            if result is None:
+                self.logger.warning("No expenses data found.")
                 return None
+            result = (*result, stats.to_dict())
+            report_cache.put(key, token, result)
+
+        self.window = [format_day(first_day), format_day(last_day)]
+        self.ledger_version = version
+        if totals_only:
+            return setup_data, result[1]
+        return (setup_data, *result)
 
-            # Filter expenses based on date and category
-            filtered_expenses = {}
-            total_expense = 0
-            for name, details in expenses_data.items():
-                if name == "budget_info":
-                    continue
-                expense_date = datetime.strptime(details["date"], "%d-%m-%Y")
-                if start_date <= expense_date <= end_date:
-                    if self.category is None or details["category"] == self.category:
-                        filtered_expenses[name] = details
-                        total_expense += details["amount"]
-
-            brief_report = {
+    def summary(self):
+        """Total and remaining budget only, without listing the expenses.
+
+        Answered from the ledger's daily/monthly rollups rather than its rows
+        (from the manifest's month totals for a partitioned ledger)."""
+        try:
+            query = self._query(totals_only=True)
+            if query is None:
+                return None
+            setup_data, total_expense = query
+            return {
                 "time_period": self.time_period,
                 "category": self.category,
                 "total_expense": total_expense,
-                "remaining_budget": setup_data.get("budget", 0) - total_expense,
-                "expenses": filtered_expenses
+                "remaining_budget": setup_data.get("budget", 0) - total_expense
             }
+        except Exception as e:
+            self.logger.exception(f"Error generating report summary: {e}")
+            return None
+
+    def breakdown(self):
+        """Per-category and per-day totals for the report window"""
+        try:
+            date_range = self._date_range()
+            if date_range is None:
+                return None
+            result = open_ledger(self.expenses_file_path).breakdown(
+                *date_range, self.category)
+            if result is None:
+                self.logger.warning("No expenses data found.")
+                return None
+            return {"time_period": self.time_period, "category": self.category, **result}
+        except Exception as e:
+            self.logger.exception(f"Error generating report breakdown: {e}")
+            return None
+
+    def analytics(self, top_n=None, parallel=None):
+        """Per-category/day/week totals, the top-N expenses and p50/p90/p99
+        amounts, from one streaming pass without collecting the expenses.
+
+        With parallel (the default for ledgers too big to report in-process)
+        the window is aggregated in chunks across the report worker pool."""
+        try:
+            date_range = self._date_range()
+            if date_range is None:
+                return None
+            top_n = REPORT_TOP_N if top_n is None else top_n
+            ledger = open_ledger(self.expenses_file_path)
+            if parallel is None:
+                parallel = ledger.disk_size() >= REPORT_INPROCESS_BYTES
+            if parallel:
+                stats = parallel_analyze(
+                    self.expenses_file_path, *date_range, self.category, top_n)
+            else:
+                stats = ledger.analyze(*date_range, self.category, top_n)
+            if stats is None:
+                self.logger.warning("No expenses data found.")
+                return None
+            return {"time_period": self.time_period, "category": self.category,
+                    **stats.to_dict()}
+        except Exception as e:
+            self.logger.exception(f"Error generating report analytics: {e}")
+            return None
 
+    def _build_reports(self, query):
+        """Brief and detailed report dicts from one _query() result"""
+        setup_data, filtered_expenses, total_expense, budget_info, analytics = query
+        brief_report = {
+            "time_period": self.time_period,
+            "category": self.category,
+            "total_expense": total_expense,
+            "remaining_budget": setup_data.get("budget", 0) - total_expense,
+            "expenses": filtered_expenses,
+            "analytics": analytics
+        }
+        # The detailed report only adds budget_info to the same scan, plus
+        # what report_cache needs to reuse the saved file
+        detailed_report = dict(brief_report, budget_info=budget_info,
+                               window=self.window, ledger_version=self.ledger_version)
+        return brief_report, detailed_report
+
+    def generate_reports(self, cached_only=False):
+        """Both reports from a single ledger scan: {"brief": ..., "detailed": ...}.
+
+        With cached_only, None unless report_cache can answer without a scan."""
+        try:
+            query = self._query(cached_only=cached_only)
+            if query is None:
+                return None if cached_only else {"brief": None, "detailed": None}
+            brief_report, detailed_report = self._build_reports(query)
             self.logger.info(
-                f"Report generated for {self.time_period} period.")
+                "Brief and detailed reports generated for %s period (report cache: %s).",
+                self.time_period, report_cache.stats(), extra=log_category("report"))
+            return {"brief": brief_report, "detailed": detailed_report}
+
+        except Exception as e:
+            self.logger.exception(f"Error generating reports: {e}")
+            return {"brief": None, "detailed": None}
+
+    def brief_generate_report(self):
+        try:
+            query = self._query()
+            if query is None:
+                return None
+            brief_report, _ = self._build_reports(query)
+
+            self.logger.info("Report generated for %s period.", self.time_period,
+                             extra=log_category("report"))
             return brief_report
 
         except Exception as e:
@@ -125,62 +361,81 @@ class Report:
 
     def detailed_generate_report(self, no_save=False):
         try:
-            with open(self.expenses_file_path, 'r') as f:
-                expenses_data = json.load(f)
-            with open(self.setup_file_path, 'r') as f:
-                setup_data = json.load(f)
-            if not expenses_data:
-                self.logger.warning("No expenses data found.")
+            query = self._query()
+            if query is None:
                 return None
+            _, detailed_report = self._build_reports(query)
+
+            self.logger.info("Detailed report generated for %s period.", self.time_period,
+                             extra=log_category("report"))
+            if not no_save:
+                self.save_detailed_report(detailed_report)
+
+            return detailed_report
+
+        except Exception as e:
+            self.logger.exception(f"Error generating detailed report: {e}")
+            return None
+
+    def save_detailed_report(self, detailed_report, file_format=None, compression=None):
+        """Write a detailed report dict compactly (see report_writer); returns the path"""
+        file_path = report_path(self.detailed_report_path, file_format, compression)
+        header = {key: value for key, value in detailed_report.items() if key != "expenses"}
+        write_report(file_path, header, detailed_report["expenses"].items(), file_format)
+        return file_path
+
+    def stream_detailed_report(self, file_format=None, compression=None, strict=False):
+        """Write the detailed report straight from the ledger, one expense at a
+        time, so memory does not grow with the size of the report.
 
+        Returns {"path", "expenses", "total_expense"}, or None when there is
+        no expenses data. Errors (no setup data, an invalid period, an
+        unreadable ledger, a failed write) are logged and also return None,
+        unless strict is set, in which case they are raised."""
+        try:
+            setup_data = ledger_cache.load_json(self.setup_file_path)
             if not setup_data:
-                self.logger.warning("No setup data found.")
-                return None
+                raise ValueError("No setup data found.")
+            date_range = self._date_range()
+            if date_range is None:
+                raise ValueError(f"Invalid time period {self.time_period!r}.")
 
-            # Determine the start date based on the time period
-            end_date = datetime.now()
-            if self.time_period.lower() == "d":
-                start_date = end_date - timedelta(days=1)
-            elif self.time_period.lower() == "w":
-                start_date = end_date - timedelta(weeks=1)
-            elif self.time_period.lower() == "m":
-                start_date = end_date - timedelta(days=30)
-            elif self.time_period.lower() == "y":
-                start_date = end_date - timedelta(days=365)
-            else:
-                self.logger.error("Invalid time period specified.")
+            ledger = open_ledger(self.expenses_file_path)
+            version = ledger.version()
+            # The total and analytics are accumulated as the rows stream past
+            stats = ExpenseStats(REPORT_TOP_N)
+            streamed = ledger.stream(*date_range, self.category, stats=stats)
+            if streamed is None:
+                if ledger.exists() and ledger.load() is None:
+                    raise ValueError(f"Could not read {self.expenses_file_path.name}.")
+                self.logger.warning("No expenses data found.")
                 return None
-
-            # Filter expenses based on date and category
-            filtered_expenses = {}
-            total_expense = 0
-            for name, details in expenses_data.items():
-                if name == "budget_info":
-                    continue
-                expense_date = datetime.strptime(details["date"], "%d-%m-%Y")
-                if start_date <= expense_date <= end_date:
-                    if self.category is None or details["category"] == self.category:
-                        filtered_expenses[name] = details
-                        total_expense += details["amount"]
-
-            detailed_report = {
+            rows, budget_info = streamed
+            first_day, last_day = day_range(*date_range)
+            header = {
                 "time_period": self.time_period,
                 "category": self.category,
-                "total_expense": total_expense,
-                "remaining_budget": setup_data.get("budget", 0) - total_expense,
-                "expenses": filtered_expenses,
-                "budget_info": expenses_data.get("budget_info", {})
+                "budget_info": budget_info,
+                "window": [format_day(first_day), format_day(last_day)],
+                "ledger_version": version
             }
 
-            self.logger.info(
-                f"Detailed report generated for {self.time_period} period.")
-            if not no_save:
-                report_handler = BackgroundTasks(
-                    self.detailed_report_path, "w")
-                report_handler.background_fileIO(detailed_report)
-
-            return detailed_report
+            def trailer():
+                return {
+                    "total_expense": stats.total,
+                    "remaining_budget": setup_data.get("budget", 0) - stats.total,
+                    "analytics": stats.to_dict()
+                }
 
+            file_path = report_path(self.detailed_report_path, file_format, compression)
+            count = write_report(file_path, header, rows, file_format, trailer)
+            total_expense = stats.total
+            self.logger.info("Detailed report for %s period streamed to %s (%d expenses).",
+                             self.time_period, file_path.name, count,
+                             extra=log_category("report"))
+            return {"path": file_path, "expenses": count, "total_expense": total_expense}
         except Exception as e:
-            self.logger.exception(f"Error generating detailed report: {e}")
+            if strict:
+                raise
+            self.logger.exception(f"Error streaming detailed report: {e}")
             return None
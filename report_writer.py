@@ -0,0 +1,138 @@
+import csv
+import gzip
+import json
+import lzma
+import os
+from itertools import islice
+from pathlib import Path
+
+# Detailed report file format: compact "json", "jsonl" or "csv"
+REPORT_FORMAT = os.getenv("EXPENSE_REPORT_FORMAT", "json")
+# Optional "gzip" or "lzma" compression of detailed reports
+REPORT_COMPRESSION = os.getenv("EXPENSE_REPORT_COMPRESSION") or None
+
+FORMATS = {"json": ".json", "jsonl": ".jsonl", "csv": ".csv"}
+COMPRESSIONS = {None: "", "gzip": ".gz", "lzma": ".xz"}
+CSV_FIELDS = ["name", "amount", "category", "date", "description"]
+# json.dumps() builds a new encoder per call when given separators
+compact_json = json.JSONEncoder(separators=(",", ":")).encode
+# Rows encoded per write; bounds the memory a streamed report holds
+WRITE_BATCH_ROWS = 1000
+
+
+def report_path(base_path, file_format=None, compression=None):
+    """base_path with the suffix of the format and compression, e.g. .jsonl.gz"""
+    file_format = file_format or REPORT_FORMAT
+    compression = compression or REPORT_COMPRESSION
+    if file_format not in FORMATS:
+        raise ValueError(f"Unknown report format: {file_format}")
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"Unknown report compression: {compression}")
+    base_path = strip_suffixes(Path(base_path))
+    return base_path.with_name(base_path.name + FORMATS[file_format]
+                               + COMPRESSIONS[compression])
+
+
+def strip_suffixes(file_path):
+    """file_path without its compression and format suffixes"""
+    if file_path.suffix in (".gz", ".xz"):
+        file_path = file_path.with_suffix("")
+    if file_path.suffix in FORMATS.values():
+        file_path = file_path.with_suffix("")
+    return file_path
+
+
+def open_report(file_path, mode="r"):
+    """Open a report for text I/O, decompressing by its suffix"""
+    opener = {".gz": gzip.open, ".xz": lzma.open}.get(Path(file_path).suffix, open)
+    return opener(file_path, mode + "t", encoding="utf-8", newline="")
+
+
+def batched(rows, size=WRITE_BATCH_ROWS):
+    """Lists of up to size rows, so each write() call carries many of them"""
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+
+def write_report(file_path, header, rows, file_format=None, trailer=None):
+    """Write a report as the rows are produced; returns the number of rows.
+
+    header holds the report fields besides the expenses and rows yields
+    (name, expense) pairs. trailer, if given, is called once the rows are
+    written for the fields computed while producing them (totals, stats).
+    "json" writes the same document as the in-memory report, compactly;
+    "jsonl" writes the header on the first line, one expense per line and
+    the trailer fields on the last; "csv" writes only the expenses.
+    Compression follows the file suffix. The report is written to a
+    temporary file and moved into place, so readers never see half of it."""
+    file_format = file_format or REPORT_FORMAT
+    file_path = Path(file_path)
+    file_path.parent.mkdir(parents=True, exist_ok=True)
+    # Same suffixes, so the temporary file is compressed the same way
+    temp_path = file_path.with_name(f".tmp-{file_path.name}")
+    count = 0
+    try:
+        with open_report(temp_path, "w") as file:
+            if file_format == "json":
+                # The header without its closing brace, then "expenses" streamed in
+                head = compact_json(header)[:-1]
+                file.write(head + ("," if header else "") + '"expenses":{')
+                for lines in batched(rows):
+                    file.write(("," if count else "") + ",".join(
+                        json.dumps(name) + ":" + compact_json(expense) for name, expense in lines))
+                    count += len(lines)
+                file.write("}")
+                if trailer is not None:
+                    tail = compact_json(trailer())[1:-1]
+                    file.write(("," if tail else "") + tail)
+                file.write("}")
+            elif file_format == "jsonl":
+                file.write(compact_json(header) + "\n")
+                for lines in batched(rows):
+                    file.write("".join(compact_json(dict(expense, name=name)) + "\n"
+                                       for name, expense in lines))
+                    count += len(lines)
+                if trailer is not None:
+                    # No "name", which tells it apart from the expense lines
+                    file.write(compact_json(trailer()) + "\n")
+            elif file_format == "csv":
+                writer = csv.DictWriter(file, CSV_FIELDS, extrasaction="ignore")
+                writer.writeheader()
+                for name, expense in rows:
+                    writer.writerow(dict(expense, name=name))
+                    count += 1
+                if trailer is not None:
+                    trailer()
+            else:
+                raise ValueError(f"Unknown report format: {file_format}")
+        os.replace(temp_path, file_path)
+    finally:
+        if temp_path.exists():
+            temp_path.unlink()
+    return count
+
+
+def read_report(file_path):
+    """Load a report written by write_report() back into a dict"""
+    file_path = Path(file_path)
+    file_format = (file_path.with_suffix("") if file_path.suffix in (".gz", ".xz")
+                   else file_path).suffix
+    with open_report(file_path) as file:
+        if file_format == ".json":
+            return json.load(file)
+        if file_format == ".jsonl":
+            report = json.loads(file.readline())
+            report["expenses"] = {}
+            for line in file:
+                expense = json.loads(line)
+                if "name" in expense:
+                    report["expenses"][expense.pop("name")] = expense
+                else:
+                    report.update(expense)
+            return report
+        return {"expenses": {row.pop("name"): dict(row, amount=float(row["amount"]))
+                             for row in csv.DictReader(file)}}
@@ -0,0 +1,100 @@
+from calendar import monthrange
+from datetime import date
+from expense_table import to_day, from_day
+
+# Differences smaller than this are float noise from incremental updates
+TOLERANCE = 1e-6
+
+
+def month_span(day):
+    """(first, last) day ordinals of the month containing day"""
+    value = date.fromordinal(day)
+    first_day = value.replace(day=1).toordinal()
+    return first_day, first_day + monthrange(value.year, value.month)[1] - 1
+
+
+class Rollups:
+    """Daily per-category expense totals, with monthly totals derived from them.
+
+    A total over any window reads the months it fully covers from the
+    monthly cells and only the days at its edges from the daily ones, so a
+    yearly total touches a few dozen cells however many expenses there are."""
+
+    def __init__(self, days=None):
+        self.days = {}
+        # (first day, last day) of a month -> {category: total}
+        self.months = {}
+        for day, totals in (days or {}).items():
+            for category, amount in totals.items():
+                self._add(day, category, amount)
+
+    @classmethod
+    def build(cls, pairs):
+        """Rollups of (name, expense) pairs"""
+        rollups = cls()
+        for _, expense in pairs:
+            rollups.add(expense)
+        return rollups
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls({int(day): totals for day, totals in data.get("days", {}).items()})
+
+    def to_dict(self):
+        return {"days": {str(day): totals for day, totals in sorted(self.days.items())}}
+
+    def copy(self):
+        return Rollups(self.days)
+
+    def add(self, expense, sign=1):
+        """Count an expense in (sign=1) or out of (sign=-1) the totals"""
+        if not expense or "date" not in expense:
+            return
+        self._add(to_day(expense["date"]), expense.get("category"),
+                  sign * expense["amount"])
+
+    def _add(self, day, category, amount):
+        for cells, key in ((self.days, day), (self.months, month_span(day))):
+            totals = cells.setdefault(key, {})
+            total = totals.get(category, 0) + amount
+            if abs(total) < TOLERANCE:
+                totals.pop(category, None)
+                if not totals:
+                    del cells[key]
+            else:
+                totals[category] = total
+
+    @staticmethod
+    def _sum(totals, category):
+        return sum(totals.values()) if category is None else totals.get(category, 0)
+
+    def total(self, first_day, last_day, category=None):
+        """Total spent on days [first_day, last_day], optionally in one category"""
+        total = 0
+        for (month_first, month_last), totals in self.months.items():
+            if month_last < first_day or month_first > last_day:
+                continue
+            if first_day <= month_first and month_last <= last_day:
+                total += self._sum(totals, category)
+                continue
+            for day in range(max(first_day, month_first), min(last_day, month_last) + 1):
+                day_totals = self.days.get(day)
+                if day_totals:
+                    total += self._sum(day_totals, category)
+        return total
+
+    def month_totals(self):
+        """{'YYYY-MM': {category: total}} in month order"""
+        return {date.fromordinal(first_day).strftime("%Y-%m"): dict(totals)
+                for (first_day, _), totals in sorted(self.months.items())}
+
+    def diff(self, other):
+        """(date, category, ours, theirs) for every daily cell that differs"""
+        differences = []
+        for day in sorted(self.days.keys() | other.days.keys()):
+            ours, theirs = self.days.get(day, {}), other.days.get(day, {})
+            for category in sorted(ours.keys() | theirs.keys(), key=str):
+                if abs(ours.get(category, 0) - theirs.get(category, 0)) >= TOLERANCE:
+                    differences.append((from_day(day), category,
+                                        ours.get(category), theirs.get(category)))
+        return differences
@@ -0,0 +1,112 @@
+import pytest
+import random
+import tracemalloc
+from analytics import ExpenseStats, KLLSketch
+from expense_table import ExpenseTable, to_day
+
+
+def rank_error(values, estimate, fraction):
+    """How far estimate's rank in sorted values is from the requested one"""
+    below = sum(1 for value in values if value <= estimate)
+    return abs(below / len(values) - fraction)
+
+
+def test_sketch_percentiles_are_close():
+    generator = random.Random(7)
+    values = [generator.lognormvariate(3, 1) for _ in range(100_000)]
+    sketch = KLLSketch()
+    for value in values:
+        sketch.update(value)
+
+    values.sort()
+    for fraction, estimate in zip((0.5, 0.9, 0.99), sketch.quantiles((0.5, 0.9, 0.99))):
+        assert rank_error(values, estimate, fraction) < 0.02
+    assert sketch.count == 100_000
+    assert (sketch.min, sketch.max) == (values[0], values[-1])
+    # Bounded memory: a few k values retained for 100k updates
+    assert sum(len(items) for items in sketch.compactors) < 3 * sketch.k
+
+
+def test_merged_sketches_match_the_whole():
+    generator = random.Random(3)
+    values = [generator.uniform(0, 1000) for _ in range(40_000)]
+    halves = KLLSketch(), KLLSketch(seed=1)
+    for index, value in enumerate(values):
+        halves[index % 2].update(value)
+
+    merged = halves[0].merge(halves[1])
+    assert merged.count == len(values)
+    values.sort()
+    for fraction in (0.5, 0.9, 0.99):
+        assert rank_error(values, merged.quantile(fraction), fraction) < 0.02
+
+    restored = KLLSketch.from_dict(merged.to_dict())
+    assert restored.quantiles((0.5, 0.9)) == merged.quantiles((0.5, 0.9))
+
+
+def test_small_sketch_is_exact():
+    sketch = KLLSketch()
+    assert sketch.quantile(0.5) is None
+    for value in range(1, 11):
+        sketch.update(value)
+    assert sketch.quantiles((0, 0.5, 0.9, 1)) == [1, 5, 9, 10]
+
+
+def make_table(num_expenses):
+    expenses = {"budget_info": {}}
+    for i in range(num_expenses):
+        expenses[f"Expense_{i}"] = {
+            "amount": float(i % 97) + i / num_expenses,
+            "category": ["Food", "Travel", "Rent"][i % 3],
+            "date": f"{i % 28 + 1:02d}-06-2025",
+            "description": ""
+        }
+    return expenses, ExpenseTable.from_ledger(expenses)
+
+
+def test_stats_match_a_full_scan():
+    expenses, table = make_table(3000)
+    first_day, last_day = to_day("03-06-2025"), to_day("20-06-2025")
+    rows = [(name, details) for name, details in expenses.items()
+            if name != "budget_info" and first_day <= to_day(details["date"]) <= last_day
+            and details["category"] == "Food"]
+
+    stats = ExpenseStats(top_n=3).add_table(table, first_day, last_day, "Food")
+    report = stats.to_dict()
+    assert report["count"] == len(rows)
+    assert report["total_expense"] == pytest.approx(sum(d["amount"] for _, d in rows))
+    assert list(report["by_category"]) == ["Food"]
+    assert sum(report["by_day"].values()) == pytest.approx(report["total_expense"])
+    assert sum(report["by_week"].values()) == pytest.approx(report["total_expense"])
+    assert list(report["by_week"]) == ["2025-W23", "2025-W24", "2025-W25"]
+    largest = sorted(rows, key=lambda row: row[1]["amount"], reverse=True)[:3]
+    assert report["top_expenses"] == [{"name": name, "amount": details["amount"]}
+                                      for name, details in largest]
+    assert set(report["percentiles"]) == {"p50", "p90", "p99"}
+
+
+def test_stats_merge_across_chunks():
+    _, table = make_table(3000)
+    first_day, last_day = to_day("01-06-2025"), to_day("30-06-2025")
+    whole = ExpenseStats().add_table(table, first_day, last_day)
+    middle = to_day("15-06-2025")
+    merged = ExpenseStats().add_table(table, first_day, middle - 1).merge(
+        ExpenseStats().add_table(table, middle, last_day))
+
+    assert merged.count == whole.count
+    assert merged.total == pytest.approx(whole.total)
+    assert merged.by_category == pytest.approx(whole.by_category)
+    assert merged.by_day == pytest.approx(whole.by_day)
+    assert sorted(merged.top) == sorted(whole.top)
+
+
+def test_stats_memory_does_not_grow_with_rows():
+    def peak(num_expenses):
+        _, table = make_table(num_expenses)
+        tracemalloc.start()
+        ExpenseStats().add_table(table, to_day("01-06-2025"), to_day("30-06-2025"))
+        size = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return size
+
+    assert peak(100_000) < 2 * peak(10_000)
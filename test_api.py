@@ -1,5 +1,10 @@
 import pytest
-from api import API
+import requests
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+import api as api_module
+from api import API, RateCache, RateEngine, cross_rate, fetch_json
 
 
 @pytest.fixture
@@ -13,3 +18,143 @@ def test_get_exchange_rate_valid(api_instance):
     assert isinstance(rate, (int, float))
     assert rate > 0
     assert result == "success"
+
+
+def test_rates_are_cached_per_base(rate_server):
+    api = API(base_currency="USD")
+    assert api.get_exchange_rate("PKR") == (280.0, "Tue, 01 Jul 2025 00:00:01 +0000", "success")
+    # The whole table was kept, so other currencies don't refetch
+    assert api.get_exchange_rate("EUR")[0] == 0.92
+    assert API(base_currency="USD").get_exchange_rate("GBP")[0] == 0.79
+    assert len(rate_server.requests) == 1
+
+    # Other bases are derived from the same pivot table
+    assert API(base_currency="EUR").get_exchange_rate("USD")[0] == pytest.approx(1 / 0.92)
+    assert len(rate_server.requests) == 1
+
+
+def test_rates_persist_on_disk(rate_server):
+    API(base_currency="USD").get_exchange_rate("PKR")
+    # A new process starts with an empty memory cache
+    with patch.object(api_module, "rate_cache", RateCache(api_module.rate_cache.path)):
+        assert API(base_currency="USD").get_exchange_rate("PKR")[0] == 280.0
+    assert len(rate_server.requests) == 1
+
+
+def test_rates_are_refetched_after_the_next_update(rate_server):
+    rate_server.ttl = -1
+    API(base_currency="USD").get_exchange_rate("PKR")
+    API(base_currency="USD").get_exchange_rate("PKR")
+    assert len(rate_server.requests) == 2
+
+
+def test_stale_rates_are_used_offline(rate_server):
+    rate_server.ttl = -1
+    API(base_currency="USD").get_exchange_rate("PKR")
+    rate_server.offline = True
+    assert API(base_currency="USD").get_exchange_rate("PKR") == (
+        280.0, "Tue, 01 Jul 2025 00:00:01 +0000", "stale")
+    # Nothing to fall back on
+    empty = RateCache(api_module.rate_cache.path.with_name("empty.json"))
+    with patch.object(api_module, "rate_cache", empty):
+        assert API(base_currency="USD").get_exchange_rate("PKR") is None
+
+
+def test_cross_rates_come_from_the_pivot_table():
+    rates = {"USD": 1, "PKR": 280.0, "EUR": 0.92, "JPY": 157.3}
+    assert cross_rate(rates, "USD", "PKR") == 280.0
+    assert cross_rate(rates, "PKR", "PKR") == 1.0
+    assert cross_rate(rates, "EUR", "PKR") == pytest.approx(280.0 / 0.92, rel=1e-11)
+    # Decimal on the printed digits: 0.92 / 0.92 * x is exact
+    assert cross_rate(rates, "EUR", "USD") * 0.92 == pytest.approx(1, abs=1e-12)
+    assert cross_rate(rates, "JPY", "EUR") == float("0.00584869675779")
+    assert cross_rate(rates, "XXX", "PKR") is None
+
+
+def test_rate_engine_converts_in_bulk(rate_server):
+    engine = RateEngine()
+    assert engine.rate("EUR", "PKR") == pytest.approx(280.0 / 0.92)
+    assert engine.convert(10, "USD", "PKR") == 2800.0
+    amounts = [10, 20.5, 1000, 0.01]
+    assert engine.convert_many(amounts, "EUR", "GBP") == [
+        round(amount * 0.79 / 0.92, 2) for amount in amounts]
+    currencies = ["USD", "PKR", "EUR", "USD"]
+    assert engine.convert_many(amounts, currencies, "PKR") == [2800.0, 20.5, 304347.83, 2.8]
+    with pytest.raises(ValueError):
+        engine.convert_many(amounts, ["USD", "XXX", "EUR", "USD"], "PKR")
+    # One pivot fetch serves every pair
+    assert [path.rsplit("/", 1)[-1] for path in rate_server.requests] == ["USD"]
+
+
+def test_connections_are_pooled(rate_server):
+    rate_server.ttl = -1
+    for _ in range(3):
+        API(base_currency="USD").get_exchange_rate("PKR")
+    assert len(rate_server.requests) == 3
+    # Every fetch went over the one kept-alive connection
+    assert len(rate_server.clients) == 1
+
+
+def test_failed_requests_are_retried(rate_server):
+    rate_server.failures = 2
+    assert API(base_currency="USD").get_exchange_rate("PKR")[0] == 280.0
+    assert len(rate_server.requests) == 3
+
+    # Retries are bounded
+    rate_server.failures = 10
+    with pytest.raises(requests.HTTPError):
+        fetch_json(f"{api_module.API_URL}/key/latest/USD", retries=2)
+    assert len(rate_server.requests) == 6
+    # Not found isn't retried
+    rate_server.failures = 0
+    with pytest.raises(requests.HTTPError):
+        fetch_json(f"{api_module.API_URL}/key/latest/XXX")
+    assert len(rate_server.requests) == 7
+
+
+def test_stalled_provider_times_out(rate_server):
+    rate_server.delay = 1
+    start = time.perf_counter()
+    with patch.object(api_module, "HTTP_TIMEOUT", (1, 0.1)), \
+            patch.object(api_module, "HTTP_RETRIES", 1):
+        assert API(base_currency="USD").get_exchange_rate("PKR") is None
+    assert time.perf_counter() - start < 0.9
+    assert len(rate_server.requests) == 2
+
+
+def test_concurrent_callers_share_one_request(rate_server):
+    rate_server.delay = 0.2
+    with ThreadPoolExecutor(8) as pool:
+        results = list(pool.map(lambda currency: API(base_currency="EUR").get_exchange_rate(
+            currency), ["PKR", "USD", "GBP", "JPY"] * 2))
+    assert [result[0] for result in results[:4]] == pytest.approx(
+        [280.0 / 0.92, 1 / 0.92, 0.79 / 0.92, 157.3 / 0.92])
+    assert results[4:] == results[:4]
+    assert len(rate_server.requests) == 1
+    assert not api_module._inflight
+
+
+@pytest.mark.skipif(api_module.np is None, reason="NumPy is not installed")
+def test_bulk_conversion_rounds_the_same_without_numpy(rate_server):
+    engine = RateEngine()
+    # Products just below a half, where np.round and round() disagree
+    amounts = [2.675, 1.115, 0.435, 10, 0.01] * 3
+    currencies = ["USD", "USD", "USD", "EUR", "JPY"] * 3
+    with_numpy = engine.convert_many(amounts, currencies, "USD")
+    single = engine.convert_many(amounts, "USD", "USD")
+    with patch.object(api_module, "np", None):
+        assert engine.convert_many(amounts, currencies, "USD") == with_numpy
+        assert engine.convert_many(amounts, "USD", "USD") == single
+    assert single[:3] == [2.67, 1.11, 0.43]
+
+
+@pytest.mark.skipif(api_module.np is None, reason="NumPy is not installed")
+@pytest.mark.parametrize("digits", [0, 2, 4])
+def test_vectorized_rounding_matches_round(digits):
+    np = api_module.np
+    rng = np.random.default_rng(7)
+    values = np.concatenate([rng.uniform(-1e6, 1e6, 20_000),
+                             rng.integers(0, 10**7, 20_000) / 2000,  # Exact halves
+                             [2.675, 1.115, -0.435, 1e20, 0.0]])
+    assert api_module.round_array(values, digits) == [round(value, digits)
+                                                      for value in values.tolist()]
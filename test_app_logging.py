@@ -0,0 +1,139 @@
+import logging
+import multiprocessing
+import threading
+import app_logging
+from app_logging import (LogPipeline, LogSampler, RoutingQueueHandler, UserFileHandler,
+                         UserLogFiles, get_logger, log_category)
+
+
+def user_logger(files, username):
+    logger = logging.getLogger(f"test_app_logging.{username}")
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    logger.handlers = [UserFileHandler(files, username)]
+    return logger
+
+
+def test_get_logger_is_created_once():
+    logger = get_logger("test_app_logging", "registry_user")
+    handlers = list(logger.handlers)
+    assert get_logger("test_app_logging", "registry_user") is logger
+    assert logger.handlers == handlers
+    # Every user logger shares the console and shared-log handlers
+    other = get_logger("test_app_logging", "registry_user_2")
+    assert other is not logger
+    assert other.handlers[1:] == handlers[1:]
+    assert app_logging.log_files.open_count() <= app_logging.log_files.max_open
+
+
+def test_open_log_files_are_capped(tmp_path):
+    files = UserLogFiles(tmp_path, max_open=2)
+    loggers = [user_logger(files, f"user_{i}") for i in range(5)]
+    for round_number in range(3):
+        for i, logger in enumerate(loggers):
+            logger.info(f"round {round_number} for user_{i}")
+            assert files.open_count() <= 2
+
+    assert files.opened - files.closed == 2
+    for i in range(5):
+        lines = (tmp_path / f"user_{i}" / "tracker.log").read_text().splitlines()
+        # Reopened after eviction without losing or misrouting records
+        assert [line.split(" - ")[-1] for line in lines] == [
+            f"round {round_number} for user_{i}" for round_number in range(3)]
+    files.close_all()
+    assert files.open_count() == 0
+
+
+def test_recently_used_files_stay_open(tmp_path):
+    files = UserLogFiles(tmp_path, max_open=2)
+    busy, other, third = (user_logger(files, name) for name in ("busy", "other", "third"))
+    busy.info("1")
+    other.info("1")
+    busy.info("2")
+    third.info("1")
+    # "other" was the least recently used, so it was the one closed
+    assert (files.opened, files.closed) == (3, 1)
+    busy.info("3")
+    assert files.opened == 3
+    files.close_all()
+
+
+def test_sampler_keeps_a_fraction_and_limits_the_rate():
+    sampler = LogSampler(sample={"hot": 0.1}, limits={"noisy": 5})
+    logger = logging.getLogger("test_app_logging.sampled")
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    kept = []
+    logger.handlers = [logging.Handler()]
+    logger.handlers[0].emit = kept.append
+    logger.filters = [sampler]
+
+    for i in range(100):
+        logger.info("hot %d", i, extra=log_category("hot"))
+        logger.warning("noisy %d", i, extra=log_category("noisy"))
+        logger.info("plain %d", i)
+    logger.error("hot failure", extra=log_category("hot"))
+
+    messages = [record.getMessage() for record in kept]
+    assert [m for m in messages if m.startswith("hot ")] == [
+        f"hot {i}" for i in range(0, 100, 10)] + ["hot failure"]
+    # A 100-record burst lands within a second or two
+    assert 5 <= sum(m.startswith("noisy") for m in messages) <= 10
+    assert sum(m.startswith("plain") for m in messages) == 100
+    assert sampler.dropped["hot"] == 90
+
+
+def test_queued_records_are_batched_and_formatted_off_thread(tmp_path):
+    files = UserLogFiles(tmp_path, buffered=True)
+    pipeline = LogPipeline(files, batch_size=600)
+    logger = logging.getLogger("test_app_logging.queued")
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    logger.handlers = [RoutingQueueHandler(pipeline, [UserFileHandler(files, "queued")])]
+    formatted_on = set()
+
+    class Expense:
+        def __str__(self):
+            formatted_on.add(threading.current_thread().name)
+            return "expense"
+
+    # Queued before the listener runs, so they arrive as two batches
+    handler = logger.handlers[0]
+    for i in range(1000):
+        pipeline.queue.put(handler.prepare(
+            logger.makeRecord(logger.name, logging.INFO, "", 0, "%d %s", (i, Expense()), None)))
+    assert not formatted_on
+    pipeline.start()
+    assert pipeline.flush()
+
+    assert pipeline.listener.batches == 2
+    assert formatted_on == {pipeline.listener._thread.name}
+    logger.debug("below the handlers' level")
+    logger.info("%s after the batches", Expense())
+    assert pipeline.flush()
+    lines = (tmp_path / "queued" / "tracker.log").read_text().splitlines()
+    assert lines[-1].endswith("expense after the batches")
+    lines.pop()
+    assert [line.split(" - ")[-1] for line in lines] == [f"{i} expense" for i in range(1000)]
+    pipeline.stop()
+    files.close_all()
+
+
+def log_from_child(users_dir):
+    pipeline = LogPipeline(UserLogFiles(users_dir, buffered=True))
+    logger = user_logger(pipeline.files, "child")
+    logger.handlers = [RoutingQueueHandler(pipeline, logger.handlers)]
+    for i in range(1000):
+        logger.info("record %d", i)
+    logger.error("last record")
+
+
+def test_child_process_writes_queued_records_before_exit(tmp_path):
+    # Pool and batch workers exit through os._exit() without running atexit
+    child = multiprocessing.get_context("fork").Process(target=log_from_child, args=(tmp_path,))
+    child.start()
+    child.join(10)
+    assert child.exitcode == 0
+    lines = (tmp_path / "child" / "tracker.log").read_text().splitlines()
+    assert len(lines) == 1001
+    assert lines[-1].endswith("last record")
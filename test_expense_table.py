@@ -0,0 +1,143 @@
+import pytest
+import json
+import tracemalloc
+from unittest.mock import patch
+from expense_table import DateIndex, ExpenseTable, ExpenseRecord, to_day
+from file_locks import locked
+
+
+def make_ledger(num_expenses):
+    expenses = {"budget_info": {"current_budget": 1000}}
+    for i in range(num_expenses):
+        expenses[f"Expense_{i}"] = {
+            "amount": float(i % 50),
+            "category": ["Food", "Travel", "Rent"][i % 3],
+            "date": f"{i % 28 + 1:02d}-06-2025",
+            "description": "Groceries" if i % 2 else ""
+        }
+    return expenses
+
+
+def test_rows_round_trip():
+    ledger = make_ledger(10)
+    table = ExpenseTable.from_ledger(ledger)
+    assert len(table) == 10
+    assert table.budget_info == {"current_budget": 1000}
+    for record in table:
+        assert isinstance(record, ExpenseRecord)
+        assert record.to_dict() == ledger[record.name]
+
+
+def test_select_filters_days_and_category():
+    ledger = make_ledger(90)
+    table = ExpenseTable.from_ledger(ledger)
+    first_day, last_day = to_day("05-06-2025"), to_day("10-06-2025")
+
+    indices, total = table.select(first_day, last_day, "Food")
+    expected = {name: details for name, details in ledger.items()
+                if name != "budget_info" and details["category"] == "Food"
+                and first_day <= to_day(details["date"]) <= last_day}
+    assert {table.names[index] for index in indices} == set(expected)
+    assert total == sum(details["amount"] for details in expected.values())
+    assert table.select(first_day, last_day, "Unknown") == ([], 0)
+
+
+def test_record_has_no_instance_dict():
+    record = ExpenseRecord("Lunch", 10.0, "Food", "01-06-2025")
+    with pytest.raises(AttributeError):
+        record.__dict__
+
+
+def test_table_uses_far_less_memory_than_parsed_json():
+    raw = json.dumps(make_ledger(20_000))
+
+    tracemalloc.start()
+    parsed = json.loads(raw)
+    dict_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    tracemalloc.start()
+    table = ExpenseTable.from_ledger(parsed)
+    table_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    assert len(table) == 20_000
+    assert table_bytes * 5 < dict_bytes
+
+
+def test_date_index_put_remove_and_span():
+    index = DateIndex.build(make_ledger(6))
+    assert list(index.days) == sorted(index.days)
+
+    index.put("Late", to_day("30-06-2025"))
+    index.put("Expense_0", to_day("15-06-2025"))
+    index.remove("Expense_1")
+    assert list(index.days) == sorted(index.days)
+    assert "Expense_1" not in index.names
+
+    start, stop = index.span(to_day("15-06-2025"), to_day("30-06-2025"))
+    assert index.names[start:stop] == ["Expense_0", "Late"]
+
+
+def test_date_index_is_saved_atomically_under_the_io_lock(tmp_path):
+    index_path = tmp_path / "expenses.index.json"
+    index = DateIndex.build(make_ledger(6))
+    with patch("Multithreading_Multiprocessing.locked", wraps=locked) as lock:
+        assert index.save(index_path, [1, 2])
+    lock.assert_called_once_with(index_path)
+    assert not list(tmp_path.glob(".*.tmp"))
+
+    saved = DateIndex.read(index_path, [1, 2])
+    assert (list(saved.days), saved.names) == (list(index.days), index.names)
+    assert DateIndex.read(index_path, [1, 3]) is None
+    index_path.write_text('{"snapshot": [1, 2], "da')
+    assert DateIndex.read(index_path, [1, 2]) is None
+    assert DateIndex.read(tmp_path / "missing.json", [1, 2]) is None
+
+
+def test_table_rows_are_in_date_order():
+    table = ExpenseTable.from_ledger(make_ledger(60))
+    assert list(table.days) == sorted(table.days)
+
+
+def test_breakdowns_group_by_category_and_day():
+    table = ExpenseTable.from_ledger(make_ledger(90))
+    first_day, last_day = to_day("01-06-2025"), to_day("02-06-2025")
+    rows = [record for record in table if first_day <= to_day(record.date) <= last_day]
+
+    expected = {}
+    for record in rows:
+        expected[record.category] = expected.get(record.category, 0) + record.amount
+    assert table.category_totals(first_day, last_day) == expected
+    assert table.daily_totals(first_day, last_day, "Food") == {
+        date: sum(record.amount for record in rows
+                  if record.date == date and record.category == "Food")
+        for date in ("01-06-2025", "02-06-2025")}
+
+
+def test_vectorized_falls_back_without_numpy():
+    table = ExpenseTable.from_ledger(make_ledger(10))
+    with patch("expense_table.np", None):
+        assert table.vectorized() is table
+    with patch("expense_table.REPORT_BACKEND", "python"):
+        assert table.vectorized() is table
+
+
+@pytest.mark.parametrize("category", [None, "Food", "Unknown"])
+def test_numpy_table_matches_python_table(category):
+    pytest.importorskip("numpy")
+    table = ExpenseTable.from_ledger(make_ledger(300))
+    with patch("expense_table.REPORT_BACKEND", "auto"):
+        view = table.vectorized()
+    assert view is not table
+    for first, last in [("05-06-2025", "10-06-2025"), ("01-01-2020", "31-12-2030"),
+                        ("29-07-2025", "30-07-2025")]:
+        first_day, last_day = to_day(first), to_day(last)
+        indices, total = view.select(first_day, last_day, category)
+        expected_indices, expected_total = table.select(first_day, last_day, category)
+        assert indices == expected_indices
+        assert total == pytest.approx(expected_total)
+        assert view.category_totals(first_day, last_day) == pytest.approx(
+            table.category_totals(first_day, last_day))
+        assert view.daily_totals(first_day, last_day, category) == pytest.approx(
+            table.daily_totals(first_day, last_day, category))
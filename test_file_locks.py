@@ -0,0 +1,97 @@
+import pytest
+import os
+import time
+from threading import Thread
+from unittest.mock import patch
+import file_locks
+from file_locks import FileLock, locked
+from Multithreading_Multiprocessing import write_text
+
+needs_flock = pytest.mark.skipif(file_locks.fcntl is None, reason="no fcntl.flock")
+
+
+def test_readers_share_and_writers_wait(tmp_path):
+    lock = FileLock(tmp_path / ".io.lock")
+    events = []
+
+    def writer():
+        with lock:
+            events.append("writer")
+
+    lock.acquire(shared=True)
+    reader = Thread(target=lambda: (lock.acquire(shared=True), events.append("reader"),
+                                    lock.release()))
+    reader.start()
+    reader.join(timeout=2)
+    thread = Thread(target=writer)
+    thread.start()
+    time.sleep(0.1)
+    # The second reader got in, the writer waits for the first one
+    assert events == ["reader"]
+    lock.release()
+    thread.join(timeout=2)
+    assert events == ["reader", "writer"]
+
+
+def test_exclusive_lock_is_reentrant(tmp_path):
+    lock = FileLock(tmp_path / ".io.lock")
+    with lock:
+        with lock:
+            lock.acquire(shared=True)
+            lock.release()
+    # Released for good: another thread gets it straight away
+    thread = Thread(target=lambda: lock.acquire() or lock.release())
+    thread.start()
+    thread.join(timeout=2)
+    assert not thread.is_alive()
+
+
+@needs_flock
+def test_lock_excludes_other_open_files(tmp_path):
+    # A second open of the lock file stands in for another process
+    lock_path = tmp_path / ".io.lock"
+    other = os.open(lock_path, os.O_RDWR | os.O_CREAT)
+    try:
+        with FileLock(lock_path):
+            with pytest.raises(BlockingIOError):
+                file_locks.fcntl.flock(other, file_locks.fcntl.LOCK_SH | file_locks.fcntl.LOCK_NB)
+        lock = FileLock(lock_path)
+        lock.acquire(shared=True)
+        file_locks.fcntl.flock(other, file_locks.fcntl.LOCK_SH | file_locks.fcntl.LOCK_NB)
+        with pytest.raises(BlockingIOError):
+            file_locks.fcntl.flock(other, file_locks.fcntl.LOCK_EX | file_locks.fcntl.LOCK_NB)
+        file_locks.fcntl.flock(other, file_locks.fcntl.LOCK_UN)
+        lock.release()
+    finally:
+        os.close(other)
+
+
+@needs_flock
+def test_acquire_reports_writes_by_other_processes(tmp_path):
+    lock_path = tmp_path / ".ledger.lock"
+    lock = FileLock(lock_path, count_holds=True)
+    assert lock.acquire()
+    lock.release()
+    assert not lock.acquire()
+    lock.release()
+    # Another process's FileLock on the same file
+    other = FileLock(lock_path, count_holds=True)
+    other.acquire()
+    other.release()
+    assert lock.acquire()
+    lock.release()
+
+
+def test_write_text_replaces_atomically(tmp_path):
+    file_path = tmp_path / "expenses.json"
+    write_text(file_path, '{"a": 1}')
+    with patch("os.replace", side_effect=OSError("disk full")):
+        with pytest.raises(OSError):
+            write_text(file_path, '{"a": 2}')
+    assert file_path.read_text() == '{"a": 1}'
+    # No temporary file left behind
+    assert [path.name for path in tmp_path.glob("*.json*")] == ["expenses.json"]
+
+    write_text(file_path, "\n{}", mode="a")
+    with locked(file_path, shared=True):
+        assert file_path.read_text() == '{"a": 1}\n{}'
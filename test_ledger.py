@@ -0,0 +1,430 @@
+import pytest
+import json
+from datetime import datetime
+from itertools import islice
+from unittest.mock import patch
+from analytics import ExpenseStats
+from ledger import (Ledger, LedgerCache, PARSED_SIZE_FACTOR, PartitionedLedger,
+                    SQLiteLedger, day_bounds, index_path_for, journal_path_for, ledger_lock,
+                    migrate_to_partitions, migrate_to_sqlite, read_version)
+from Multithreading_Multiprocessing import BackgroundTasks, WriteBehind, parallel_analyze, shutdown_report_pool
+
+
+@pytest.fixture
+def ledger_path(tmp_path):
+    path = tmp_path / "expenses.json"
+    with open(path, "w") as file:
+        json.dump({"budget_info": {"current_budget": 1000},
+                   "Lunch": {"amount": 10, "category": "Food",
+                             "date": "01-06-2025", "description": ""}}, file)
+    return path
+
+
+def test_journal_commit_appends_without_rewriting_snapshot(ledger_path):
+    snapshot_before = ledger_path.read_text()
+    ledger = Ledger(ledger_path, mode="journal")
+    ledger.commit(puts={"Taxi": {"amount": 25, "category": "Travel",
+                                 "date": "02-06-2025", "description": ""}})
+
+    assert ledger_path.read_text() == snapshot_before
+    lines = journal_path_for(ledger_path).read_text().splitlines()
+    assert len(lines) == 1
+    assert Ledger(ledger_path).load()["Taxi"]["amount"] == 25
+
+
+def test_journal_replays_deletes(ledger_path):
+    Ledger(ledger_path, mode="journal").commit(deletes=["Lunch"])
+    assert "Lunch" not in Ledger(ledger_path).load()
+
+
+def test_torn_last_journal_line_is_ignored(ledger_path):
+    journal_path = journal_path_for(ledger_path)
+    with open(journal_path, "w") as file:
+        file.write(json.dumps({"op": "put", "key": "Taxi", "value": {"amount": 5}}) + "\n")
+        file.write('{"op": "put", "key": "Bu')
+    data = Ledger(ledger_path).load()
+    assert data["Taxi"]["amount"] == 5
+    assert "Bus" not in data
+
+
+def test_compact_folds_journal_into_snapshot(ledger_path):
+    ledger = Ledger(ledger_path, mode="journal")
+    ledger.commit(puts={"budget_info": {"current_budget": 990}})
+    assert ledger.compact()
+
+    assert not journal_path_for(ledger_path).exists()
+    with open(ledger_path, "r") as file:
+        snapshot = json.load(file)
+    assert snapshot["budget_info"]["current_budget"] == 990
+    assert "Lunch" in snapshot
+
+
+def test_failed_compaction_keeps_the_journal(ledger_path):
+    ledger = Ledger(ledger_path, mode="journal")
+    ledger.commit(puts={"Taxi": {"amount": 5, "category": "Travel",
+                                 "date": "02-06-2025", "description": ""}})
+    background_fileIO = BackgroundTasks.background_fileIO
+    written = []
+
+    def failed_write(tasks, data=None):
+        return False if tasks.mode == "w" else background_fileIO(tasks, data)
+
+    def torn_write(tasks, data=None):
+        # The write reports success but the snapshot reads back empty
+        if tasks.mode == "w":
+            written.append(data)
+            return True
+        return {} if written else background_fileIO(tasks, data)
+
+    for fake in (failed_write, torn_write):
+        with patch.object(BackgroundTasks, "background_fileIO", autospec=True,
+                          side_effect=fake):
+            assert not ledger.compact()
+        assert journal_path_for(ledger_path).exists()
+        assert Ledger(ledger_path).load()["Taxi"]["amount"] == 5
+
+
+def test_snapshot_commit_drops_stale_journal(ledger_path):
+    Ledger(ledger_path, mode="journal").commit(
+        puts={"Taxi": {"amount": 5}})
+    Ledger(ledger_path, mode="snapshot").commit()
+    assert not journal_path_for(ledger_path).exists()
+    assert Ledger(ledger_path).load()["Taxi"]["amount"] == 5
+
+
+def test_migrate_to_sqlite_keeps_ledger_contents(ledger_path):
+    assert migrate_to_sqlite(ledger_path) == 1
+    assert SQLiteLedger(ledger_path).load() == Ledger(ledger_path).load()
+
+
+def test_sqlite_commit_and_get(ledger_path):
+    ledger = SQLiteLedger(ledger_path)
+    ledger.commit(puts={"Taxi": {"amount": 25, "category": "Travel",
+                                 "date": "02-06-2025", "description": ""},
+                        "budget_info": {"current_budget": 975}})
+    assert ledger.get("Taxi")["amount"] == 25
+    assert ledger.get("budget_info") == {"current_budget": 975}
+    ledger.commit(deletes=["Taxi"])
+    assert ledger.get("Taxi") is None
+
+
+@pytest.mark.parametrize("backend", [Ledger, SQLiteLedger, PartitionedLedger])
+def test_get_many_matches_get(ledger_path, backend):
+    three_month_ledger(ledger_path)
+    migrate_to_sqlite(ledger_path)
+    migrate_to_partitions(ledger_path)
+    ledger = backend(ledger_path)
+    names = [name for name, _ in islice(ledger.items(), 0, None, 2)]
+    found = ledger.get_many(names + ["missing", "budget_info"])
+    assert found == {name: ledger.get(name) for name in names}
+
+
+def test_sqlite_schema_is_created_once(ledger_path):
+    migrate_to_sqlite(ledger_path)
+    SQLiteLedger(ledger_path).count()
+    # Running the schema script again would fail
+    with patch("ledger.SQLITE_SCHEMA", "not sql"):
+        ledger = SQLiteLedger(ledger_path)
+        assert ledger.get("Lunch")["amount"] == 10
+        assert list(ledger.get_many(["Lunch"])) == ["Lunch"]
+
+
+@pytest.mark.parametrize("category", [None, "Food", "Travel"])
+def test_sqlite_query_matches_json_query(ledger_path, category):
+    json_ledger = Ledger(ledger_path)
+    json_ledger.commit(puts={
+        "Taxi": {"amount": 25, "category": "Travel", "date": "02-06-2025", "description": ""},
+        "Dinner": {"amount": 40, "category": "Food", "date": "30-06-2025", "description": ""},
+        "Old": {"amount": 99, "category": "Food", "date": "01-01-2024", "description": ""}})
+    migrate_to_sqlite(ledger_path)
+
+    start_date, end_date = datetime(2025, 5, 31, 12, 30), datetime(2025, 6, 30, 9)
+    expected = json_ledger.query(start_date, end_date, category)
+    assert SQLiteLedger(ledger_path).query(
+        start_date, end_date, category) == expected
+
+
+def test_cache_serves_repeated_loads_without_reparsing(ledger_path):
+    cache = LedgerCache()
+    with patch("ledger.ledger_cache", cache):
+        first = Ledger(ledger_path).load()
+        second = Ledger(ledger_path).load()
+    assert first is second
+    assert cache.hits == 1 and cache.misses == 1
+
+
+def test_cache_revalidates_after_external_write(ledger_path):
+    cache = LedgerCache()
+    with patch("ledger.ledger_cache", cache):
+        Ledger(ledger_path).load()
+        with open(ledger_path, "w") as file:
+            json.dump({"Taxi": {"amount": 5}}, file)
+        assert Ledger(ledger_path).load() == {"Taxi": {"amount": 5}}
+
+
+@pytest.mark.parametrize("mode", ["snapshot", "journal"])
+def test_cache_is_updated_in_place_on_commit(ledger_path, mode):
+    cache = LedgerCache()
+    with patch("ledger.ledger_cache", cache):
+        before = Ledger(ledger_path).load()
+        Ledger(ledger_path, mode=mode).commit(
+            puts={"Taxi": {"amount": 5}}, deletes=["Lunch"])
+        misses = cache.misses
+        after = Ledger(ledger_path).load()
+    assert cache.misses == misses
+    assert "Taxi" in after and "Lunch" not in after
+    # Readers holding the previous version are not affected
+    assert "Lunch" in before
+
+
+def test_cache_evicts_least_recently_used(tmp_path):
+    cache = LedgerCache(max_bytes=2 * 100 * PARSED_SIZE_FACTOR)
+    for name in ("a", "b", "c"):
+        cache.put(name, ((1, 100),), {name: 1})
+    assert cache.get("a", ((1, 100),)) is None
+    assert cache.get("c", ((1, 100),)) == {"c": 1}
+    assert cache.stats()["bytes"] <= cache.max_bytes
+
+
+def test_date_index_is_saved_and_reused(ledger_path):
+    cache = LedgerCache()
+    with patch("ledger.ledger_cache", cache):
+        Ledger(ledger_path).date_index()
+    assert index_path_for(ledger_path).exists()
+
+    # A new process (empty cache) orders the ledger without parsing dates
+    with patch("ledger.ledger_cache", LedgerCache()), \
+            patch("expense_table.to_day", side_effect=AssertionError):
+        assert Ledger(ledger_path).date_index().names == ["Lunch"]
+
+
+@pytest.mark.parametrize("mode", ["snapshot", "journal"])
+def test_date_index_follows_commits(ledger_path, mode):
+    with patch("ledger.ledger_cache", LedgerCache()):
+        ledger = Ledger(ledger_path, mode=mode)
+        ledger.date_index()
+        ledger.commit(puts={"Early": {"amount": 1, "category": "Food",
+                                      "date": "01-05-2025", "description": ""}},
+                      deletes=["Lunch"])
+        assert Ledger(ledger_path).date_index().names == ["Early"]
+
+    # The saved index plus the journal give the same answer from cold
+    with patch("ledger.ledger_cache", LedgerCache()):
+        assert Ledger(ledger_path).date_index().names == ["Early"]
+
+
+def three_month_ledger(ledger_path):
+    Ledger(ledger_path).commit(puts={
+        "Taxi": {"amount": 25, "category": "Travel", "date": "02-06-2025", "description": ""},
+        "Dinner": {"amount": 40, "category": "Food", "date": "30-06-2025", "description": ""},
+        "Rent": {"amount": 500, "category": "Rent", "date": "01-07-2025", "description": ""},
+        "Bus": {"amount": 3, "category": "Travel", "date": "15-07-2025", "description": ""},
+        "Old": {"amount": 99, "category": "Food", "date": "01-01-2024", "description": ""}})
+    migrate_to_partitions(ledger_path)
+    return PartitionedLedger(ledger_path)
+
+
+def test_partitions_are_split_by_month(ledger_path):
+    ledger = three_month_ledger(ledger_path)
+    assert sorted(path.name for path in ledger.dir.glob("20*.json")) == [
+        "2024-01.json", "2025-06.json", "2025-07.json"]
+    manifest = ledger.manifest()
+    assert manifest["partitions"]["2025-06"]["count"] == 3
+    assert manifest["partitions"]["2025-06"]["category_totals"] == {"Food": 50, "Travel": 25}
+    assert ledger.load() == Ledger(ledger_path).load()
+    assert ledger.count() == 6
+
+
+@pytest.mark.parametrize("category", [None, "Food", "Travel"])
+def test_partitioned_query_matches_json_query(ledger_path, category):
+    ledger = three_month_ledger(ledger_path)
+    start_date, end_date = datetime(2025, 5, 31, 12, 30), datetime(2025, 7, 10, 9)
+    expected = Ledger(ledger_path).query(start_date, end_date, category)
+    assert ledger.query(start_date, end_date, category) == expected
+    assert ledger.total(start_date, end_date, category) == expected[1]
+
+
+def test_partitioned_query_reads_only_overlapping_months(ledger_path):
+    ledger = three_month_ledger(ledger_path)
+    with patch.object(PartitionedLedger, "partition", autospec=True,
+                      side_effect=PartitionedLedger.partition) as partition:
+        ledger.query(datetime(2025, 7, 1), datetime(2025, 7, 31, 23, 59))
+    assert [call.args[1] for call in partition.call_args_list] == ["2025-07"]
+
+
+def test_partitioned_total_uses_manifest_for_covered_months(ledger_path):
+    ledger = three_month_ledger(ledger_path)
+    with patch.object(PartitionedLedger, "partition", side_effect=AssertionError):
+        assert ledger.total(datetime(2024, 1, 1), datetime(2025, 7, 31, 23, 59)) == 677
+        assert ledger.total(datetime(2025, 6, 1), datetime(2025, 6, 30, 23, 59), "Food") == 50
+
+
+def test_partitioned_commit_rewrites_only_touched_month(ledger_path):
+    ledger = three_month_ledger(ledger_path)
+    untouched = (ledger.dir / "2024-01.json").stat().st_mtime_ns
+    ledger.commit(puts={"Coffee": {"amount": 4, "category": "Food",
+                                   "date": "16-07-2025", "description": ""},
+                        "budget_info": {"current_budget": 900}})
+
+    assert (ledger.dir / "2024-01.json").stat().st_mtime_ns == untouched
+    cold = PartitionedLedger(ledger_path)
+    with patch("ledger.ledger_cache", LedgerCache()):
+        assert cold.get("Coffee")["amount"] == 4
+        assert cold.get("budget_info") == {"current_budget": 900}
+        assert cold.manifest()["partitions"]["2025-07"]["total"] == 507
+
+
+def test_partitioned_commit_moves_and_deletes(ledger_path):
+    ledger = three_month_ledger(ledger_path)
+    ledger.commit(puts={"Bus": {"amount": 3, "category": "Travel",
+                                "date": "01-01-2024", "description": ""}},
+                  deletes=["Rent"])
+    with patch("ledger.ledger_cache", LedgerCache()):
+        cold = PartitionedLedger(ledger_path)
+        assert "2025-07" not in cold.manifest()["partitions"]
+        assert not (cold.dir / "2025-07.json").exists()
+        assert cold.names()["Bus"] == "2024-01"
+        assert cold.get("Rent") is None
+
+
+def test_partitioned_items_page_in_date_order(ledger_path):
+    ledger = three_month_ledger(ledger_path)
+    names = [name for name, _ in ledger.items(sort="date")]
+    assert names == ["Old", "Lunch", "Taxi", "Dinner", "Rent", "Bus"]
+    assert [name for name, _ in ledger.items(2, 2, sort="date")] == ["Taxi", "Dinner"]
+    assert [name for name, _ in ledger.items(1, 2, sort="-date")] == ["Rent", "Dinner"]
+
+
+@pytest.mark.parametrize("backend", [Ledger, SQLiteLedger, PartitionedLedger])
+def test_every_commit_bumps_the_version(ledger_path, backend):
+    ledger = backend(ledger_path)
+    before = ledger.version()
+    ledger.commit(puts={"Taxi": {"amount": 25, "category": "Travel",
+                                 "date": "02-06-2025", "description": ""}})
+    ledger.commit(deletes=["Taxi"])
+    assert ledger.version() == read_version(ledger_path) == before + 2
+
+
+@pytest.mark.parametrize("category", [None, "Food"])
+def test_breakdown_matches_across_backends(ledger_path, category):
+    three_month_ledger(ledger_path)
+    migrate_to_sqlite(ledger_path)
+    start_date, end_date = datetime(2025, 6, 1), datetime(2025, 7, 31, 23, 59)
+    expected = Ledger(ledger_path).breakdown(start_date, end_date, category)
+    assert expected["by_day"]["30-06-2025"] == 40
+    assert sum(expected["by_category"].values()) == sum(expected["by_day"].values())
+    for backend in (SQLiteLedger, PartitionedLedger):
+        assert backend(ledger_path).breakdown(start_date, end_date, category) == expected
+
+
+@pytest.mark.parametrize("category", [None, "Food"])
+def test_analyze_matches_across_backends(ledger_path, category):
+    three_month_ledger(ledger_path)
+    migrate_to_sqlite(ledger_path)
+    start_date, end_date = datetime(2025, 5, 1), datetime(2025, 7, 31, 23, 59)
+    expected = Ledger(ledger_path).analyze(start_date, end_date, category, top_n=2).to_dict()
+    assert expected["total_expense"] == sum(expected["by_category"].values())
+    assert len(expected["top_expenses"]) == min(2, expected["count"])
+    for backend in (SQLiteLedger, PartitionedLedger):
+        assert backend(ledger_path).analyze(
+            start_date, end_date, category, top_n=2).to_dict() == expected
+
+
+@pytest.mark.parametrize("backend", [Ledger, SQLiteLedger, PartitionedLedger])
+def test_chunks_cover_the_window(ledger_path, backend):
+    three_month_ledger(ledger_path)
+    migrate_to_sqlite(ledger_path)
+    spans = backend(ledger_path).chunks(datetime(2024, 1, 1), datetime(2025, 7, 31), 2)
+    assert [span[0] for span in spans] == sorted(span[0] for span in spans)
+    assert all(first <= last for first, last in spans)
+    # Old, Lunch and Taxi, Dinner, Rent and Bus
+    sizes = [Ledger(ledger_path).analyze(*day_bounds(*span)).count for span in spans]
+    assert sum(sizes) == 6
+    assert max(sizes) <= 2
+
+
+@pytest.mark.parametrize("backend", [Ledger, SQLiteLedger, PartitionedLedger])
+def test_query_and_stream_build_stats_in_the_same_pass(ledger_path, backend):
+    three_month_ledger(ledger_path)
+    migrate_to_sqlite(ledger_path)
+    ledger = backend(ledger_path)
+    window = datetime(2024, 1, 1), datetime(2025, 7, 31, 23, 59), "Food"
+    expected = ledger.analyze(*window, top_n=3).to_dict()
+
+    stats = ExpenseStats(3)
+    expenses, total_expense, _ = ledger.query(*window, stats=stats)
+    assert stats.to_dict() == expected
+    assert stats.total == total_expense
+    stats = ExpenseStats(3)
+    rows, _ = ledger.stream(*window, stats=stats)
+    assert [name for name, _ in rows] == list(expenses)
+    assert stats.to_dict() == expected
+
+
+@pytest.mark.parametrize("backend", [Ledger, SQLiteLedger, PartitionedLedger])
+def test_parallel_analyze_matches_serial(ledger_path, backend):
+    three_month_ledger(ledger_path)
+    migrate_to_sqlite(ledger_path)
+    start_date, end_date = datetime(2024, 1, 1), datetime(2025, 7, 31)
+    expected = backend(ledger_path).analyze(start_date, end_date, top_n=3).to_dict()
+    mode = {Ledger: "snapshot", SQLiteLedger: "sqlite", PartitionedLedger: "partitioned"}
+    try:
+        stats = parallel_analyze(ledger_path, start_date, end_date, top_n=3,
+                                 chunk_rows=1, workers=2, mode=mode[backend])
+    finally:
+        shutdown_report_pool()
+    assert stats.to_dict() == expected
+
+
+@pytest.mark.parametrize("mode", ["snapshot", "journal"])
+def test_parallel_analyze_scans_json_ledgers_locally(ledger_path, mode):
+    three_month_ledger(ledger_path)
+    start_date, end_date = datetime(2024, 1, 1), datetime(2025, 7, 31)
+    expected = Ledger(ledger_path, mode).analyze(start_date, end_date, top_n=3).to_dict()
+    # Each worker would parse the whole expenses.json for its chunk
+    with patch("Multithreading_Multiprocessing.get_report_pool", side_effect=AssertionError):
+        stats = parallel_analyze(ledger_path, start_date, end_date, top_n=3,
+                                 chunk_rows=1, workers=2, mode=mode)
+    assert stats.to_dict() == expected
+
+
+def test_write_behind_commits_keep_caches_consistent(ledger_path):
+    buffer = WriteBehind(delay=60, max_pending=1000)
+    june = datetime(2025, 6, 1), datetime(2025, 6, 30, 23, 59)
+    with patch("Multithreading_Multiprocessing.write_behind", buffer), \
+            patch("Multithreading_Multiprocessing.WRITE_BEHIND", True):
+        ledger = Ledger(ledger_path)
+        assert ledger.query(*june)[1] == 10
+        for i in range(5):
+            ledger.commit(puts={f"Taxi_{i}": {"amount": 5, "category": "Travel",
+                                              "date": "02-06-2025", "description": ""}})
+            # Cached tables and rollups follow each commit before anything is flushed
+            assert ledger.query(*june)[1] == 10 + 5 * (i + 1)
+        assert list(json.loads(ledger_path.read_text())) == ["budget_info", "Lunch"]
+
+        token = ledger.token()
+        assert buffer.flush()
+        # Caches keyed on the token stay valid across the flush
+        assert ledger.token() == token
+        assert "Taxi_4" in json.loads(ledger_path.read_text())
+        assert read_version(ledger_path) == ledger.version()
+    assert buffer.flushed < buffer.writes
+
+
+def test_ledger_lock_flushes_pending_writes_before_release(ledger_path, tmp_path_factory):
+    buffer = WriteBehind(delay=60, max_pending=1000)
+    elsewhere = tmp_path_factory.mktemp("other") / "notes.json"
+    elsewhere.write_text("{}")
+    with patch("Multithreading_Multiprocessing.write_behind", buffer), \
+            patch("Multithreading_Multiprocessing.WRITE_BEHIND", True):
+        BackgroundTasks(elsewhere, "w").background_fileIO({"n": 1})
+        with ledger_lock(ledger_path):
+            Ledger(ledger_path).commit(puts={"Taxi": {"amount": 5, "category": "Travel",
+                                                      "date": "02-06-2025", "description": ""}})
+            assert "Taxi" not in json.loads(ledger_path.read_text())
+        # The next process to take the lock reads the commit from disk
+        assert "Taxi" in json.loads(ledger_path.read_text())
+        assert read_version(ledger_path) == Ledger(ledger_path).version()
+        # Files outside the ledger's directory keep waiting
+        assert buffer.pending_text(elsewhere) is not None
+        assert buffer.flush()
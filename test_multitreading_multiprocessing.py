@@ -1,8 +1,17 @@
 import pytest
 import logging
-from Multithreading_Multiprocessing import BackgroundTasks
+import shutil
+import time
+from datetime import datetime
+from pathlib import Path
+from unittest.mock import patch
+from Multithreading_Multiprocessing import (BackgroundTasks, WriteBehind, get_io_pool,
+                                            read_batch_state, run_batch_reports)
 import json
 
+BASE_DIR = Path(__file__).resolve().parent
+BATCH_USERS = [f"batch_user_{i}" for i in range(4)]
+
 
 @pytest.fixture
 def background_tasks_write():
@@ -37,3 +46,138 @@ def test_background_fileIO(background_tasks_write, background_tasks_read):
     time.sleep(1)  # Wait for the thread to finish
     loaded_data = background_tasks_read.read_from_file()
     assert loaded_data == data
+
+
+def test_submitted_operations_overlap(tmp_path):
+    writes = [BackgroundTasks(tmp_path / f"file_{i}.json", "w").submit_write({"i": i})
+              for i in range(8)]
+    assert [future.result(timeout=5) for future in writes] == [True] * 8
+    reads = [BackgroundTasks(tmp_path / f"file_{i}.json", "r").submit_read() for i in range(8)]
+    assert [future.result(timeout=5) for future in reads] == [{"i": i} for i in range(8)]
+    # Every operation ran on the one shared pool
+    assert get_io_pool() is get_io_pool()
+
+
+def test_failed_write_resolves_to_false(tmp_path):
+    (tmp_path / "taken").write_text("")
+    future = BackgroundTasks(tmp_path / "taken" / "file.json", "w").submit_write({})
+    assert future.result(timeout=5) is False
+
+
+
+@pytest.fixture
+def write_behind():
+    buffer = WriteBehind(delay=60, max_pending=1000)
+    with patch("Multithreading_Multiprocessing.write_behind", buffer):
+        yield buffer
+
+
+def test_write_behind_coalesces_and_reads_see_pending_writes(tmp_path, write_behind):
+    file_path = tmp_path / "expenses.json"
+    file_path.write_text("{}")
+    acks = [BackgroundTasks(file_path, "w", write_behind=True).background_fileIO({"n": i})
+            for i in range(20)]
+    assert json.loads(file_path.read_text()) == {}
+    assert BackgroundTasks(file_path, "r").background_fileIO() == {"n": 19}
+    assert not any(ack.done() for ack in acks)
+
+    assert BackgroundTasks(file_path).flush()
+    assert [ack.result(timeout=1) for ack in acks] == [True] * 20
+    assert json.loads(file_path.read_text()) == {"n": 19}
+    assert (write_behind.writes, write_behind.flushed) == (20, 1)
+
+
+def test_write_behind_flushes_after_delay_or_max_pending(tmp_path, write_behind):
+    paths = [tmp_path / f"file_{i}.json" for i in range(3)]
+    for path in paths:
+        path.write_text("{}")
+    write_behind.max_pending = 3
+    acks = [BackgroundTasks(path, "w", write_behind=True).submit_write({"ok": True})
+            for path in paths]
+    assert [ack.result(timeout=5) for ack in acks] == [True] * 3
+
+    write_behind.delay = 0.01
+    ack = BackgroundTasks(paths[0], "w", write_behind=True).submit_write({"late": True})
+    assert ack.result(timeout=5)
+    assert json.loads(paths[0].read_text()) == {"late": True}
+
+
+def test_direct_write_supersedes_pending_write(tmp_path, write_behind):
+    file_path = tmp_path / "expenses.json"
+    file_path.write_text("{}")
+    pending = BackgroundTasks(file_path, "w", write_behind=True).background_fileIO({"old": 1})
+    assert BackgroundTasks(file_path, "w", write_behind=False).background_fileIO({"new": 1})
+    assert pending.result(timeout=1)
+    write_behind.flush()
+    assert json.loads(file_path.read_text()) == {"new": 1}
+
+
+def test_write_acknowledges_failure(tmp_path):
+    (tmp_path / "taken").write_text("")
+    tasks = BackgroundTasks(tmp_path / "taken" / "file.json", "w", write_behind=False)
+    assert tasks.background_fileIO({}) is False
+
+
+@pytest.fixture
+def batch_users():
+    today = datetime.now().strftime("%d-%m-%Y")
+    for i, username in enumerate(BATCH_USERS):
+        user_dir = BASE_DIR / "users" / username
+        user_dir.mkdir(parents=True, exist_ok=True)
+        with open(user_dir / "setup.json", "w") as file:
+            json.dump({"budget": 1000, "income": 5000, "default_currency": "PKR"}, file)
+        with open(user_dir / "expenses.json", "w") as file:
+            json.dump({"budget_info": {},
+                       "Lunch": {"amount": 10 * (i + 1), "category": "Food",
+                                 "date": today, "description": ""}}, file)
+    yield BATCH_USERS
+    for username in BATCH_USERS:
+        shutil.rmtree(BASE_DIR / "users" / username, ignore_errors=True)
+
+
+def slow_job(username, time_period, category=None):
+    if username == BATCH_USERS[1]:
+        time.sleep(30)
+    return "ok", 0.0
+
+
+def test_batch_reports_write_every_report_and_resume(batch_users, tmp_path):
+    state_path = tmp_path / "state.jsonl"
+    summary = run_batch_reports(batch_users[:2], "cm", workers=2, state_path=state_path)
+    assert (summary["ok"], summary["failed"], summary["resumed"]) == (2, 0, 0)
+    for i, username in enumerate(batch_users[:2]):
+        with open(BASE_DIR / "users" / username / "detailed_report_cm.json") as file:
+            assert json.load(file)["total_expense"] == 10 * (i + 1)
+
+    # A rerun only reports the users the first one didn't finish
+    summary = run_batch_reports(batch_users, "cm", workers=2, state_path=state_path)
+    assert (summary["ok"], summary["resumed"]) == (2, 2)
+    assert set(read_batch_state(state_path)) == set(batch_users)
+    assert summary["users_per_sec"] > 0
+    assert len(summary["slowest"]) == 2
+
+
+def test_batch_reports_fail_errors_and_retry_them(batch_users, tmp_path):
+    users_dir = BASE_DIR / "users"
+    (users_dir / batch_users[0] / "setup.json").unlink()
+    (users_dir / batch_users[1] / "expenses.json").write_text("{not json")
+    (users_dir / batch_users[2] / "expenses.json").unlink()
+    state_path = tmp_path / "state.jsonl"
+    summary = run_batch_reports(batch_users, "cm", workers=2, state_path=state_path)
+    assert (summary["ok"], summary["skipped"], summary["failed"]) == (1, 1, 2)
+    assert sorted(result["username"] for result in summary["failures"]) == batch_users[:2]
+    assert set(read_batch_state(state_path)) == set(batch_users[2:])
+
+    # Only the failed users are reported again
+    (users_dir / batch_users[1] / "expenses.json").write_text("{}")
+    summary = run_batch_reports(batch_users, "cm", workers=2, state_path=state_path)
+    assert (summary["skipped"], summary["failed"], summary["resumed"]) == (1, 1, 2)
+
+
+def test_batch_job_timeout_fails_only_that_user(batch_users):
+    started = time.monotonic()
+    summary = run_batch_reports(batch_users, "cm", workers=2, timeout=1, job=slow_job)
+    assert time.monotonic() - started < 10
+    assert summary["ok"] == 3
+    assert [(result["username"], result["status"]) for result in summary["failures"]] == [
+        (BATCH_USERS[1], "timeout")]
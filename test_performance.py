@@ -2,15 +2,29 @@ import pytest
 import time
 import json
 import psutil
+import tracemalloc
+import multiprocessing
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread
 import os
 from pathlib import Path
 from transaction import Expense
-from report import Report
+from report import Report, ReportCache
 from setup import Setup
-from api import API
+import api as api_module
+from api import API, RateCache, RateEngine, fetch_json
+from app_logging import (LOG_FORMAT, LogPipeline, LogSampler, RoutingQueueHandler, UserLogFiles,
+                         UserFileHandler, get_logger, log_category)
 from user_profile import user_profile
-from Multithreading_Multiprocessing import BackgroundTasks
+from Multithreading_Multiprocessing import (BackgroundTasks, WriteBehind, flush_writes,
+                                            parallel_analyze, shutdown_report_pool)
+from ledger import Ledger, migrate_to_partitions, migrate_to_sqlite
+from expense_table import np
+from datetime import datetime, timedelta
 from unittest.mock import patch
+import logging
+from logging.handlers import RotatingFileHandler
 
 # Base directory for test data
 BASE_DIR = Path(__file__).resolve().parent
@@ -19,6 +33,11 @@ TEST_USER_DIR = BASE_DIR / "users" / TEST_USER
 TEST_USER_2 = "test_user_2"
 TEST_USER_2_DIR = BASE_DIR / "users" / TEST_USER_2
 
+# 100k and 1M row benchmarks take minutes to set up; opt in explicitly
+large_benchmark = pytest.mark.skipif(
+    not os.getenv("RUN_LARGE_BENCHMARKS"), reason="set RUN_LARGE_BENCHMARKS=1 to run")
+needs_numpy = pytest.mark.skipif(np is None, reason="NumPy is not installed")
+
 
 @pytest.fixture(autouse=True)
 def setup_and_teardown():
@@ -163,6 +182,82 @@ def test_api_performance(benchmark):
         assert end_memory - start_memory < 5  # Memory increase < 5MB
 
 
+@pytest.mark.parametrize("source", ["network", "disk", "memory"])
+def test_exchange_rate_cache_latency(rate_server, source, benchmark):
+    """One get_exchange_rate() against the local stub provider: fetched every
+    time, read from the rate file by a fresh cache, or a memory cache hit."""
+    api = API(base_currency="USD")
+    if source == "network":
+        # Every table is already out of date when it arrives
+        rate_server.ttl = -1
+    api.get_exchange_rate("PKR")
+
+    def lookup():
+        if source == "disk":
+            api_module.rate_cache = RateCache(api_module.rate_cache.path)
+        return api.get_exchange_rate("PKR")
+
+    assert benchmark(lookup)[0] == 280.0
+    benchmark.extra_info["us_per_lookup"] = benchmark.stats.stats.mean * 1e6
+    if source == "memory":
+        assert len(rate_server.requests) == 1
+        assert benchmark.stats.stats.mean < 0.001
+
+
+@pytest.mark.parametrize("engine", ["per_row", "convert_many"])
+def test_bulk_currency_conversion_performance(rate_server, engine, benchmark):
+    """10k amounts in four currencies converted to PKR: a rate lookup per
+    row against one convert_many() call on the pivot table."""
+    currencies = ["USD", "EUR", "GBP", "JPY"]
+    amounts = [float(i % 500) + 0.25 for i in range(10_000)]
+    row_currencies = [currencies[i % 4] for i in range(10_000)]
+
+    def per_row():
+        return [round(amount * API(base_currency=currency).get_exchange_rate("PKR")[0], 2)
+                for amount, currency in zip(amounts, row_currencies)]
+
+    def convert_many():
+        return RateEngine().convert_many(amounts, row_currencies, "PKR")
+
+    converted = benchmark(per_row if engine == "per_row" else convert_many)
+    assert converted == pytest.approx(RateEngine().convert_many(amounts, row_currencies, "PKR"))
+    # Every pair came from the one pivot table
+    assert len(rate_server.requests) == 1
+
+
+@pytest.mark.parametrize("client", ["requests_get", "pooled_session", "single_flight"])
+def test_concurrent_rate_fetch_latency(rate_server, client, benchmark):
+    """16 callers asking for the USD table at once, with the stub provider
+    taking 20 ms per request: a bare requests.get() each (a new connection
+    per call), the pooled session each, or get_rates() sharing one request."""
+    callers = 16
+    rate_server.delay = 0.02
+    # Every table is already out of date when it arrives
+    rate_server.ttl = -1
+    url = f"{api_module.API_URL}/key/latest/USD"
+
+    def call(_):
+        if client == "requests_get":
+            return requests.get(url, timeout=10).json()["conversion_rates"]["PKR"]
+        if client == "pooled_session":
+            return fetch_json(url)["conversion_rates"]["PKR"]
+        return API(base_currency="USD").get_exchange_rate("PKR")[0]
+
+    with ThreadPoolExecutor(callers) as pool:
+        list(pool.map(call, range(callers)))
+        rate_server.requests.clear()
+        results = benchmark.pedantic(lambda: list(pool.map(call, range(callers))),
+                                     rounds=10, iterations=1)
+    assert results == [280.0] * callers
+    requests_per_round = len(rate_server.requests) / 10
+    benchmark.extra_info["requests_per_round"] = requests_per_round
+    benchmark.extra_info["ms_per_round"] = benchmark.stats.stats.mean * 1e3
+    if client == "single_flight":
+        assert requests_per_round < callers / 2
+    else:
+        assert requests_per_round == callers
+
+
 @pytest.mark.parametrize("num_entries", [10, 100])
 def test_user_profile_performance(num_entries, benchmark):
     """Test performance of loading user profile with varying data sizes."""
@@ -187,3 +282,443 @@ def test_user_profile_performance(num_entries, benchmark):
 
     assert benchmark.stats.stats.mean < 0.1  # Profile loading < 100ms
     assert end_memory - start_memory < 10  # Memory increase < 10MB
+
+
+def write_ledger(user_dir, num_expenses):
+    """Write expenses.json and setup.json with expenses spread over two years."""
+    today = datetime.now()
+    expenses = {"budget_info": {"month": today.strftime("%Y-%m"), "initial_budget": 10000,
+                                "current_budget": 10000, "income": 50000}}
+    for i in range(num_expenses):
+        expenses[f"Expense_{i}"] = {
+            "amount": 100 * (i % 5 + 1),
+            "category": "Food" if i % 2 == 0 else "Travel",
+            "date": (today - timedelta(days=i % 730)).strftime("%d-%m-%Y"),
+            "description": "Test"
+        }
+    with open(user_dir / "expenses.json", "w") as f:
+        json.dump(expenses, f)
+    with open(user_dir / "setup.json", "w") as f:
+        json.dump({"budget": 10000, "income": 50000,
+                  "default_currency": "PKR"}, f)
+
+
+@pytest.mark.parametrize("num_expenses", [
+    1000,
+    pytest.param(100_000, marks=large_benchmark),
+    pytest.param(1_000_000, marks=large_benchmark),
+])
+@pytest.mark.parametrize("storage_mode", ["snapshot", "sqlite"])
+def test_storage_backend_report_performance(storage_mode, num_expenses, benchmark):
+    """Compare monthly Food reports on the JSON and SQLite backends."""
+    write_ledger(TEST_USER_DIR, num_expenses)
+    if storage_mode == "sqlite":
+        migrate_to_sqlite(TEST_USER_DIR / "expenses.json")
+
+    report = Report("m", "Food", TEST_USER)
+    # Every round reads the backend rather than the report cache
+    cache = ReportCache(max_entries=0)
+    with patch("ledger.STORAGE_MODE", storage_mode), patch("report.report_cache", cache):
+        result = benchmark(report.brief_generate_report)
+
+    assert result is not None
+    assert result["total_expense"] > 0
+    assert cache.hits == cache.disk_hits == 0
+
+
+@pytest.mark.parametrize("num_expenses", [10_000])
+def test_bulk_import_performance(num_expenses, benchmark):
+    """Test throughput of importing expenses with add_expenses_bulk."""
+    write_ledger(TEST_USER_DIR, 0)
+    rows = [{"name": f"Import_{i}", "amount": 10, "category": "Food",
+             "date": "01-06-2025"} for i in range(num_expenses)]
+
+    start_memory = psutil.Process().memory_info().rss / 1024 / 1024
+    summary = benchmark.pedantic(
+        Expense.add_expenses_bulk, args=(TEST_USER, rows), rounds=3)
+    end_memory = psutil.Process().memory_info().rss / 1024 / 1024
+
+    assert summary["added"] == num_expenses
+    assert summary["rows_per_sec"] > 10_000
+    assert end_memory - start_memory < 50  # Memory increase < 50MB
+
+
+@pytest.mark.parametrize("num_expenses", [1000])
+def test_iter_expenses_paging_performance(num_expenses, benchmark):
+    """Test paging through every expense ten at a time."""
+    write_ledger(TEST_USER_DIR, num_expenses)
+
+    def page_through():
+        seen = 0
+        for offset in range(0, num_expenses, 10):
+            seen += len(list(Expense.iter_expenses(TEST_USER, offset, 10)))
+        return seen
+
+    assert benchmark(page_through) == num_expenses
+    assert benchmark.stats.stats.mean < 0.5  # Whole ledger paged < 500ms
+
+
+@pytest.mark.parametrize("num_expenses", [
+    1000,
+    pytest.param(100_000, marks=large_benchmark),
+])
+@pytest.mark.parametrize("threshold,engine", [(float("inf"), "in-process"), (0, "pool")])
+def test_report_engine_performance(num_expenses, threshold, engine, benchmark):
+    """Compare brief+detailed reports in-process and on the persistent worker pool."""
+    write_ledger(TEST_USER_DIR, num_expenses)
+    report = Report("m", None, TEST_USER)
+    cache = ReportCache(max_entries=0)
+    # Workers forked under the patch scan the ledger every round too
+    shutdown_report_pool()
+    try:
+        with patch("Multithreading_Multiprocessing.REPORT_INPROCESS_BYTES", threshold), \
+                patch("report.report_cache", cache):
+            results = benchmark(BackgroundTasks().generate_reports, report)
+    finally:
+        shutdown_report_pool()
+
+    assert results["brief"]["total_expense"] == results["detailed"]["total_expense"]
+    assert cache.hits == cache.disk_hits == 0
+    assert benchmark.stats.stats.mean < 5.0  # Both reports < 5s
+
+
+@pytest.mark.parametrize("num_expenses", [
+    10_000,
+    pytest.param(1_000_000, marks=large_benchmark),
+])
+@pytest.mark.parametrize("cached", [False, True])
+def test_report_cache_performance(num_expenses, cached, benchmark):
+    """Compare yearly reports with and without the report cache."""
+    write_ledger(TEST_USER_DIR, num_expenses)
+    report = Report("y", None, TEST_USER)
+    cache = ReportCache(max_entries=128 if cached else 0)
+    with patch("report.report_cache", cache):
+        result = benchmark(report.brief_generate_report)
+
+    assert result["total_expense"] > 0
+    if cached:
+        assert cache.hits > 0
+
+
+@pytest.mark.parametrize("num_expenses", [
+    10_000,
+    pytest.param(1_000_000, marks=large_benchmark),
+])
+def test_rollup_summary_performance(num_expenses, benchmark):
+    """Yearly total and remaining budget answered from the rollups."""
+    write_ledger(TEST_USER_DIR, num_expenses)
+    report = Report("y", None, TEST_USER)
+    expected = report.brief_generate_report()["total_expense"]
+
+    with patch("report.report_cache", ReportCache(max_entries=0)):
+        summary = benchmark(report.summary)
+
+    assert summary["total_expense"] == pytest.approx(expected)
+    assert benchmark.stats.stats.mean < 0.01  # Served from rollups < 10ms
+
+
+@pytest.mark.parametrize("num_expenses", [
+    10_000,
+    pytest.param(100_000, marks=large_benchmark),
+    pytest.param(1_000_000, marks=large_benchmark),
+])
+@pytest.mark.parametrize("backend", ["python", pytest.param("auto", marks=needs_numpy)])
+def test_report_backend_performance(num_expenses, backend, benchmark):
+    """Compare the pure-Python and NumPy engines on a yearly total and breakdown."""
+    write_ledger(TEST_USER_DIR, num_expenses)
+    ledger = Ledger(TEST_USER_DIR / "expenses.json")
+    end_date = datetime.now()
+    start_date = end_date - timedelta(days=365)
+    ledger.table()  # Parse once; the benchmark measures the engine only
+
+    def yearly_breakdown():
+        ledger.breakdown(start_date, end_date, "Food")
+        return ledger.breakdown(start_date, end_date)
+
+    with patch("expense_table.REPORT_BACKEND", backend):
+        result = benchmark(yearly_breakdown)
+
+    assert len(result["by_day"]) >= 365
+    assert set(result["by_category"]) == {"Food", "Travel"}
+
+
+@pytest.mark.parametrize("num_expenses", [
+    10_000,
+    pytest.param(100_000, marks=large_benchmark),
+    pytest.param(1_000_000, marks=large_benchmark),
+])
+def test_report_analytics_performance(num_expenses, benchmark):
+    """Breakdowns, top-N and percentiles in one pass; peak memory stays flat."""
+    write_ledger(TEST_USER_DIR, num_expenses)
+    ledger = Ledger(TEST_USER_DIR / "expenses.json")
+    end_date = datetime.now()
+    start_date = end_date - timedelta(days=365)
+    ledger.table()
+
+    stats = benchmark(ledger.analyze, start_date, end_date)
+
+    tracemalloc.start()
+    ledger.analyze(start_date, end_date)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    benchmark.extra_info["peak_bytes"] = peak
+    assert stats.total == ledger.query(start_date, end_date)[1]
+    assert len(stats.top) == 5
+    assert peak < 1024 * 1024
+
+
+@pytest.mark.parametrize("num_expenses", [
+    20_000,
+    pytest.param(1_000_000, marks=large_benchmark),
+])
+@pytest.mark.parametrize("workers", [1, 2, 4])
+@pytest.mark.parametrize("storage_mode", ["sqlite", "partitioned"])
+@pytest.mark.parametrize("warm", [False, True])
+def test_parallel_analytics_scaling(num_expenses, workers, storage_mode, warm, tmp_path, benchmark):
+    """Chunked map-reduce analytics on 1..N worker processes, from a fresh
+    pool (cold) and from one whose workers already ran the same analysis."""
+    write_ledger(tmp_path, num_expenses)
+    file_path = tmp_path / "expenses.json"
+    if storage_mode == "sqlite":
+        migrate_to_sqlite(file_path)
+    else:
+        migrate_to_partitions(file_path)
+    end_date = datetime.now()
+    start_date = end_date - timedelta(days=365)
+
+    def run():
+        return parallel_analyze(file_path, start_date, end_date, chunk_rows=num_expenses // 16,
+                                workers=workers, mode=storage_mode)
+
+    try:
+        if warm:
+            run()
+            stats = benchmark(run)
+        else:
+            # Every round starts new workers with empty caches
+            stats = benchmark.pedantic(run, setup=shutdown_report_pool, rounds=5)
+    finally:
+        shutdown_report_pool()
+
+    benchmark.extra_info["cpus"] = os.cpu_count()
+    assert stats.total == pytest.approx(Ledger(file_path).query(start_date, end_date)[1])
+
+
+@pytest.mark.parametrize("num_expenses", [
+    10_000,
+    pytest.param(100_000, marks=large_benchmark),
+    pytest.param(1_000_000, marks=large_benchmark),
+])
+@pytest.mark.parametrize("streamed", [False, True])
+def test_detailed_report_write_memory(num_expenses, streamed, benchmark):
+    """Peak memory of writing a yearly detailed report from a dict vs streamed."""
+    write_ledger(TEST_USER_DIR, num_expenses)
+    report = Report("y", None, TEST_USER)
+    Ledger(report.expenses_file_path).table()  # The parsed ledger is not counted
+
+    def write():
+        if streamed:
+            return report.stream_detailed_report("json")
+        with patch("report.report_cache", ReportCache(max_entries=0)):
+            return report.detailed_generate_report()
+
+    benchmark.pedantic(write, rounds=3)
+    tracemalloc.start()
+    write()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    benchmark.extra_info["peak_bytes"] = peak
+    if streamed:
+        assert peak < 2 * 1024 * 1024
+
+
+@pytest.mark.parametrize("engine", ["thread_per_call", "io_pool"])
+def test_background_io_ops_per_sec(engine, benchmark):
+    """One small JSON write plus read per op: the old Queue/Thread-per-call
+    path against the shared I/O pool."""
+    file_path = TEST_USER_DIR / "io_benchmark.json"
+    data = {"budget": 1000, "income": 5000}
+
+    def thread_per_call():
+        # What every background_fileIO() call used to pay: a result Queue
+        # and a thread of its own
+        for mode, target, args in (("w", "save_to_file", (data,)), ("r", "read_from_file", ())):
+            tasks = BackgroundTasks(file_path, mode)
+            multiprocessing.Queue()
+            thread = Thread(target=getattr(tasks, target), args=args, daemon=True)
+            thread.start()
+            thread.join(timeout=5)
+        return tasks.data
+
+    def io_pool():
+        BackgroundTasks(file_path, "w").background_fileIO(data)
+        return BackgroundTasks(file_path, "r").background_fileIO()
+
+    try:
+        result = benchmark(thread_per_call if engine == "thread_per_call" else io_pool)
+    finally:
+        file_path.unlink(missing_ok=True)
+    benchmark.extra_info["ops_per_sec"] = 1 / benchmark.stats.stats.mean
+    assert result == data
+
+
+@pytest.mark.parametrize("setup_expenses", [1000], indirect=True)
+@pytest.mark.parametrize("write_behind", [False, True])
+def test_write_behind_bulk_entry_performance(setup_expenses, write_behind, benchmark):
+    """50 adds in a row, made durable at the end, with and without write-behind."""
+    expense = setup_expenses
+    buffer = WriteBehind()
+    names = (f"Bulk_{i}" for i in range(10**6))
+
+    def add_batch():
+        for _ in range(50):
+            expense.name = next(names)
+            expense.add_expense()
+        assert flush_writes()
+
+    with patch("Multithreading_Multiprocessing.write_behind", buffer), \
+            patch("Multithreading_Multiprocessing.WRITE_BEHIND", write_behind):
+        benchmark.pedantic(add_batch, rounds=5)
+
+    benchmark.extra_info["writes"] = buffer.writes
+    benchmark.extra_info["flushed"] = buffer.flushed
+    with open(TEST_USER_DIR / "expenses.json") as file:
+        saved = json.load(file)
+    assert sum(name.startswith("Bulk_") for name in saved) == 250
+
+
+def add_expenses_worker(worker, count):
+    """Stress worker: count adds to TEST_USER from a separate process"""
+    expense = Expense("Initial", 1, "Test", "01-06-2025", "Test", TEST_USER)
+    expense.setup_file_path = TEST_USER_DIR / "expenses.json"
+    for i in range(count):
+        expense.name = f"Worker_{worker}_{i}"
+        expense.add_expense()
+
+
+@pytest.mark.parametrize("setup_expenses", [100], indirect=True)
+@pytest.mark.parametrize("processes", [1, 4])
+def test_multiprocess_writers_lose_no_updates(setup_expenses, processes, benchmark):
+    """Processes adding to one ledger at once; every add and every budget
+    update must survive. Reports adds/sec across all processes."""
+    per_process = 40 // processes
+    rounds = iter(range(10**6))
+
+    def run():
+        first = next(rounds) * processes
+        workers = [multiprocessing.Process(target=add_expenses_worker,
+                                           args=(first + worker, per_process))
+                   for worker in range(processes)]
+        for process in workers:
+            process.start()
+        for process in workers:
+            process.join(timeout=60)
+            assert process.exitcode == 0
+
+    benchmark.pedantic(run, rounds=3)
+    benchmark.extra_info["adds_per_sec"] = processes * per_process / benchmark.stats.stats.mean
+
+    with open(TEST_USER_DIR / "expenses.json") as file:
+        saved = json.load(file)
+    budget_info = saved.pop("budget_info")
+    assert sum(name.startswith("Worker_") for name in saved) == 3 * 40
+    assert budget_info["count"] == len(saved)
+    assert budget_info["total_spent"] == pytest.approx(
+        sum(expense["amount"] for expense in saved.values()))
+    assert budget_info["current_budget"] == pytest.approx(
+        budget_info["initial_budget"] - budget_info["total_spent"])
+
+
+@pytest.mark.parametrize("engine", ["handlers_per_call", "registry"])
+def test_logging_overhead_per_operation(engine, benchmark):
+    """Getting a user's logger and writing one INFO record, as every Expense
+    and Report call does, for 20 users in turn."""
+    usernames = [f"log_user_{i}" for i in range(20)]
+    process = psutil.Process()
+
+    def handlers_per_call(username):
+        # What each setup_logging() call used to do
+        logger = logging.getLogger("test_performance.legacy")
+        logger.setLevel(logging.DEBUG)
+        logger.propagate = False
+        user_dir = BASE_DIR / "users" / username
+        user_dir.mkdir(parents=True, exist_ok=True)
+        file_handler = RotatingFileHandler(
+            user_dir / "tracker.log", maxBytes=5*1024*1024, backupCount=3)
+        file_handler.setLevel(logging.INFO)
+        file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+        logger.handlers = [file_handler]
+        return logger
+
+    files = UserLogFiles()
+
+    def registry(username):
+        logger = get_logger("test_performance.registry", username)
+        # Route the records to this test's pool instead of the global one
+        logger.handlers[0] = UserFileHandler(files, username)
+        logger.propagate = False
+        return logger
+
+    get = handlers_per_call if engine == "handlers_per_call" else registry
+    operations = iter(range(10**7))
+    fds_before = process.num_fds()
+
+    def log_operations():
+        for _ in range(100):
+            operation = next(operations)
+            get(usernames[operation % len(usernames)]).info(f"operation {operation}")
+
+    try:
+        benchmark(log_operations)
+        benchmark.extra_info["us_per_operation"] = benchmark.stats.stats.mean / 100 * 1e6
+        benchmark.extra_info["fds_opened"] = process.num_fds() - fds_before
+        if engine == "registry":
+            # One open log file per user, reused across operations
+            assert files.opened == len(usernames)
+            assert process.num_fds() - fds_before <= files.max_open + 2
+    finally:
+        files.close_all()
+        for username in usernames:
+            for file in (BASE_DIR / "users" / username).glob("*"):
+                file.unlink()
+            (BASE_DIR / "users" / username).rmdir()
+
+
+@pytest.mark.parametrize("pipeline", ["synchronous", "queued", "queued_sampled"])
+def test_hot_path_logging_performance(pipeline, benchmark):
+    """Request-path cost of the INFO record every add writes: formatted and
+    written on the calling thread, queued to the listener, or queued with
+    1 in 100 kept."""
+    files = UserLogFiles(buffered=pipeline != "synchronous")
+    log_pipeline = LogPipeline(files)
+    logger = logging.getLogger(f"test_performance.hot.{pipeline}")
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+    targets = [UserFileHandler(files, TEST_USER)]
+    logger.handlers = targets if pipeline == "synchronous" else [
+        RoutingQueueHandler(log_pipeline, targets)]
+    sampler = LogSampler(sample={"expense.add": 0.01})
+    logger.filters = [sampler] if pipeline == "queued_sampled" else []
+    expense = {"amount": 100, "category": "Test", "date": "01-06-2025", "description": "Test"}
+    logged = 0
+
+    def add_records():
+        nonlocal logged
+        for _ in range(1000):
+            logger.info("Expense saved and budget updated: %s", expense,
+                        extra=log_category("expense.add"))
+        logged += 1000
+
+    try:
+        # A fixed number of rounds keeps the log (~120 bytes a record) well
+        # under the 5 MB at which it would rotate
+        benchmark.pedantic(add_records, rounds=20, iterations=1)
+        assert log_pipeline.flush()
+        if log_pipeline.listener:
+            benchmark.extra_info["listener_batches"] = log_pipeline.listener.batches
+    finally:
+        log_pipeline.stop()
+        files.close_all()
+    benchmark.extra_info["us_per_record"] = benchmark.stats.stats.mean / 1000 * 1e6
+    lines = sum(path.read_text().count("\n") for path in TEST_USER_DIR.glob("tracker.log*"))
+    assert lines == (logged // 100 if pipeline == "queued_sampled" else logged)
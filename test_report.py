@@ -5,7 +5,10 @@ import time
 import psutil
 from pathlib import Path
 from datetime import datetime, timedelta
-from report import Report
+from report import Report, ReportCache, calendar_period
+from report_writer import read_report
+from ledger import Ledger, PartitionedLedger, migrate_to_partitions
+import Multithreading_Multiprocessing as background
 from transaction import Expense
 from setup import Setup
 from unittest.mock import patch
@@ -179,3 +182,183 @@ def test_detailed_report_performance(setup_expenses, benchmark):
 
     assert benchmark.stats.stats.mean < 2.0  # Detailed report < 2s
     assert end_memory - start_memory < 30  # Memory increase < 30MB
+
+
+@pytest.mark.parametrize("period,expected", [
+    ("cd", (datetime(2025, 6, 18).date(), datetime(2025, 6, 18).date())),
+    ("cw", (datetime(2025, 6, 16).date(), datetime(2025, 6, 22).date())),
+    ("cm", (datetime(2025, 6, 1).date(), datetime(2025, 6, 30).date())),
+    ("cy", (datetime(2025, 1, 1).date(), datetime(2025, 12, 31).date())),
+    ("2024-02", (datetime(2024, 2, 1).date(), datetime(2024, 2, 29).date())),
+    ("2024", (datetime(2024, 1, 1).date(), datetime(2024, 12, 31).date())),
+    ("fortnight", None),
+])
+def test_calendar_period(period, expected):
+    assert calendar_period(period, datetime(2025, 6, 18).date()) == expected
+
+
+@pytest.mark.parametrize("setup_expenses", [30], indirect=True)
+@pytest.mark.parametrize("time_period,start,end,expected_count", [
+    (None, "01-06-2025", "10-06-2025", 10),
+    (None, "30-06-2025", None, 1),
+    ("2025-06", None, None, 30),
+    ("2025-07", None, None, 0),
+    # A custom period with both dates left blank covers everything to date
+    ("custom", None, None, 30),
+    (None, None, None, 30),
+])
+def test_report_date_windows(setup_expenses, time_period, start, end, expected_count):
+    """Test custom start/end and calendar month windows."""
+    report = Report(time_period, None, TEST_USER, start, end)
+    assert report.detailed_report_path.name != "detailed_report_None.json"
+    result = report.brief_generate_report()
+    assert result is not None
+    assert len(result["expenses"]) == expected_count
+    assert result["total_expense"] == sum(
+        expense["amount"] for expense in result["expenses"].values())
+
+
+@pytest.mark.parametrize("setup_expenses", [30], indirect=True)
+def test_generate_reports_single_scan(setup_expenses):
+    """Brief and detailed reports come from one ledger query."""
+    report = Report("2025-06", "Food", TEST_USER)
+    # The analytics come from the rows query() selected, not a second pass
+    with patch.object(Ledger, "query", autospec=True, side_effect=Ledger.query) as query, \
+            patch.object(Ledger, "analyze", side_effect=AssertionError):
+        results = report.generate_reports()
+    assert query.call_count == 1
+    assert results["brief"] == report.brief_generate_report()
+    assert results["detailed"] == report.detailed_generate_report(no_save=True)
+
+
+@pytest.mark.parametrize("setup_expenses", [30], indirect=True)
+def test_small_ledgers_are_reported_in_process(setup_expenses):
+    report = Report("2025-06", None, TEST_USER)
+    with patch.object(background, "get_report_pool", side_effect=AssertionError):
+        results = background.BackgroundTasks().generate_reports(report)
+    assert len(results["brief"]["expenses"]) == 30
+    assert (TEST_USER_DIR / "detailed_report_2025-06.json").exists()
+
+
+@pytest.mark.parametrize("setup_expenses", [30], indirect=True)
+def test_large_ledgers_use_persistent_pool(setup_expenses):
+    report = Report("2025-06", None, TEST_USER)
+    expected = report.generate_reports()
+    try:
+        with patch.object(background, "REPORT_INPROCESS_BYTES", 0):
+            assert background.BackgroundTasks().generate_reports(report) == expected
+            pool = background.get_report_pool()
+            assert background.BackgroundTasks().generate_reports(report) == expected
+            assert background.get_report_pool() is pool
+    finally:
+        background.shutdown_report_pool()
+
+
+@pytest.mark.parametrize("setup_expenses", [30], indirect=True)
+def test_report_cache_is_invalidated_by_expense_changes(setup_expenses):
+    cache = ReportCache()
+    with patch("report.report_cache", cache), \
+            patch.object(Ledger, "query", autospec=True, side_effect=Ledger.query) as query:
+        first = Report("2025-06", None, TEST_USER).brief_generate_report()
+        assert Report("2025-06", None, TEST_USER).brief_generate_report() == first
+        assert query.call_count == 1 and cache.hits == 1
+
+        Expense("Extra", 50, "Food", "15-06-2025", "", TEST_USER).add_expense()
+        changed = Report("2025-06", None, TEST_USER).brief_generate_report()
+    assert query.call_count == 2
+    assert changed["total_expense"] == first["total_expense"] + 50
+    assert cache.stats()["misses"] == 2
+
+
+@pytest.mark.parametrize("setup_expenses", [30], indirect=True)
+@pytest.mark.parametrize("file_format,compression", [("json", None), ("jsonl", "gzip"),
+                                                     ("json", "lzma")])
+def test_report_cache_reads_back_saved_detailed_report(setup_expenses, file_format,
+                                                       compression):
+    with patch("report_writer.REPORT_FORMAT", file_format), \
+            patch("report_writer.REPORT_COMPRESSION", compression):
+        detailed = Report("2025-06", "Food", TEST_USER).detailed_generate_report()
+
+        # A fresh process has an empty cache but the saved report still matches
+        cache = ReportCache()
+        with patch("report.report_cache", cache), \
+                patch.object(Ledger, "query", side_effect=AssertionError):
+            assert Report("2025-06", "Food", TEST_USER).detailed_generate_report(
+                no_save=True) == detailed
+        assert cache.disk_hits == 1
+
+        # Once the ledger changes the saved report is ignored
+        Expense("Extra", 50, "Food", "15-06-2025", "", TEST_USER).add_expense()
+        with patch("report.report_cache", ReportCache()):
+            refreshed = Report("2025-06", "Food", TEST_USER).detailed_generate_report(
+                no_save=True)
+    assert refreshed["ledger_version"] > detailed["ledger_version"]
+    assert "Extra" in refreshed["expenses"]
+
+
+@pytest.mark.parametrize("setup_expenses", [30], indirect=True)
+def test_summary_is_answered_from_rollups(setup_expenses):
+    brief = Report("2025", "Food", TEST_USER).brief_generate_report()
+    with patch.object(Ledger, "query", side_effect=AssertionError), \
+            patch("report.report_cache", ReportCache()):
+        summary = Report("2025", "Food", TEST_USER).summary()
+    assert summary["total_expense"] == brief["total_expense"]
+    assert summary["remaining_budget"] == brief["remaining_budget"]
+
+
+def test_partitioned_summary_reads_only_partial_months(tmp_path):
+    user_dir = tmp_path / "users" / TEST_USER
+    user_dir.mkdir(parents=True)
+    (user_dir / "setup.json").write_text(json.dumps({"budget": 1000}))
+    expenses = {"budget_info": {"current_budget": 1000}}
+    for month in (5, 6, 7):
+        for day in (1, 15, 28):
+            expenses[f"Expense_{month}_{day}"] = {
+                "amount": month * day, "category": "Food" if day < 20 else "Travel",
+                "date": f"{day:02d}-{month:02d}-2025", "description": ""}
+    (user_dir / "expenses.json").write_text(json.dumps(expenses))
+    migrate_to_partitions(user_dir / "expenses.json")
+
+    with patch("report.BASE_DIR", tmp_path), patch("ledger.STORAGE_MODE", "partitioned"), \
+            patch("report.report_cache", ReportCache()), \
+            patch.object(PartitionedLedger, "partition_table", autospec=True,
+                         side_effect=PartitionedLedger.partition_table) as partition_table:
+        summary = Report(None, "Food", TEST_USER, "01-05-2025", "20-07-2025").summary()
+    # May and June are whole months, so only July's rows were read
+    assert [call.args[1] for call in partition_table.call_args_list] == ["2025-07"]
+    assert summary["total_expense"] == 5 * 16 + 6 * 16 + 7 * 16
+    assert summary["remaining_budget"] == 1000 - summary["total_expense"]
+
+
+@pytest.mark.parametrize("setup_expenses", [30], indirect=True)
+def test_reports_include_streaming_analytics(setup_expenses):
+    brief = Report("2025-06", None, TEST_USER).brief_generate_report()
+    analytics = Report("2025-06", None, TEST_USER).analytics()
+    assert brief["analytics"] == {key: value for key, value in analytics.items()
+                                  if key not in ("time_period", "category")}
+    assert analytics["total_expense"] == brief["total_expense"]
+    assert sum(analytics["by_category"].values()) == pytest.approx(brief["total_expense"])
+    amounts = sorted((details["amount"] for details in brief["expenses"].values()),
+                     reverse=True)
+    assert [item["amount"] for item in analytics["top_expenses"]] == amounts[:5]
+    assert min(amounts) <= analytics["percentiles"]["p50"] <= max(amounts)
+
+
+@pytest.mark.parametrize("setup_expenses", [30], indirect=True)
+@pytest.mark.parametrize("file_format,compression", [("json", None), ("jsonl", "gzip")])
+def test_streamed_detailed_report_matches_in_memory_report(setup_expenses, file_format,
+                                                           compression):
+    detailed = Report("2025-06", "Food", TEST_USER).detailed_generate_report(no_save=True)
+    with patch.object(Ledger, "analyze", side_effect=AssertionError):
+        result = Report("2025-06", "Food", TEST_USER).stream_detailed_report(
+            file_format, compression)
+    assert result["expenses"] == len(detailed["expenses"])
+    assert read_report(result["path"]) == detailed
+
+
+@pytest.mark.parametrize("setup_expenses", [30], indirect=True)
+def test_saved_detailed_report_is_compact_json(setup_expenses):
+    detailed = Report("2025-06", None, TEST_USER).detailed_generate_report()
+    saved = (TEST_USER_DIR / "detailed_report_2025-06.json").read_text()
+    assert json.loads(saved) == detailed
+    assert len(saved) < len(json.dumps(detailed, indent=4)) * 0.8
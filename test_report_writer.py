@@ -0,0 +1,75 @@
+import pytest
+import json
+from report_writer import read_report, report_path, write_report
+
+REPORT = {
+    "time_period": "2025-06",
+    "category": None,
+    "total_expense": 35.5,
+    "budget_info": {"current_budget": 1000},
+    "expenses": {
+        "Lunch": {"amount": 10.5, "category": "Food", "date": "01-06-2025", "description": ""},
+        "Taxi, late": {"amount": 25.0, "category": "Travel", "date": "02-06-2025",
+                       "description": 'said "hi"'}
+    }
+}
+
+
+def header(report):
+    return {key: value for key, value in report.items() if key != "expenses"}
+
+
+@pytest.mark.parametrize("compression", [None, "gzip", "lzma"])
+@pytest.mark.parametrize("file_format", ["json", "jsonl", "csv"])
+def test_reports_round_trip(tmp_path, file_format, compression):
+    file_path = report_path(tmp_path / "detailed_report_2025-06.json", file_format, compression)
+    assert file_path.name == "detailed_report_2025-06." + {
+        "json": "json", "jsonl": "jsonl", "csv": "csv"}[file_format] + {
+        None: "", "gzip": ".gz", "lzma": ".xz"}[compression]
+
+    count = write_report(file_path, header(REPORT), iter(REPORT["expenses"].items()), file_format)
+    assert count == 2
+    loaded = read_report(file_path)
+    if file_format == "csv":
+        assert loaded == {"expenses": REPORT["expenses"]}
+    else:
+        assert loaded == REPORT
+
+
+def test_json_report_is_compact(tmp_path):
+    file_path = tmp_path / "report.json"
+    write_report(file_path, header(REPORT), REPORT["expenses"].items(), "json")
+    assert json.loads(file_path.read_text()) == REPORT
+    assert file_path.stat().st_size < len(json.dumps(REPORT, indent=4))
+    assert "\n" not in file_path.read_text()
+
+
+def test_failed_write_keeps_the_previous_report(tmp_path):
+    file_path = tmp_path / "report.jsonl"
+    write_report(file_path, header(REPORT), REPORT["expenses"].items(), "jsonl")
+
+    def rows():
+        yield "Lunch", REPORT["expenses"]["Lunch"]
+        raise OSError("disk full")
+
+    with pytest.raises(OSError):
+        write_report(file_path, header(REPORT), rows(), "jsonl")
+    assert read_report(file_path) == REPORT
+    assert [path.name for path in tmp_path.iterdir()] == ["report.jsonl"]
+
+
+@pytest.mark.parametrize("file_format", ["json", "jsonl"])
+def test_trailer_fields_are_computed_after_the_rows(tmp_path, file_format):
+    file_path = report_path(tmp_path / "report.json", file_format)
+    seen = []
+
+    def rows():
+        for name, expense in REPORT["expenses"].items():
+            seen.append(expense["amount"])
+            yield name, expense
+
+    head = {"time_period": "2025-06", "category": None,
+            "budget_info": REPORT["budget_info"]}
+    write_report(file_path, head, rows(), file_format,
+                 trailer=lambda: {"total_expense": sum(seen)})
+    assert read_report(file_path) == REPORT
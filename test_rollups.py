@@ -0,0 +1,58 @@
+import pytest
+import random
+from rollups import Rollups
+from expense_table import to_day, from_day
+
+
+def make_expenses(num_expenses, seed=7):
+    rng = random.Random(seed)
+    first_day = to_day("01-01-2024")
+    return {f"Expense_{i}": {"amount": rng.randint(1, 500) / 4,
+                             "category": rng.choice(["Food", "Travel", "Rent"]),
+                             "date": from_day(first_day + rng.randrange(730)),
+                             "description": ""}
+            for i in range(num_expenses)}
+
+
+def brute_force_total(rows, first_day, last_day, category=None):
+    return sum(amount for day, row_category, amount in rows
+               if first_day <= day <= last_day and category in (None, row_category))
+
+
+@pytest.mark.parametrize("category", [None, "Food", "Unknown"])
+def test_total_matches_raw_rows(category):
+    expenses = make_expenses(2000)
+    rollups = Rollups.build(expenses.items())
+    rows = [(to_day(expense["date"]), expense["category"], expense["amount"])
+            for expense in expenses.values()]
+    rng = random.Random(1)
+    for _ in range(50):
+        first_day = to_day("01-12-2023") + rng.randrange(800)
+        last_day = first_day + rng.randrange(400)
+        assert rollups.total(first_day, last_day, category) == pytest.approx(
+            brute_force_total(rows, first_day, last_day, category))
+
+
+def test_months_are_derived_from_days():
+    rollups = Rollups.build(make_expenses(500).items())
+    month_totals = rollups.month_totals()
+    assert len(month_totals) == 24
+    assert sum(sum(totals.values()) for totals in month_totals.values()) == pytest.approx(
+        sum(sum(totals.values()) for totals in rollups.days.values()))
+
+
+def test_add_and_remove_cancel_out():
+    rollups = Rollups()
+    expense = {"amount": 12.5, "category": "Food", "date": "03-06-2025"}
+    rollups.add(expense)
+    rollups.add(expense, -1)
+    assert rollups.days == {} and rollups.months == {}
+
+
+def test_round_trip_and_diff():
+    rollups = Rollups.build(make_expenses(100).items())
+    restored = Rollups.from_dict(rollups.to_dict())
+    assert restored.diff(rollups) == []
+
+    restored.add({"amount": 5, "category": "Food", "date": "01-01-2020"})
+    assert restored.diff(rollups) == [("01-01-2020", "Food", 5, None)]
@@ -1,5 +1,9 @@
 import pytest
+from pathlib import Path
 from transaction import Expense
+from unittest.mock import patch
+from ledger import open_ledger, load_rollups, verify_rollups
+from rollups import Rollups
 import json
 
 
@@ -51,3 +55,121 @@ def test_check_budget(expense):
     initial_budget = data.get("budget_info", {}).get("initial_budget", 0)
     # Assuming initial budget is less than or equal to 100
     assert remaining_budget <= initial_budget
+
+
+@pytest.fixture
+def bulk_user():
+    import shutil
+    user_dir = Path(__file__).resolve().parent / "users" / "bulk_test_user"
+    user_dir.mkdir(parents=True, exist_ok=True)
+    with open(user_dir / "setup.json", "w") as file:
+        json.dump({"budget": 1000, "income": 5000}, file)
+    yield "bulk_test_user"
+    shutil.rmtree(user_dir)
+
+
+def test_add_expenses_bulk(bulk_user):
+    rows = [{"name": f"item {i}", "amount": "10", "category": "food",
+             "date": "01-06-2025"} for i in range(25)]
+    rows.append({"name": "bad", "amount": "ten", "category": "food"})
+    rows.append({"name": "bad date", "amount": 1,
+                "category": "food", "date": "2025-06-01"})
+
+    summary = Expense.add_expenses_bulk(bulk_user, rows, chunk_size=10)
+    assert summary["added"] == 25
+    assert summary["skipped"] == 2
+    assert summary["rows_per_sec"] > 0
+
+    assert Expense.load_expense("Item_3", bulk_user)["category"] == "Food"
+    assert Expense.check_budget(bulk_user) == 1000 - 25 * 10
+
+
+def test_bulk_import_rejects_bad_amounts_and_duplicates(bulk_user):
+    rows = [{"name": "taxi", "amount": 20, "category": "travel", "date": "01-06-2025"},
+            {"name": "Taxi", "amount": 30, "category": "travel", "date": "01-06-2025"}]
+    rows += [{"name": f"bad {amount}", "amount": amount, "category": "food"}
+             for amount in ("nan", "inf", "-inf", -5)]
+
+    summary = Expense.add_expenses_bulk(bulk_user, rows)
+    assert summary["added"] == 1
+    assert summary["skipped"] == 5
+    assert summary["duplicates"] == 1
+    # The first row was kept and the budget charged for it alone
+    assert Expense.load_expense("Taxi", bulk_user)["amount"] == 20
+    assert Expense.check_budget(bulk_user) == 1000 - 20
+
+
+def test_iter_expenses_pages_and_sorts(bulk_user):
+    rows = [{"name": f"item {i}", "amount": (i * 7) % 10, "category": "food",
+             "date": f"{i + 1:02d}-06-2025"} for i in range(12)]
+    Expense.add_expenses_bulk(bulk_user, rows)
+
+    assert Expense.count_expenses(bulk_user) == 12
+    first_page = list(Expense.iter_expenses(bulk_user, 0, 5))
+    assert [name for name, _ in first_page] == [
+        f"Item_{i}" for i in range(5)]
+    assert len(list(Expense.iter_expenses(bulk_user, 10, 5))) == 2
+
+    newest = list(Expense.iter_expenses(bulk_user, 0, 1, sort="-date"))
+    assert newest[0][0] == "Item_11"
+    amounts = [expense["amount"]
+               for _, expense in Expense.iter_expenses(bulk_user, sort="amount")]
+    assert amounts == sorted(amounts)
+
+
+def test_running_aggregates_follow_changes(bulk_user):
+    Expense("Lunch", 10, "Food", "01-06-2025", "", bulk_user).add_expense()
+    Expense("Taxi", 25, "Travel", "02-06-2025", "", bulk_user).add_expense()
+    Expense.update_expense("Lunch", bulk_user, amount=15, category="Travel")
+    Expense.delete_expense("Taxi", bulk_user)
+
+    result = Expense.rebuild_aggregates(bulk_user)
+    assert result["matches"]
+    assert result["stored"] == {"total_spent": 15, "count": 1,
+                                "category_totals": {"Travel": 15}}
+
+
+def test_rebuild_aggregates_repairs_drift(bulk_user):
+    Expense("Lunch", 10, "Food", "01-06-2025", "", bulk_user).add_expense()
+    expenses_path = Path(__file__).resolve().parent / \
+        "users" / bulk_user / "expenses.json"
+    with open(expenses_path, "r") as file:
+        data = json.load(file)
+    data["budget_info"]["total_spent"] = 999
+    with open(expenses_path, "w") as file:
+        json.dump(data, file)
+
+    assert not Expense.rebuild_aggregates(bulk_user)["matches"]
+    assert Expense.rebuild_aggregates(bulk_user)["matches"]
+
+
+def test_rollups_follow_add_update_and_delete(bulk_user):
+    Expense("Lunch", 10, "Food", "01-06-2025", "", bulk_user).add_expense()
+    expenses_path = Path(__file__).resolve().parent / "users" / bulk_user / "expenses.json"
+    load_rollups(open_ledger(expenses_path))
+
+    # From here on the rollups are maintained, never rebuilt
+    with patch.object(Rollups, "build", side_effect=AssertionError):
+        Expense("Taxi", 25, "Travel", "02-06-2025", "", bulk_user).add_expense()
+        Expense.update_expense("Lunch", bulk_user, amount=15,
+                               category="Travel", date="03-07-2025")
+        Expense("Rent", 500, "Rent", "05-07-2025", "", bulk_user).add_expense()
+        Expense.delete_expense("Rent", bulk_user)
+        rollups = load_rollups(open_ledger(expenses_path))
+
+    assert rollups.month_totals() == {"2025-06": {"Travel": 25},
+                                      "2025-07": {"Travel": 15}}
+    assert verify_rollups(expenses_path) == []
+
+
+def test_verify_rollups_reports_drift(bulk_user):
+    Expense("Lunch", 10, "Food", "01-06-2025", "", bulk_user).add_expense()
+    expenses_path = Path(__file__).resolve().parent / "users" / bulk_user / "expenses.json"
+    assert verify_rollups(expenses_path) is None
+    assert verify_rollups(expenses_path) == []
+
+    with open(expenses_path.with_name("expenses.rollup.json"), "w") as file:
+        json.dump({"days": {}}, file)
+    assert verify_rollups(expenses_path, fix=False) == [("01-06-2025", "Food", None, 10)]
+    assert verify_rollups(expenses_path) != []
+    assert verify_rollups(expenses_path) == []
@@ -1,59 +1,45 @@
 from datetime import datetime, timedelta
 import json
-import logging
-from logging.handlers import RotatingFileHandler
+import math
+from app_logging import get_logger, log_category
 from pathlib import Path
 from Multithreading_Multiprocessing import BackgroundTasks
+from ledger import open_ledger, ledger_lock
 import time
-from threading import Lock
-
-
-# Shared logger for system-wide errors (configured once)
-shared_logger = None
-file_lock = Lock()
-
-
-def setup_logging(username):
-    global shared_logger
-    logger = logging.getLogger(__name__)
-    logger.setLevel(logging.DEBUG)
-    user_dir = BASE_DIR / "users" / username
-    user_dir.mkdir(parents=True, exist_ok=True)
-
-    # User-specific log with rotation
-    file_handler = RotatingFileHandler(
-        user_dir / "tracker.log", maxBytes=5*1024*1024, backupCount=3
-    )
-    console_handler = logging.StreamHandler()
-    file_handler.setLevel(logging.INFO)
-    console_handler.setLevel(logging.WARNING)
-    formatter = logging.Formatter(
-        "%(asctime)s -%(name)s - %(levelname)s - %(message)s")
-    file_handler.setFormatter(formatter)
-    console_handler.setFormatter(formatter)
-
-    # Configure shared logger for ERROR and CRITICAL (only once)
-    if shared_logger is None:
-        shared_logger = logging.getLogger('shared')
-        shared_logger.setLevel(logging.ERROR)
-        shared_file_handler = RotatingFileHandler(
-            BASE_DIR / "tracker.log", maxBytes=10*1024*1024, backupCount=5
-        )
-        shared_file_handler.setFormatter(formatter)
-        shared_logger.handlers = [shared_file_handler]
-
-    # Clear existing handlers to avoid duplicates
-    logger.handlers = []
-    logger.addHandler(file_handler)
-    logger.addHandler(console_handler)
-    # Add shared handler for ERROR/CRITICAL
-    logger.addHandler(shared_logger.handlers[0])
-    return logger
+from itertools import islice
+
+# budget_info fields maintained incrementally on every ledger change
+AGGREGATE_KEYS = ("total_spent", "category_totals", "count")
 
 
 BASE_DIR = Path(__file__).resolve().parent
 
 
+def compute_aggregates(expenses):
+    """Running totals kept in budget_info, computed from (name, expense) pairs"""
+    aggregates = {"total_spent": 0, "category_totals": {}, "count": 0}
+    for _, expense in expenses:
+        update_aggregates(aggregates, expense, 1)
+    return aggregates
+
+
+def update_aggregates(budget_info, expense, sign):
+    """Add (sign=1) or remove (sign=-1) one expense from the running totals"""
+    if "total_spent" not in budget_info:
+        # Ledger from before running totals; rebuild_aggregates fills them in
+        return
+    amount = expense.get("amount", 0)
+    category = expense.get("category")
+    budget_info["total_spent"] += sign * amount
+    budget_info["count"] += sign
+    # Replace rather than mutate: budget_info may share it with the ledger cache
+    category_totals = dict(budget_info["category_totals"])
+    category_totals[category] = category_totals.get(category, 0) + sign * amount
+    if abs(category_totals[category]) < 1e-9:
+        del category_totals[category]
+    budget_info["category_totals"] = category_totals
+
+
 class Expense:
     def __init__(self, name, amount, category, date=None, description="", username=None):
         self.name = name
@@ -62,7 +48,7 @@ class Expense:
         self.date = date if date else datetime.now().strftime("%d-%m-%Y")
         self.description = description
         self.username = username
-        self.logger = setup_logging(username)
+        self.logger = get_logger(__name__, username)
         user_dir = BASE_DIR / "users" / self.username
         user_dir.mkdir(parents=True, exist_ok=True)
         self.setup_file_path = user_dir / "expenses.json"
@@ -75,91 +61,188 @@ class Expense:
             "description": self.description
         }
 
+    @classmethod
+    def new_budget_info(cls, username):
+        """Fresh budget_info for the current month from the user's setup.json"""
+        user_dir = BASE_DIR / "users" / username
+        setup = BackgroundTasks(user_dir / "setup.json", "r")
+        setup_data = setup.background_fileIO()
+        initial_budget = setup_data.get("budget", 0)
+        return {
+            "month": datetime.now().strftime("%Y-%m"),
+            "initial_budget": initial_budget,
+            "current_budget": initial_budget,
+            "income": setup_data.get("income", 0)
+        }
+
     def set_budget(self):
         try:
-            user_dir = BASE_DIR / "users" / self.username
-            setup = BackgroundTasks(user_dir / "setup.json", "r")
-            setup_data = setup.background_fileIO()
-            initial_budget = setup_data.get("budget", 0)
-            income = setup_data.get("income", 0)
-
-            # Load or create expenses file
-            if self.setup_file_path.exists():
-                expenses = BackgroundTasks(self.setup_file_path, "r")
-                expenses_data = expenses.background_fileIO()
-            else:
-                expenses_data = {}
-
-            current_month = datetime.now().strftime("%Y-%m")
-
-            # Check if we need to reset monthly budget
-            if "budget_info" not in expenses_data or expenses_data["budget_info"].get("month") != current_month:
-                expenses_data["budget_info"] = {
-                    "month": current_month,
-                    "initial_budget": initial_budget,
-                    "current_budget": initial_budget,
-                    "income": income
-                }
-
-                expenses = BackgroundTasks(self.setup_file_path, "w")
-                expenses.background_fileIO(expenses_data)
-                self.logger.info(f"Monthly budget reset to: {initial_budget}")
+            with ledger_lock(self.setup_file_path):
+                # Load or create expenses file
+                ledger = open_ledger(self.setup_file_path)
+                budget_info = ledger.get("budget_info") if ledger.exists() else None
+
+                current_month = datetime.now().strftime("%Y-%m")
+
+                # Check if we need to reset monthly budget
+                if budget_info is None or budget_info.get("month") != current_month:
+                    # Running totals cover the whole ledger, not just the month
+                    if budget_info is not None and "total_spent" in budget_info:
+                        aggregates = {key: budget_info[key] for key in AGGREGATE_KEYS}
+                    else:
+                        aggregates = compute_aggregates(ledger.items())
+                    budget_info = self.new_budget_info(self.username)
+                    budget_info.update(aggregates)
+                    ledger.commit(puts={"budget_info": budget_info})
+                    self.logger.info(
+                        f"Monthly budget reset to: {budget_info['initial_budget']}")
         except Exception as e:
             self.logger.exception(f"Failed to set budget: {e}")
             return 0
 
     def add_expense(self):
         try:
-            with file_lock:
-                expenses_reader = BackgroundTasks(self.setup_file_path, "r")
-                expenses = expenses_reader.background_fileIO(
-                ) if self.setup_file_path.exists() else {}
-                if expenses is None:
-                    expenses = {}
+            with ledger_lock(self.setup_file_path):
+                ledger = open_ledger(self.setup_file_path)
+                budget_info = ledger.get("budget_info") if ledger.exists() else None
 
                 # Initialize budget if not exists
-                if "budget_info" not in expenses:
+                if budget_info is None:
                     self.set_budget()
-                    expenses_reader = BackgroundTasks(
-                        self.setup_file_path, "r")
-                    expenses = expenses_reader.background_fileIO()
-                    if expenses is None:
+                    ledger = open_ledger(self.setup_file_path)
+                    budget_info = ledger.get("budget_info")
+                    if budget_info is None:
                         raise Exception("Failed to read expenses file")
 
                 # Update current budget
-                current_budget = expenses["budget_info"]["current_budget"]
-                expenses["budget_info"]["current_budget"] = current_budget - self.amount
+                current_budget = budget_info["current_budget"]
+                budget_info["current_budget"] = current_budget - self.amount
 
-                # Save expense
+                # Save expense (replacing one with the same name)
                 expense = self.to_dict()
-                expenses[self.name] = expense
+                replaced = ledger.get(self.name)
+                if replaced is not None:
+                    update_aggregates(budget_info, replaced, -1)
+                update_aggregates(budget_info, expense, 1)
+                ledger.commit(
+                    puts={self.name: expense, "budget_info": budget_info})
+
+                self.logger.info("Expense saved and budget updated: %s", expense,
+                                 extra=log_category("expense.add"))
+        except Exception as e:
+            self.logger.exception(f"Failed to save expense: {e}")
 
-                expenses_handler = BackgroundTasks(self.setup_file_path, "w")
-                expenses_handler.background_fileIO(expenses)
+    @staticmethod
+    def validate_row(row):
+        """Normalize an imported row to (name, expense dict); raises ValueError"""
+        name = str(row.get("name") or "").strip().title().replace(" ", "_")
+        if not name or name == "Budget_Info":
+            raise ValueError(f"Invalid expense name: {row.get('name')!r}")
+        amount = float(row.get("amount"))
+        if not math.isfinite(amount) or amount < 0:
+            raise ValueError(f"Invalid amount for {name}: {row.get('amount')!r}")
+        category = str(row.get("category") or "").strip(
+        ).title().replace(" ", "_")
+        if not category:
+            raise ValueError(f"Missing category for {name}")
+        date = str(row.get("date") or "").strip()
+        if date:
+            datetime.strptime(date, "%d-%m-%Y")
+        else:
+            date = datetime.now().strftime("%d-%m-%Y")
+        return name, {
+            "amount": amount,
+            "category": category,
+            "date": date,
+            "description": str(row.get("description") or "").strip()
+        }
 
-                self.logger.info(
-                    f"Expense saved and budget updated: {self.to_dict()}")
+    @classmethod
+    def add_expenses_bulk(cls, username, rows, chunk_size=5000):
+        """Add many expenses with one ledger read and write per chunk.
+
+        rows is any iterable of dicts with name, amount, category and
+        optionally date (DD-MM-YYYY) and description. Invalid rows are
+        skipped and counted, as are rows repeating a name seen earlier in
+        the import (the first one is kept). Returns a summary with rows/sec."""
+        user_dir = BASE_DIR / "users" / username
+        setup_file_path = user_dir / "expenses.json"
+        logger = get_logger(__name__, username)
+        summary = {"added": 0, "skipped": 0, "duplicates": 0}
+        start = time.perf_counter()
+        rows = iter(rows)
+        row_number = 0
+        seen = set()
+        try:
+            while True:
+                batch = list(islice(rows, chunk_size))
+                if not batch:
+                    break
+                chunk = {}
+                for row in batch:
+                    row_number += 1
+                    try:
+                        name, expense = cls.validate_row(row)
+                    except (TypeError, ValueError) as e:
+                        summary["skipped"] += 1
+                        logger.warning("Skipping import row %d: %s", row_number, e,
+                                       extra=log_category("import.skip"))
+                        continue
+                    if name in seen:
+                        summary["skipped"] += 1
+                        summary["duplicates"] += 1
+                        logger.warning("Skipping import row %d: duplicate name %s",
+                                       row_number, name, extra=log_category("import.skip"))
+                        continue
+                    seen.add(name)
+                    chunk[name] = expense
+                if not chunk:
+                    continue
+
+                with ledger_lock(setup_file_path):
+                    ledger = open_ledger(setup_file_path)
+                    budget_info = ledger.get(
+                        "budget_info") if ledger.exists() else None
+                    if budget_info is None:
+                        budget_info = cls.new_budget_info(username)
+                        budget_info.update(compute_aggregates(ledger.items()))
+                    budget_info["current_budget"] -= sum(
+                        expense["amount"] for expense in chunk.values())
+                    for replaced in ledger.get_many(chunk).values():
+                        update_aggregates(budget_info, replaced, -1)
+                    for expense in chunk.values():
+                        update_aggregates(budget_info, expense, 1)
+                    if not ledger.commit(puts={**chunk, "budget_info": budget_info}):
+                        raise Exception("Failed to save imported expenses")
+                summary["added"] += len(chunk)
+                logger.info("Imported %d expenses (total %d)", len(chunk), summary["added"],
+                            extra=log_category("import.chunk"))
         except Exception as e:
-            self.logger.exception(f"Failed to save expense: {e}")
+            logger.exception(f"Bulk import failed: {e}")
+            summary["error"] = str(e)
+
+        summary["seconds"] = time.perf_counter() - start
+        summary["rows_per_sec"] = (
+            summary["added"] / summary["seconds"] if summary["seconds"] else 0)
+        return summary
 
     @classmethod
     def load_expense(cls, expense_name, username):
         user_dir = BASE_DIR / "users" / username
         setup_file_path = user_dir / "expenses.json"
-        logger = setup_logging(username)
+        logger = get_logger(__name__, username)
         try:
-            if setup_file_path.exists():
-                expenses = BackgroundTasks(setup_file_path, "r")
-                expenses_data = expenses.background_fileIO()
-                if expenses_data:
-                    expense_data = expenses_data.get(expense_name)
-                    if expense_data:
-                        logger.info(f"Expense loaded: {expense_data}")
-                        return expense_data
-                    else:
-                        logger.warning(
-                            f"No expense found with name: {expense_name}")
-                        return None
+            ledger = open_ledger(setup_file_path)
+            if ledger.exists():
+                expense_data = ledger.get(expense_name)
+                if expense_data:
+                    logger.info("Expense loaded: %s", expense_data,
+                                extra=log_category("expense.load"))
+                    return expense_data
+                else:
+                    logger.warning(
+                        f"No expense found with name: {expense_name}")
+                    return None
             else:
                 logger.warning("No expenses file found.")
                 return None
@@ -171,27 +254,29 @@ class Expense:
     def delete_expense(cls, expense_name, username):
         user_dir = BASE_DIR / "users" / username
         setup_file_path = user_dir / "expenses.json"
-        logger = setup_logging(username)
+        logger = get_logger(__name__, username)
         try:
-            if setup_file_path.exists():
-                with open(setup_file_path, "r") as file:
-                    expenses = json.load(file)
-
-                if expense_name in expenses and expense_name != "budget_info":
-                    # Get the expense amount before deleting
-                    deleted_amount = expenses[expense_name]["amount"]
-                    # Update current budget by adding back the deleted expense amount
-                    expenses["budget_info"]["current_budget"] += deleted_amount
-                    # Delete the expense
-                    del expenses[expense_name]
-                    expenses_handler = BackgroundTasks(setup_file_path, "w")
-                    expenses_handler.background_fileIO(expenses)
-                    logger.info(f"Expense deleted: {expense_name}")
+            with ledger_lock(setup_file_path):
+                ledger = open_ledger(setup_file_path)
+                if ledger.exists():
+                    expense = ledger.get(
+                        expense_name) if expense_name != "budget_info" else None
+
+                    if expense is not None:
+                        # Update current budget by adding back the deleted expense amount
+                        budget_info = ledger.get("budget_info")
+                        budget_info["current_budget"] += expense["amount"]
+                        update_aggregates(budget_info, expense, -1)
+                        # Delete the expense
+                        ledger.commit(puts={"budget_info": budget_info},
+                                      deletes=[expense_name])
+                        logger.info("Expense deleted: %s", expense_name,
+                                    extra=log_category("expense.delete"))
+                    else:
+                        logger.warning(
+                            f"No expense found with name: {expense_name}")
                 else:
-                    logger.warning(
-                        f"No expense found with name: {expense_name}")
-            else:
-                logger.warning("No expenses file found.")
+                    logger.warning("No expenses file found.")
         except Exception as e:
             logger.exception(f"Failed to delete expense: {e}")
 
@@ -199,35 +284,41 @@ class Expense:
     def update_expense(cls, expense_name, username, **kwargs):
         user_dir = BASE_DIR / "users" / username
         setup_file_path = user_dir / "expenses.json"
-        logger = setup_logging(username)
+        logger = get_logger(__name__, username)
         try:
-            expenses_reader = BackgroundTasks(setup_file_path, "r")
-            expenses = expenses_reader.background_fileIO() if setup_file_path.exists() else None
-            if expenses is None:
-                logger.error("Failed to read expenses file")
-                return
-
-            if expense_name in expenses:
-                old_amount = expenses[expense_name].get("amount", 0)
-                new_amount = kwargs.get("amount", old_amount)
-
-                # Update budget if amount changed
-                if "amount" in kwargs:
-                    expenses["budget_info"]["current_budget"] += (
-                        old_amount - new_amount)
-
-                # Update expense fields
-                for key, value in kwargs.items():
-                    if key in expenses[expense_name]:
-                        expenses[expense_name][key] = value
-
-                expenses_handler = BackgroundTasks(setup_file_path, "w")
-                if not expenses_handler.background_fileIO(expenses):
-                    logger.error("Failed to save updated expenses")
+            with ledger_lock(setup_file_path):
+                ledger = open_ledger(setup_file_path)
+                if not ledger.exists():
+                    logger.error("Failed to read expenses file")
                     return
-                logger.info(f"Expense updated: {expense_name} with {kwargs}")
-            else:
-                logger.warning(f"No expense found with name: {expense_name}")
+
+                expense = ledger.get(expense_name)
+                if expense is not None:
+                    budget_info = ledger.get("budget_info")
+                    old_amount = expense.get("amount", 0)
+                    new_amount = kwargs.get("amount", old_amount)
+
+                    # Update budget if amount changed
+                    if "amount" in kwargs:
+                        budget_info["current_budget"] += (
+                            old_amount - new_amount)
+
+                    # Update expense fields
+                    update_aggregates(budget_info, expense, -1)
+                    for key, value in kwargs.items():
+                        if key in expense:
+                            expense[key] = value
+                    update_aggregates(budget_info, expense, 1)
+
+                    if not ledger.commit(puts={expense_name: expense,
+                                               "budget_info": budget_info}):
+                        logger.error("Failed to save updated expenses")
+                        return
+                    logger.info("Expense updated: %s with %s", expense_name, kwargs,
+                                extra=log_category("expense.update"))
+                else:
+                    logger.warning(
+                        f"No expense found with name: {expense_name}")
         except Exception as e:
             logger.exception(f"Failed to update expense: {e}")
 
@@ -235,11 +326,11 @@ class Expense:
     def list_expenses(cls, username):
         user_dir = BASE_DIR / "users" / username
         setup_file_path = user_dir / "expenses.json"
-        logger = setup_logging(username)
+        logger = get_logger(__name__, username)
         try:
-            if setup_file_path.exists():
-                with open(setup_file_path, "r") as file:
-                    expenses = json.load(file)
+            ledger = open_ledger(setup_file_path)
+            if ledger.exists():
+                expenses = ledger.load() or {}
                 for expense in expenses:
                     yield expense
             else:
@@ -249,22 +340,44 @@ class Expense:
             logger.exception(f"Failed to list expenses: {e}")
             return {}
 
+    @classmethod
+    def count_expenses(cls, username):
+        user_dir = BASE_DIR / "users" / username
+        ledger = open_ledger(user_dir / "expenses.json")
+        return ledger.count() if ledger.exists() else 0
+
+    @classmethod
+    def iter_expenses(cls, username, offset=0, limit=None, sort=None):
+        """Yield (name, expense) pairs from a single ledger read.
+
+        sort is one of name, date, amount or category, prefixed with '-'
+        for descending order; None keeps the order expenses were added."""
+        user_dir = BASE_DIR / "users" / username
+        setup_file_path = user_dir / "expenses.json"
+        logger = get_logger(__name__, username)
+        try:
+            ledger = open_ledger(setup_file_path)
+            if ledger.exists():
+                yield from ledger.items(offset, limit, sort)
+            else:
+                logger.warning("No expenses file found.")
+        except Exception as e:
+            logger.exception(f"Failed to list expenses: {e}")
+
     @classmethod
     def check_budget(cls, username):
         user_dir = BASE_DIR / "users" / username
         setup_file_path = user_dir / "expenses.json"
-        logger = setup_logging(username)
+        logger = get_logger(__name__, username)
         try:
-            with open(setup_file_path, "r") as file:
-                expenses = json.load(file)
-                budget_info = expenses.get("budget_info", {})
-                current_budget = budget_info.get("current_budget", 0)
+            budget_info = open_ledger(setup_file_path).get("budget_info") or {}
+            if budget_info and "total_spent" not in budget_info:
+                budget_info = cls.rebuild_aggregates(username)["budget_info"]
+            current_budget = budget_info.get("current_budget", 0)
 
             if current_budget < 0:
                 logger.warning(f"Budget exceeded by {-current_budget}!")
-            elif sum(
-                    exp.get("amount", 0) for name, exp in expenses.items() if name != "budget_info"
-            ) > budget_info.get("income", 0):
+            elif budget_info.get("total_spent", 0) > budget_info.get("income", 0):
                 logger.critical("Total expenses exceed the income!")
             else:
                 logger.info(f"Remaining budget: {current_budget}")
@@ -272,3 +385,35 @@ class Expense:
         except Exception as e:
             logger.exception(f"Failed to check budget: {e}")
             return 0
+
+    @classmethod
+    def rebuild_aggregates(cls, username):
+        """Recompute the running totals in budget_info from every expense.
+
+        Returns the stored and recomputed totals and whether they matched."""
+        user_dir = BASE_DIR / "users" / username
+        setup_file_path = user_dir / "expenses.json"
+        logger = get_logger(__name__, username)
+        with ledger_lock(setup_file_path):
+            ledger = open_ledger(setup_file_path)
+            budget_info = ledger.get("budget_info")
+            if budget_info is None:
+                logger.warning("No budget info to rebuild.")
+                return {"stored": None, "rebuilt": None, "matches": False,
+                        "budget_info": None}
+            stored = {key: budget_info[key]
+                      for key in AGGREGATE_KEYS if key in budget_info}
+            rebuilt = compute_aggregates(ledger.items())
+            matches = (stored.keys() == rebuilt.keys()
+                       and stored["count"] == rebuilt["count"]
+                       and abs(stored["total_spent"] - rebuilt["total_spent"]) < 1e-6
+                       and stored["category_totals"].keys() == rebuilt["category_totals"].keys()
+                       and all(abs(stored["category_totals"][category] - total) < 1e-6
+                               for category, total in rebuilt["category_totals"].items()))
+            if not matches:
+                budget_info.update(rebuilt)
+                ledger.commit(puts={"budget_info": budget_info})
+                logger.warning(
+                    f"Running totals rebuilt: stored {stored}, actual {rebuilt}")
+        return {"stored": stored, "rebuilt": rebuilt, "matches": matches,
+                "budget_info": budget_info}